@@ -5,14 +5,40 @@
 
 import sys 
 import random
+import time
+import tracemalloc
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+from array import array
+from itertools import chain, islice
+
+try:
+    import ctst  # C trie built from ctst.c by setup.py, see ctst.c
+except ImportError:
+    ctst = None
 
 
 def main():
     testTST()
+    testTST(cls=CompactTST)
+    testQueries()
+    testQueries(cls=CompactTST)
+    testQueries(cls=FastTST)
+    testMapped()
+    testDifferential()
+    testDifferential(classes=(TST, ConcurrentTST))
+    testQueries(cls=ConcurrentTST)
+    testConcurrentTST()
 
 
 class Node:
 
+    __slots__ = ('c', 'val', 'left', 'mid', 'right')
+
     def __init__(self, c=None):
         self.c = c
         self.val = None
@@ -33,9 +59,32 @@ class TST:
         Inserts key into trie and associates key with value. 
         """
         assert(isinstance(key, str))
-        if len(key) >= 1:
-            index = 0
-            self.root.mid = self.put_recursive(self.root.mid, key, val, index)
+        if len(key) == 0:
+            return
+        index = 0
+        last = len(key) - 1
+        c = key[0]
+        node = self.root.mid
+        if node is None:
+            node = self.root.mid = Node(c)
+        while True:
+            if c < node.c:
+                if node.left is None:
+                    node.left = Node(c)
+                node = node.left
+            elif c > node.c:
+                if node.right is None:
+                    node.right = Node(c)
+                node = node.right
+            elif index < last:
+                index += 1
+                c = key[index]
+                if node.mid is None:
+                    node.mid = Node(c)
+                node = node.mid
+            else:
+                node.val = val
+                return
 
     def put_recursive(self, node, key, val, index):
         if node is None:
@@ -58,10 +107,34 @@ class TST:
         Returns value associated with key, returns None if key 
         is not associated with any value in the trie. 
         """
-        if self.root.mid is None:  # trie is empty 
+        node = self.get_node(key)
+        if node is None:
+            return None
+        return node.val
+
+    def get_node(self, key):
+        """
+        Returns the node holding the last character of key, or None if 
+        the trie has no such node. 
+        """
+        node = self.root.mid
+        if node is None or len(key) == 0:  # trie is empty 
             return None
         index = 0
-        return self.get_recursive(self.root.mid, key, index)
+        last = len(key) - 1
+        c = key[0]
+        while node is not None:
+            if c < node.c:
+                node = node.left
+            elif c > node.c:
+                node = node.right
+            elif index < last:
+                index += 1
+                c = key[index]
+                node = node.mid
+            else:
+                return node
+        return None  # key is not in tree
     
     def get_recursive(self, node, key, index):
         if node is None:  # key is not in tree
@@ -82,8 +155,58 @@ class TST:
         """
         Deletes the given key from a trie. 
         """
+        if len(key) == 0:
+            return
+        # walk down, remembering the nodes on the path and which link 
+        # (0 left, 1 mid, 2 right) was followed out of each of them
+        path = []
+        links = []
         index = 0
-        self.root.mid = self.delete_recursive(self.root.mid, key, index)
+        last = len(key) - 1
+        c = key[0]
+        node = self.root.mid
+        while node is not None:
+            path.append(node)
+            if c < node.c:
+                links.append(0)
+                node = node.left
+            elif c > node.c:
+                links.append(2)
+                node = node.right
+            elif index < last:
+                links.append(1)
+                index += 1
+                c = key[index]
+                node = node.mid
+            else:
+                node.val = None
+                break
+
+        self.root.mid = self.relink(path, links)
+
+    def relink(self, path, links):
+        """
+        Walks back up a path recorded by delete, relinking and pruning 
+        exactly as delete_recursive does when its calls return. Returns 
+        the node that takes the place of path[0]. 
+        """
+        child = None
+        if len(links) < len(path):
+            links.append(None)  # key was found, no link below the last node
+        for node, link in zip(reversed(path), reversed(links)):
+            if link == 1:
+                node.mid = child
+            elif link == 0:
+                node.left = child
+            elif link == 2:
+                node.right = child
+            child = node
+            if node.val is None and node.mid is None:
+                if node.left is None:
+                    child = node.right
+                elif node.right is None:
+                    child = node.left
+        return child
     
     def delete_recursive(self, node, key, index):
         if node is None:  # key is not in tree
@@ -109,18 +232,1325 @@ class TST:
 
         return node
 
+    # ------------------------------------------------------
+    # Batched access
+    # ------------------------------------------------------
+    # Both methods walk the batch in sorted (or balanced) order and keep 
+    # path, the nodes matching each character of the previous key, so a 
+    # key only has to be walked from where it leaves the previous key. 
+
+    def get_many(self, keys):
+        """
+        Returns the values of keys as a list in input order, with None for 
+        keys that are not in the trie. 
+        """
+        results = [None] * len(keys)
+        root = self.root
+        path = []
+        push = path.append
+        prev = ''
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[i]
+            if len(key) == 0:
+                continue
+            # common prefix with the previous key, within the walked path
+            limit = min(len(path), len(key))
+            lcp = 0
+            while lcp < limit and prev[lcp] == key[lcp]:
+                lcp += 1
+            prev = key
+            if lcp == len(key):
+                results[i] = path[lcp - 1].val
+                continue
+            del path[lcp:]
+            node = path[-1].mid if lcp else root.mid
+            index = lcp
+            last = len(key) - 1
+            c = key[index]
+            while node is not None:
+                if c < node.c:
+                    node = node.left
+                elif c > node.c:
+                    node = node.right
+                else:
+                    push(node)
+                    if index == last:
+                        results[i] = node.val
+                        break
+                    index += 1
+                    c = key[index]
+                    node = node.mid
+        return results
+
+    def put_many(self, items, presorted=False):
+        """
+        Inserts (key, value) pairs. The result is the same as calling put on 
+        each pair in turn, but the pairs are inserted in balanced_order, so 
+        left/right links of new nodes stay balanced. 
+        """
+        path = []
+        push = path.append
+        prev = ''
+        for key, val in balanced_order(items, presorted):
+            assert(isinstance(key, str))
+            if len(key) == 0:
+                continue
+            # common prefix with the previous key, within the walked path
+            limit = min(len(path), len(key))
+            lcp = 0
+            while lcp < limit and prev[lcp] == key[lcp]:
+                lcp += 1
+            prev = key
+            if lcp == len(key):
+                path[lcp - 1].val = val
+                continue
+            del path[lcp:]
+            parent = path[-1] if lcp else self.root
+            index = lcp
+            last = len(key) - 1
+            c = key[index]
+            node = parent.mid
+            if node is None:
+                node = parent.mid = Node(c)
+            while True:
+                if c < node.c:
+                    if node.left is None:
+                        node.left = Node(c)
+                    node = node.left
+                elif c > node.c:
+                    if node.right is None:
+                        node.right = Node(c)
+                    node = node.right
+                else:
+                    push(node)
+                    if index == last:
+                        node.val = val
+                        break
+                    index += 1
+                    c = key[index]
+                    if node.mid is None:
+                        node.mid = Node(c)
+                    node = node.mid
+
+    # ------------------------------------------------------
+    # Bulk loading and rebalancing
+    # ------------------------------------------------------
+    @classmethod
+    def from_items(cls, items, presorted=False):
+        """
+        Builds a trie from (key, value) pairs with put_many, so that the 
+        left/right links at every level form a balanced binary tree. Pass 
+        presorted=True if items is already sorted by key to skip the sort. 
+        """
+        tst = cls()
+        tst.put_many(items, presorted)
+        return tst
+
+    def rebalance(self):
+        """
+        Rebuilds the trie in balanced form, e.g. after many deletions. 
+        """
+        self.root = TST.from_items(self.items(), presorted=True).root
+
+    # ------------------------------------------------------
+    # Ordered iteration and queries
+    # ------------------------------------------------------
+    # All queries are generators that walk the trie in sorted key order 
+    # and only enter subtries that can still produce a result. limit caps 
+    # the number of keys produced (None for no cap). 
+
+    def items(self):
+        """
+        Yields (key, value) pairs in sorted key order. 
+        """
+        return self.collect(self.root.mid, '')
+
+    def keys(self):
+        """
+        Yields keys in sorted order. 
+        """
+        for key, _ in self.items():
+            yield key
+
+    def __iter__(self):
+        return self.keys()
+
+    def collect(self, node, prefix):
+        """
+        Yields (key, value) pairs stored in the subtrie rooted at node, with 
+        prefix prepended to every key. 
+        """
+        chars = list(prefix)
+        # stack entries are (node, depth, visit). A node is first expanded 
+        # into its left subtrie, itself and its right subtrie, and visited 
+        # (key emitted, mid subtrie pushed) when it comes off the stack again.
+        stack = [] if node is None else [(node, len(chars), False)]
+        while stack:
+            node, depth, visit = stack.pop()
+            if visit:
+                del chars[depth:]
+                chars.append(node.c)
+                if node.val is not None:
+                    yield ''.join(chars), node.val
+                if node.mid is not None:
+                    stack.append((node.mid, depth + 1, False))
+            else:
+                if node.right is not None:
+                    stack.append((node.right, depth, False))
+                stack.append((node, depth, True))
+                if node.left is not None:
+                    stack.append((node.left, depth, False))
+
+    def keys_with_prefix(self, prefix, limit=None):
+        """
+        Yields keys that start with prefix. 
+        """
+        if limit == 0:
+            return
+        if len(prefix) == 0:
+            pairs = self.collect(self.root.mid, '')
+        else:
+            node = self.get_node(prefix)
+            if node is None:
+                return
+            pairs = self.collect(node.mid, prefix)
+            if node.val is not None:
+                pairs = chain([(prefix, node.val)], pairs)
+        for key, _ in islice(pairs, limit):
+            yield key
+
+    def keys_that_match(self, pattern, limit=None):
+        """
+        Yields keys of the same length as pattern that match it, where 
+        '.' in pattern matches any character. 
+        """
+        node = self.root.mid
+        if len(pattern) == 0 or node is None or limit == 0:
+            return
+        last = len(pattern) - 1
+        found = 0
+        chars = []
+        stack = [(node, 0, False)]
+        while stack:
+            node, index, visit = stack.pop()
+            if visit:
+                del chars[index:]
+                chars.append(node.c)
+                if index == last:
+                    if node.val is not None:
+                        yield ''.join(chars)
+                        found += 1
+                        if found == limit:
+                            return
+                elif node.mid is not None:
+                    stack.append((node.mid, index + 1, False))
+            else:
+                c = pattern[index]
+                wild = c == '.'
+                if node.right is not None and (wild or c > node.c):
+                    stack.append((node.right, index, False))
+                if wild or c == node.c:
+                    stack.append((node, index, True))
+                if node.left is not None and (wild or c < node.c):
+                    stack.append((node.left, index, False))
+
+    def longest_prefix_of(self, s):
+        """
+        Returns the longest key that is a prefix of s, or None if no key 
+        is a prefix of s. 
+        """
+        node = self.root.mid
+        index = 0
+        length = 0
+        while node is not None and index < len(s):
+            c = s[index]
+            if c < node.c:
+                node = node.left
+            elif c > node.c:
+                node = node.right
+            else:
+                index += 1
+                if node.val is not None:
+                    length = index
+                node = node.mid
+        if length == 0:
+            return None
+        return s[:length]
+
+    def keys_within_hamming(self, s, d, limit=None):
+        """
+        Yields keys of the same length as s that differ from s in at most 
+        d positions. 
+        """
+        node = self.root.mid
+        if len(s) == 0 or node is None or limit == 0:
+            return
+        last = len(s) - 1
+        found = 0
+        chars = []
+        # entries are (node, index, mismatches so far, visit)
+        stack = [(node, 0, 0, False)]
+        while stack:
+            node, index, miss, visit = stack.pop()
+            c = s[index]
+            if visit:
+                del chars[index:]
+                chars.append(node.c)
+                if node.c != c:
+                    miss += 1
+                if index == last:
+                    if node.val is not None:
+                        yield ''.join(chars)
+                        found += 1
+                        if found == limit:
+                            return
+                elif node.mid is not None:
+                    stack.append((node.mid, index + 1, miss, False))
+            else:
+                # with no mismatches left only the exact branch can match
+                spare = miss < d
+                if node.right is not None and (spare or c > node.c):
+                    stack.append((node.right, index, miss, False))
+                if spare or c == node.c:
+                    stack.append((node, index, miss, True))
+                if node.left is not None and (spare or c < node.c):
+                    stack.append((node.left, index, miss, False))
+
+    def keys_within_distance(self, s, d, limit=None):
+        """
+        Yields keys whose edit (Levenshtein) distance from s is at most d. 
+        """
+        node = self.root.mid
+        if node is None or limit == 0:
+            return
+        n = len(s)
+        found = 0
+        chars = []
+        # entries are (node, depth, row, visit), where row holds the edit 
+        # distances between the depth characters above node and each 
+        # prefix of s. A subtrie is skipped once every entry of its row 
+        # exceeds d. 
+        stack = [(node, 0, list(range(n + 1)), False)]
+        while stack:
+            node, depth, row, visit = stack.pop()
+            if visit:
+                del chars[depth:]
+                chars.append(node.c)
+                c = node.c
+                new_row = [row[0] + 1]
+                for j in range(1, n + 1):
+                    new_row.append(min(new_row[j - 1] + 1, row[j] + 1,
+                                       row[j - 1] + (s[j - 1] != c)))
+                if node.val is not None and new_row[n] <= d:
+                    yield ''.join(chars)
+                    found += 1
+                    if found == limit:
+                        return
+                if node.mid is not None and min(new_row) <= d:
+                    stack.append((node.mid, depth + 1, new_row, False))
+            else:
+                if node.right is not None:
+                    stack.append((node.right, depth, row, False))
+                stack.append((node, depth, row, True))
+                if node.left is not None:
+                    stack.append((node.left, depth, row, False))
+
+
+class ConcurrentTST(TST):
+    """
+    TST that can be shared between threads: any number of readers and 
+    writers may use it at once. 
+
+    Writers never modify a node that is reachable from self.root. put, 
+    put_many, delete and rebalance copy the nodes on the paths they change 
+    (copy-on-write), link the copies under a new root node and then swap 
+    self.root in a single assignment. Readers take no lock: every read 
+    method of TST reads self.root once and so works on a consistent 
+    snapshot for its whole walk, even while writers replace the root. 
+    Writers are serialized by self.lock. 
+    """
+
+    def __init__(self):
+        TST.__init__(self)
+        self.lock = threading.Lock()
+
+    def copy(self, node, fresh):
+        """
+        Returns a private copy of node (a new node if node is None) that 
+        the current write may modify. fresh holds the ids of nodes already 
+        copied by this write, which are returned as they are. 
+        """
+        if node is not None and id(node) in fresh:
+            return node
+        new = Node()
+        if node is not None:
+            new.c, new.val = node.c, node.val
+            new.left, new.mid, new.right = node.left, node.mid, node.right
+        fresh.add(id(new))
+        return new
+
+    def put_copy(self, root, key, val, fresh):
+        """
+        Inserts key under root, a private copy, copying every node on the 
+        path to key. 
+        """
+        index = 0
+        last = len(key) - 1
+        c = key[0]
+        node = root.mid = self.copy(root.mid, fresh)
+        if node.c is None:
+            node.c = c
+        while True:
+            if c < node.c:
+                node.left = self.copy(node.left, fresh)
+                node = node.left
+            elif c > node.c:
+                node.right = self.copy(node.right, fresh)
+                node = node.right
+            elif index < last:
+                index += 1
+                c = key[index]
+                node.mid = self.copy(node.mid, fresh)
+                node = node.mid
+            else:
+                node.val = val
+                return
+            if node.c is None:
+                node.c = c
+
+    def put(self, key, val):
+        """
+        Inserts key into trie and associates key with value. 
+        """
+        assert(isinstance(key, str))
+        if len(key) == 0:
+            return
+        with self.lock:
+            fresh = set()
+            root = self.copy(self.root, fresh)
+            self.put_copy(root, key, val, fresh)
+            self.root = root
+
+    def put_many(self, items, presorted=False):
+        """
+        Inserts (key, value) pairs in balanced_order. Readers see either 
+        none or all of the batch. 
+        """
+        with self.lock:
+            fresh = set()
+            root = self.copy(self.root, fresh)
+            for key, val in balanced_order(items, presorted):
+                assert(isinstance(key, str))
+                if len(key) > 0:
+                    self.put_copy(root, key, val, fresh)
+            self.root = root
+
+    def delete(self, key):
+        """
+        Deletes the given key from a trie. 
+        """
+        if len(key) == 0:
+            return
+        with self.lock:
+            fresh = set()
+            root = self.copy(self.root, fresh)
+            path = []
+            links = []
+            index = 0
+            last = len(key) - 1
+            c = key[0]
+            node = root.mid
+            if node is not None:
+                node = self.copy(node, fresh)
+            while node is not None:
+                path.append(node)
+                if c < node.c:
+                    links.append(0)
+                    node = node.left
+                elif c > node.c:
+                    links.append(2)
+                    node = node.right
+                elif index < last:
+                    links.append(1)
+                    index += 1
+                    c = key[index]
+                    node = node.mid
+                else:
+                    node.val = None
+                    break
+                if node is not None:
+                    node = self.copy(node, fresh)
+            root.mid = self.relink(path, links)
+            self.root = root
+
+    def rebalance(self):
+        """
+        Rebuilds the trie in balanced form, e.g. after many deletions. 
+        """
+        with self.lock:
+            self.root = TST.from_items(self.items(), presorted=True).root
+
+
+class FlatTST:
+    """
+    Read-only side of a ternary-search-trie whose nodes are kept in flat 
+    parallel sequences and referred to by integer index instead of being 
+    separate objects. Subclasses provide c (character code points), val, 
+    left, mid and right, all indexed by node. 
+
+    Index 0 plays the part of TST.root, so a link equal to 0 means there 
+    is no node. 
+    """
+
+    # ------------------------------------------------------
+    # Retrieving from trie
+    # ------------------------------------------------------
+    def get(self, key):
+        """
+        Returns value associated with key, returns None if key 
+        is not associated with any value in the trie. 
+        """
+        return self.val[self.get_node(key)]
+
+    def get_node(self, key):
+        """
+        Returns index of the node holding the last character of key, or 0 
+        if the trie has no such node. 
+        """
+        chars, left, mid, right = self.c, self.left, self.mid, self.right
+        node = mid[0]
+        if node == 0 or len(key) == 0:  # trie is empty 
+            return 0
+        index = 0
+        last = len(key) - 1
+        c = ord(key[0])
+        while node != 0:
+            if c < chars[node]:
+                node = left[node]
+            elif c > chars[node]:
+                node = right[node]
+            elif index < last:
+                index += 1
+                c = ord(key[index])
+                node = mid[node]
+            else:
+                return node
+        return 0  # key is not in tree
+
+    def get_recursive(self, node, key, index):
+        if node == 0:  # key is not in tree
+            return None
+        c = ord(key[index])
+        if c < self.c[node]:
+            return self.get_recursive(self.left[node], key, index)
+        elif c > self.c[node]:
+            return self.get_recursive(self.right[node], key, index)
+        elif index < len(key) - 1:
+            return self.get_recursive(self.mid[node], key, index+1)
+        else:
+            return self.val[node]
+
+    # ------------------------------------------------------
+    # Batched access
+    # ------------------------------------------------------
+    # Same approach as TST.get_many. 
+
+    def get_many(self, keys):
+        """
+        Returns the values of keys as a list in input order, with None for 
+        keys that are not in the trie. 
+        """
+        codes, left, mid, right, vals = self.c, self.left, self.mid, self.right, self.val
+        results = [None] * len(keys)
+        path = []
+        push = path.append
+        prev = ''
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[i]
+            if len(key) == 0:
+                continue
+            # common prefix with the previous key, within the walked path
+            limit = min(len(path), len(key))
+            lcp = 0
+            while lcp < limit and prev[lcp] == key[lcp]:
+                lcp += 1
+            prev = key
+            if lcp == len(key):
+                results[i] = vals[path[lcp - 1]]
+                continue
+            del path[lcp:]
+            node = mid[path[-1] if lcp else 0]
+            index = lcp
+            last = len(key) - 1
+            c = ord(key[index])
+            while node != 0:
+                if c < codes[node]:
+                    node = left[node]
+                elif c > codes[node]:
+                    node = right[node]
+                else:
+                    push(node)
+                    if index == last:
+                        results[i] = vals[node]
+                        break
+                    index += 1
+                    c = ord(key[index])
+                    node = mid[node]
+        return results
+
+    # ------------------------------------------------------
+    # Ordered iteration and queries
+    # ------------------------------------------------------
+    # Same queries as TST, see the notes there. 
+
+    def items(self):
+        """
+        Yields (key, value) pairs in sorted key order. 
+        """
+        return self.collect(self.mid[0], '')
+
+    def keys(self):
+        """
+        Yields keys in sorted order. 
+        """
+        for key, _ in self.items():
+            yield key
+
+    def __iter__(self):
+        return self.keys()
+
+    def collect(self, node, prefix):
+        """
+        Yields (key, value) pairs stored in the subtrie rooted at node, with 
+        prefix prepended to every key. 
+        """
+        codes, left, mid, right, vals = self.c, self.left, self.mid, self.right, self.val
+        chars = list(prefix)
+        stack = [] if node == 0 else [(node, len(chars), False)]
+        while stack:
+            node, depth, visit = stack.pop()
+            if visit:
+                del chars[depth:]
+                chars.append(chr(codes[node]))
+                if vals[node] is not None:
+                    yield ''.join(chars), vals[node]
+                if mid[node] != 0:
+                    stack.append((mid[node], depth + 1, False))
+            else:
+                if right[node] != 0:
+                    stack.append((right[node], depth, False))
+                stack.append((node, depth, True))
+                if left[node] != 0:
+                    stack.append((left[node], depth, False))
+
+    def keys_with_prefix(self, prefix, limit=None):
+        """
+        Yields keys that start with prefix. 
+        """
+        if limit == 0:
+            return
+        if len(prefix) == 0:
+            pairs = self.collect(self.mid[0], '')
+        else:
+            node = self.get_node(prefix)
+            if node == 0:
+                return
+            pairs = self.collect(self.mid[node], prefix)
+            if self.val[node] is not None:
+                pairs = chain([(prefix, self.val[node])], pairs)
+        for key, _ in islice(pairs, limit):
+            yield key
+
+    def keys_that_match(self, pattern, limit=None):
+        """
+        Yields keys of the same length as pattern that match it, where 
+        '.' in pattern matches any character. 
+        """
+        codes, left, mid, right, vals = self.c, self.left, self.mid, self.right, self.val
+        node = mid[0]
+        if len(pattern) == 0 or node == 0 or limit == 0:
+            return
+        pattern = [-1 if ch == '.' else ord(ch) for ch in pattern]
+        last = len(pattern) - 1
+        found = 0
+        chars = []
+        stack = [(node, 0, False)]
+        while stack:
+            node, index, visit = stack.pop()
+            if visit:
+                del chars[index:]
+                chars.append(chr(codes[node]))
+                if index == last:
+                    if vals[node] is not None:
+                        yield ''.join(chars)
+                        found += 1
+                        if found == limit:
+                            return
+                elif mid[node] != 0:
+                    stack.append((mid[node], index + 1, False))
+            else:
+                c = pattern[index]
+                wild = c == -1
+                if right[node] != 0 and (wild or c > codes[node]):
+                    stack.append((right[node], index, False))
+                if wild or c == codes[node]:
+                    stack.append((node, index, True))
+                if left[node] != 0 and (wild or c < codes[node]):
+                    stack.append((left[node], index, False))
+
+    def longest_prefix_of(self, s):
+        """
+        Returns the longest key that is a prefix of s, or None if no key 
+        is a prefix of s. 
+        """
+        codes, left, mid, right, vals = self.c, self.left, self.mid, self.right, self.val
+        node = mid[0]
+        index = 0
+        length = 0
+        while node != 0 and index < len(s):
+            c = ord(s[index])
+            if c < codes[node]:
+                node = left[node]
+            elif c > codes[node]:
+                node = right[node]
+            else:
+                index += 1
+                if vals[node] is not None:
+                    length = index
+                node = mid[node]
+        if length == 0:
+            return None
+        return s[:length]
+
+    def keys_within_hamming(self, s, d, limit=None):
+        """
+        Yields keys of the same length as s that differ from s in at most 
+        d positions. 
+        """
+        codes, left, mid, right, vals = self.c, self.left, self.mid, self.right, self.val
+        node = mid[0]
+        if len(s) == 0 or node == 0 or limit == 0:
+            return
+        s = [ord(ch) for ch in s]
+        last = len(s) - 1
+        found = 0
+        chars = []
+        stack = [(node, 0, 0, False)]
+        while stack:
+            node, index, miss, visit = stack.pop()
+            c = s[index]
+            if visit:
+                del chars[index:]
+                chars.append(chr(codes[node]))
+                if codes[node] != c:
+                    miss += 1
+                if index == last:
+                    if vals[node] is not None:
+                        yield ''.join(chars)
+                        found += 1
+                        if found == limit:
+                            return
+                elif mid[node] != 0:
+                    stack.append((mid[node], index + 1, miss, False))
+            else:
+                spare = miss < d
+                if right[node] != 0 and (spare or c > codes[node]):
+                    stack.append((right[node], index, miss, False))
+                if spare or c == codes[node]:
+                    stack.append((node, index, miss, True))
+                if left[node] != 0 and (spare or c < codes[node]):
+                    stack.append((left[node], index, miss, False))
+
+    def keys_within_distance(self, s, d, limit=None):
+        """
+        Yields keys whose edit (Levenshtein) distance from s is at most d. 
+        """
+        codes, left, mid, right, vals = self.c, self.left, self.mid, self.right, self.val
+        node = mid[0]
+        if node == 0 or limit == 0:
+            return
+        s = [ord(ch) for ch in s]
+        n = len(s)
+        found = 0
+        chars = []
+        stack = [(node, 0, list(range(n + 1)), False)]
+        while stack:
+            node, depth, row, visit = stack.pop()
+            if visit:
+                del chars[depth:]
+                c = codes[node]
+                chars.append(chr(c))
+                new_row = [row[0] + 1]
+                for j in range(1, n + 1):
+                    new_row.append(min(new_row[j - 1] + 1, row[j] + 1,
+                                       row[j - 1] + (s[j - 1] != c)))
+                if vals[node] is not None and new_row[n] <= d:
+                    yield ''.join(chars)
+                    found += 1
+                    if found == limit:
+                        return
+                if mid[node] != 0 and min(new_row) <= d:
+                    stack.append((mid[node], depth + 1, new_row, False))
+            else:
+                if right[node] != 0:
+                    stack.append((right[node], depth, row, False))
+                stack.append((node, depth, row, True))
+                if left[node] != 0:
+                    stack.append((left[node], depth, row, False))
+
+
+class CompactTST(FlatTST):
+    """
+    Ternary-search-trie with the same interface as TST, with nodes held in 
+    arrays as described in FlatTST. Nodes pruned by delete are put on a 
+    free list and reused by later insertions. 
+    """
+
+    def __init__(self):
+        self.c = array('I', [0])
+        self.val = [None]
+        self.left = array('i', [0])
+        self.mid = array('i', [0])
+        self.right = array('i', [0])
+        self.free = []
+
+    def new_node(self, c):
+        """
+        Returns index of an empty node holding character code c, reusing 
+        a freed slot if there is one. 
+        """
+        if self.free:
+            node = self.free.pop()
+            self.c[node] = c
+            return node
+        self.c.append(c)
+        self.val.append(None)
+        self.left.append(0)
+        self.mid.append(0)
+        self.right.append(0)
+        return len(self.val) - 1
+
+    def release(self, node):
+        """
+        Clears node and puts its slot on the free list. 
+        """
+        self.val[node] = None
+        self.left[node] = self.mid[node] = self.right[node] = 0
+        self.free.append(node)
+
+    # ------------------------------------------------------
+    # Inserting into trie
+    # ------------------------------------------------------
+    def put(self, key, val):
+        """
+        Inserts key into trie and associates key with value. 
+        """
+        assert(isinstance(key, str))
+        if len(key) == 0:
+            return
+        chars, left, mid, right = self.c, self.left, self.mid, self.right
+        index = 0
+        last = len(key) - 1
+        c = ord(key[0])
+        node = mid[0]
+        if node == 0:
+            node = mid[0] = self.new_node(c)
+        while True:
+            if c < chars[node]:
+                if left[node] == 0:
+                    left[node] = self.new_node(c)
+                node = left[node]
+            elif c > chars[node]:
+                if right[node] == 0:
+                    right[node] = self.new_node(c)
+                node = right[node]
+            elif index < last:
+                index += 1
+                c = ord(key[index])
+                if mid[node] == 0:
+                    mid[node] = self.new_node(c)
+                node = mid[node]
+            else:
+                self.val[node] = val
+                return
+
+    def put_recursive(self, node, key, val, index):
+        c = ord(key[index])
+        if node == 0:
+            node = self.new_node(c)
+        if c < self.c[node]:
+            self.left[node] = self.put_recursive(self.left[node], key, val, index)
+        elif c > self.c[node]:
+            self.right[node] = self.put_recursive(self.right[node], key, val, index)
+        elif index < len(key) - 1:
+            self.mid[node] = self.put_recursive(self.mid[node], key, val, index+1)
+        else:
+            self.val[node] = val
+        return node
+
+    # ------------------------------------------------------
+    # Deleting from trie
+    # ------------------------------------------------------
+    def delete(self, key):
+        """
+        Deletes the given key from a trie. 
+        """
+        if len(key) == 0:
+            return
+        chars, left, mid, right, vals = self.c, self.left, self.mid, self.right, self.val
+        path = []
+        links = []
+        index = 0
+        last = len(key) - 1
+        c = ord(key[0])
+        node = mid[0]
+        while node != 0:
+            path.append(node)
+            if c < chars[node]:
+                links.append(left)
+                node = left[node]
+            elif c > chars[node]:
+                links.append(right)
+                node = right[node]
+            elif index < last:
+                links.append(mid)
+                index += 1
+                c = ord(key[index])
+                node = mid[node]
+            else:
+                vals[node] = None
+                break
+
+        # same relinking and pruning as TST.delete, with pruned nodes 
+        # going back on the free list
+        child = 0
+        if len(links) < len(path):
+            links.append(None)  # key was found, no link below the last node
+        for node, link in zip(reversed(path), reversed(links)):
+            if link is not None:
+                link[node] = child
+            child = node
+            if vals[node] is None and mid[node] == 0:
+                if left[node] == 0:
+                    child = right[node]
+                    self.release(node)
+                elif right[node] == 0:
+                    child = left[node]
+                    self.release(node)
+        mid[0] = child
+
+    def delete_recursive(self, node, key, index):
+        if node == 0:  # key is not in tree
+            return 0
+        c = ord(key[index])
+        if c < self.c[node]:
+            self.left[node] = self.delete_recursive(self.left[node], key, index)
+        elif c > self.c[node]:
+            self.right[node] = self.delete_recursive(self.right[node], key, index)
+        elif index < len(key) - 1:
+            self.mid[node] = self.delete_recursive(self.mid[node], key, index+1)
+        else:
+            self.val[node] = None
+
+        # same pruning rules as TST.delete_recursive, except that the pruned 
+        # node goes back on the free list. 
+        if self.val[node] is None and self.mid[node] == 0:
+            if self.left[node] == 0:
+                child = self.right[node]
+                self.release(node)
+                return child
+            elif self.right[node] == 0:
+                child = self.left[node]
+                self.release(node)
+                return child
+
+        return node
+
+    # ------------------------------------------------------
+    # Batched access
+    # ------------------------------------------------------
+    # Same approach as TST.put_many. 
+
+    def put_many(self, items, presorted=False):
+        """
+        Inserts (key, value) pairs, see TST.put_many. 
+        """
+        codes, left, mid, right = self.c, self.left, self.mid, self.right
+        path = []
+        push = path.append
+        prev = ''
+        for key, val in balanced_order(items, presorted):
+            assert(isinstance(key, str))
+            if len(key) == 0:
+                continue
+            # common prefix with the previous key, within the walked path
+            limit = min(len(path), len(key))
+            lcp = 0
+            while lcp < limit and prev[lcp] == key[lcp]:
+                lcp += 1
+            prev = key
+            if lcp == len(key):
+                self.val[path[lcp - 1]] = val
+                continue
+            del path[lcp:]
+            parent = path[-1] if lcp else 0
+            index = lcp
+            last = len(key) - 1
+            c = ord(key[index])
+            node = mid[parent]
+            if node == 0:
+                node = mid[parent] = self.new_node(c)
+            while True:
+                if c < codes[node]:
+                    if left[node] == 0:
+                        left[node] = self.new_node(c)
+                    node = left[node]
+                elif c > codes[node]:
+                    if right[node] == 0:
+                        right[node] = self.new_node(c)
+                    node = right[node]
+                else:
+                    push(node)
+                    if index == last:
+                        self.val[node] = val
+                        break
+                    index += 1
+                    c = ord(key[index])
+                    if mid[node] == 0:
+                        mid[node] = self.new_node(c)
+                    node = mid[node]
+
+    # ------------------------------------------------------
+    # Bulk loading and rebalancing
+    # ------------------------------------------------------
+    @classmethod
+    def from_items(cls, items, presorted=False):
+        """
+        Builds a trie from (key, value) pairs, see TST.from_items. 
+        """
+        tst = cls()
+        tst.put_many(items, presorted)
+        return tst
+
+    def rebalance(self):
+        """
+        Rebuilds the trie in balanced form, e.g. after many deletions. 
+        This also drops the slots on the free list. 
+        """
+        fresh = CompactTST.from_items(self.items(), presorted=True)
+        self.c, self.val = fresh.c, fresh.val
+        self.left, self.mid, self.right = fresh.left, fresh.mid, fresh.right
+        self.free = fresh.free
+
+
+class MappedTST(FlatTST):
+    """
+    Read-only ternary-search-trie opened from a file written by save. The 
+    node arrays are memoryviews over a read-only mmap of the file, so 
+    opening costs nothing up front and processes opening the same file 
+    share one copy in the page cache. Values are unpickled on access. 
+
+    Supports the read methods of FlatTST; close the trie (or use it in a 
+    with statement) to release the mapping. 
+    """
+
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            filesize = os.fstat(f.fileno()).st_size
+            if filesize < MAPPED_HEADER.size:
+                raise ValueError('{} is not a saved trie ({} bytes, shorter than '
+                                 'the header)'.format(fname, filesize))
+            magic, version, little, n, bloblen = MAPPED_HEADER.unpack(
+                f.read(MAPPED_HEADER.size))
+            if magic != MAPPED_MAGIC:
+                raise ValueError('{} is not a saved trie'.format(fname))
+            if version != MAPPED_VERSION:
+                raise ValueError('{} is a saved trie of version {}, expected '
+                                 'version {}'.format(fname, version, MAPPED_VERSION))
+            if little != (sys.byteorder == 'little'):
+                raise ValueError('{} was saved on a machine with different '
+                                 'byte order'.format(fname))
+            sizes = [count * array(typecode).itemsize 
+                     for typecode, count in mapped_layout(n)]
+            expected = MAPPED_HEADER.size
+            for size in sizes:
+                expected = align8(expected + size)
+            expected += bloblen
+            if filesize < expected:
+                raise ValueError('{} is truncated ({} bytes, expected {})'.format(
+                                 fname, filesize, expected))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mm)
+
+        offset = MAPPED_HEADER.size
+        views = []
+        for (typecode, count), size in zip(mapped_layout(n), sizes):
+            views.append(buf[offset:offset + size].cast(typecode))
+            offset = align8(offset + size)
+        self.c, self.left, self.mid, self.right, offsets = views
+        blob = buf[offset:offset + bloblen]
+        self.val = MappedValues(offsets, blob)
+        self.views = [buf, blob] + views
+
+    def close(self):
+        """
+        Releases the node arrays and unmaps the file. 
+        """
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MappedValues:
+    """
+    Sequence of node values of a MappedTST. Value i is the pickle stored 
+    between offsets[i] and offsets[i+1] of blob; nodes without a value 
+    have an empty range and read as None. 
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, node):
+        start, end = self.offsets[node], self.offsets[node + 1]
+        if start == end:
+            return None
+        return pickle.loads(self.blob[start:end])
+
+
+if ctst is not None:
+
+    class FastTST(ctst.TST):
+        """
+        Drop-in replacement for TST backed by the C trie in ctst.c. put, get, 
+        delete, items(prefix, limit) and longest_prefix_of run in C, and 
+        items stops walking the trie after limit keys; the rest of the 
+        TST interface is built on them here. keys_that_match and the 
+        neighbour searches filter the result of items(prefix) instead of 
+        pruning node by node, so they cost time in the number of keys sharing 
+        the literal prefix of the query. 
+
+        FastTST is plain TST when the extension is not built. 
+        """
+
+        def __iter__(self):
+            return self.keys()
+
+        def keys(self):
+            for key, _ in self.items():
+                yield key
+
+        def get_many(self, keys):
+            get = self.get
+            return [get(key) for key in keys]
+
+        def put_many(self, items, presorted=False):
+            put = self.put
+            for key, val in balanced_order(items, presorted):
+                put(key, val)
+
+        @classmethod
+        def from_items(cls, items, presorted=False):
+            tst = cls()
+            tst.put_many(items, presorted)
+            return tst
+
+        def rebalance(self):
+            items = self.items()
+            self.clear()
+            self.put_many(items, presorted=True)
+
+        def keys_with_prefix(self, prefix, limit=None):
+            for key, _ in self.items(prefix, limit):
+                yield key
+
+        def keys_that_match(self, pattern, limit=None):
+            prefix = pattern.split('.', 1)[0]
+            keys = (key for key, _ in self.items(prefix) if len(key) == len(pattern) 
+                    and all(b == '.' or a == b for a, b in zip(key, pattern)))
+            return islice(keys, limit)
+
+        def keys_within_hamming(self, s, d, limit=None):
+            keys = (key for key, _ in self.items() if len(key) == len(s) 
+                    and sum(a != b for a, b in zip(key, s)) <= d)
+            return islice(keys, limit)
+
+        def keys_within_distance(self, s, d, limit=None):
+            keys = (key for key, _ in self.items() 
+                    if abs(len(key) - len(s)) <= d and edit_distance(key, s) <= d)
+            return islice(keys, limit)
+
+else:
+    FastTST = TST
+
+
+# ----------------------------------------------------------
+# helper functions
+# ----------------------------------------------------------
+
+def balanced_order(items, presorted=False):
+    """
+    Returns the (key, value) pairs of items as a list ordered so that putting 
+    them into an empty trie one after another yields balanced left/right 
+    links at every level. If a key repeats, the last value wins, as with 
+    repeated put calls. 
+
+    Keys sharing the first d characters form a contiguous run of the sorted 
+    list. For such a run the character at position d of its median key is 
+    placed first, by emitting the group of keys with that character before 
+    the groups on either side of it; the same is then done within each group 
+    and side. 
+    """
+    if presorted:
+        pairs = []
+        for key, val in items:
+            if pairs and pairs[-1][0] == key:
+                pairs[-1] = (key, val)
+            else:
+                pairs.append((key, val))
+    else:
+        pairs = sorted(dict(items).items())
+
+    order = []
+    stack = [(0, len(pairs), 0)] if pairs else []
+    while stack:
+        lo, hi, d = stack.pop()
+        # a key of length d ends on the node above this level, and sorts 
+        # first in the run
+        if len(pairs[lo][0]) == d:
+            order.append(pairs[lo])
+            lo += 1
+        if hi - lo <= 1:
+            if hi > lo:
+                order.append(pairs[lo])
+            continue
+        median = (lo + hi) // 2
+        glo, ghi = char_bounds(pairs, lo, hi, d, median)
+        if ghi < hi:
+            stack.append((ghi, hi, d))
+        if lo < glo:
+            stack.append((lo, glo, d))
+        stack.append((glo, ghi, d + 1))  # popped first
+    return order
+
+
+def char_bounds(pairs, lo, hi, d, i):
+    """
+    Returns the range [glo, ghi) of pairs[lo:hi] whose keys have the same 
+    character at position d as the key of pairs[i]. All keys in the range 
+    are assumed sorted and longer than d. 
+    """
+    c = pairs[i][0][d]
+    a, b = lo, i
+    while a < b:
+        m = (a + b) // 2
+        if pairs[m][0][d] < c:
+            a = m + 1
+        else:
+            b = m
+    glo = a
+    a, b = i + 1, hi
+    while a < b:
+        m = (a + b) // 2
+        if pairs[m][0][d] > c:
+            b = m
+        else:
+            a = m + 1
+    return glo, a
+
+
+def edit_distance(s, t):
+    """
+    Returns the edit (Levenshtein) distance between strings s and t. 
+    """
+    row = list(range(len(t) + 1))
+    for i, a in enumerate(s, 1):
+        new_row = [i]
+        for j, b in enumerate(t, 1):
+            new_row.append(min(new_row[j - 1] + 1, row[j] + 1, row[j - 1] + (a != b)))
+        row = new_row
+    return row[-1]
+
+
+# ----------------------------------------------------------
+# on-disk format
+# ----------------------------------------------------------
+# A saved trie is a header followed by the node arrays of a freshly built 
+# CompactTST, in native byte order, each starting on an 8 byte boundary: 
+#   c, left, mid, right   n 4-byte integers each
+#   offsets               n+1 8-byte integers into the value blob
+#   blob                  the pickled node values, back to back
+
+MAPPED_MAGIC = b'TSTM'
+MAPPED_VERSION = 1
+MAPPED_HEADER = struct.Struct('<4sHHQQ')  # magic, version, little endian, n, blob size
+
+
+def mapped_layout(n):
+    """
+    Returns the (typecode, count) of each node array in a saved trie of 
+    n nodes, in file order. 
+    """
+    return [('I', n), ('i', n), ('i', n), ('i', n), ('q', n + 1)]
+
+
+def align8(offset):
+    return (offset + 7) & ~7
+
+
+def save(tst, fname):
+    """
+    Writes any trie (TST, CompactTST, ...) to fname in the format read by 
+    MappedTST. The nodes are rebuilt with CompactTST.from_items first, so 
+    the saved trie is balanced and has no unused slots. 
+    """
+    flat = CompactTST.from_items(tst.items(), presorted=True)
+    n = len(flat.val)
+    offsets = array('q', [0])
+    pickles = []
+    size = 0
+    for val in flat.val:
+        if val is not None:
+            data = pickle.dumps(val, protocol=pickle.HIGHEST_PROTOCOL)
+            pickles.append(data)
+            size += len(data)
+        offsets.append(size)
+
+    with open(fname, 'wb') as out:
+        out.write(MAPPED_HEADER.pack(MAPPED_MAGIC, MAPPED_VERSION, 
+                                     sys.byteorder == 'little', n, size))
+        for arr in (flat.c, flat.left, flat.mid, flat.right, offsets):
+            out.write(arr.tobytes())
+            out.write(bytes(align8(out.tell()) - out.tell()))
+        for data in pickles:
+            out.write(data)
+
 
 # ----------------------------------------------------------
 # test functions
 # ----------------------------------------------------------
 
-def testTST(ntrials=1000, Llim=100):
+def testTST(ntrials=1000, Llim=100, cls=None):
     """
     Performs ntrials random operations in parallel in python dictionary and
     TST, in order to ensure that TST is implemented properly.
 
-    Keys are no longer than Llim. 
+    Keys are no longer than Llim. cls selects the trie class under test 
+    (TST by default). 
     """
+    if cls is None:
+        cls = TST
     A = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!@#$%^&*()-_=+<>?:\"';"
 
     arrkeys = list()
@@ -128,7 +1558,7 @@ def testTST(ntrials=1000, Llim=100):
     delkeys = set()
 
     test_d = {}
-    tst = TST()
+    tst = cls()
 
     # a key is deleted with probability 10%
     for j in range(ntrials):
@@ -159,8 +1589,537 @@ def testTST(ntrials=1000, Llim=100):
         print(s, test_d[s], tst.get(s), s in delkeys)
         assert(test_d[s] == tst.get(s))
 
+    # a trie bulk loaded with from_items, one loaded with put_many (repeated 
+    # keys included, the last value wins) and the rebalanced trie must 
+    # answer exactly as the incrementally built one did
+    items = sorted(test_d.items())
+    probes = list(test_d) + list(delkeys)
+    prefixes = [s[:2] for s in probes[::10]]
+    expected = (items, [test_d.get(s) for s in probes], 
+                [list(tst.keys_with_prefix(p)) for p in prefixes])
+    batch = [(s, None) for s, _ in items] + random.sample(items, len(items))
+    loaded = [cls.from_items(test_d.items()), cls.from_items(items, presorted=True), cls()]
+    loaded[-1].put_many(batch)
+    tst.rebalance()
+    for t in loaded + [tst]:
+        assert(list(t.items()) == items)
+        assert(t.get_many(probes) == expected[1])
+        assert([t.get(s) for s in probes] == expected[1])
+        assert([list(t.keys_with_prefix(p)) for p in prefixes] == expected[2])
+
     print("all tests passed!", len(delkeys))
-            
+
+
+def testQueries(ntrials=200, nkeys=300, Llim=6, cls=None):
+    """
+    Checks the prefix, wildcard and neighbour queries of a trie against a 
+    brute-force scan over the same keys held in a python dictionary. 
+    """
+    if cls is None:
+        cls = TST
+    A = "ACGT"
+
+    def hamming(s, t):
+        return sum(a != b for a, b in zip(s, t))
+
+    test_d = {}
+    tst = cls()
+    for i in range(nkeys):
+        s = random_string(random.randint(1, Llim), A)
+        tst.put(s, i)
+        test_d[s] = i
+    for s in random.sample(sorted(test_d), nkeys // 10):
+        tst.delete(s)
+        del test_d[s]
+    keys = sorted(test_d)
+    assert(list(tst.keys()) == keys)
+    assert(list(tst.items()) == [(s, test_d[s]) for s in keys])
+
+    for j in range(ntrials):
+        q = random_string(random.randint(0, Llim), A)
+        d = random.randint(0, 2)
+        limit = random.choice([None, 1, 3])
+        expected = [s for s in keys if s.startswith(q)]
+        assert(list(tst.keys_with_prefix(q)) == expected)
+        assert(list(tst.keys_with_prefix(q, limit=limit)) == expected[:limit])
+
+        p = ''.join(ch if random.random() < 0.7 else '.' for ch in q)
+        expected = [s for s in keys if len(s) == len(p) and
+                    all(a == b or b == '.' for a, b in zip(s, p))]
+        assert(list(tst.keys_that_match(p, limit=limit)) == expected[:limit])
+
+        prefixes = [s for s in keys if q.startswith(s)]
+        assert(tst.longest_prefix_of(q) == (max(prefixes, key=len) if prefixes else None))
+
+        expected = [s for s in keys if len(s) == len(q) and hamming(s, q) <= d]
+        assert(list(tst.keys_within_hamming(q, d, limit=limit)) == expected[:limit])
+
+        expected = [s for s in keys if edit_distance(s, q) <= d]
+        assert(list(tst.keys_within_distance(q, d, limit=limit)) == expected[:limit])
+
+    print("all query tests passed!", len(keys))
+
+
+def testMapped(nkeys=2000, Llim=20):
+    """
+    Saves a trie holding random keys and values of mixed types, opens it 
+    as a MappedTST, and checks lookups and queries against the original. 
+    Damaged copies of the file must be refused with a ValueError. 
+    """
+    A = "ACGTacgt"
+    tst = CompactTST()
+    for i in range(nkeys):
+        s = random_string(random.randint(1, Llim), A)
+        tst.put(s, random.choice([i, str(i), (i, [i]), {'i': i}]))
+    for s in random.sample(sorted(tst.keys()), nkeys // 10):
+        tst.delete(s)
+
+    fd, fname = tempfile.mkstemp(suffix='.tst')
+    os.close(fd)
+    try:
+        save(tst, fname)
+        with MappedTST(fname) as mapped:
+            assert(list(mapped.items()) == list(tst.items()))
+            probes = list(tst.keys()) + [random_string(random.randint(1, Llim), A) 
+                                         for _ in range(nkeys)]
+            assert(mapped.get_many(probes) == [tst.get(s) for s in probes])
+            for s in probes[::10]:
+                assert(mapped.get(s) == tst.get(s))
+                assert(list(mapped.keys_with_prefix(s[:3])) == list(tst.keys_with_prefix(s[:3])))
+                assert(list(mapped.keys_within_distance(s, 1)) == list(tst.keys_within_distance(s, 1)))
+                assert(mapped.longest_prefix_of(s) == tst.longest_prefix_of(s))
+
+        # empty, truncated, foreign and newer files are refused up front
+        with open(fname, 'rb') as f:
+            data = f.read()
+        header = bytearray(data[:MAPPED_HEADER.size])
+        struct.pack_into('<H', header, 4, MAPPED_VERSION + 1)
+        for bad in (b'', data[:MAPPED_HEADER.size - 1], data[:MAPPED_HEADER.size], 
+                    data[:-1], b'XXXX' + data[4:], bytes(header) + data[MAPPED_HEADER.size:]):
+            with open(fname, 'wb') as f:
+                f.write(bad)
+            try:
+                MappedTST(fname).close()
+            except ValueError:
+                pass
+            else:
+                assert(False)
+    finally:
+        os.remove(fname)
+
+    print("all mapped tests passed!", len(probes))
+
+
+def testDifferential(ntrials=20000, Llim=30, classes=None):
+    """
+    Applies the same random sequence of put, put_many, delete, rebalance, 
+    get, get_many, prefix, wildcard and neighbour queries to several trie 
+    implementations and checks that they always agree, including on keys 
+    far longer than the recursion limit. At the end each trie must also match one bulk loaded 
+    with from_items from its items. 
+    """
+    if classes is None:
+        classes = (TST, CompactTST, FastTST)
+    A = "ABCab\u00e9\u4e2d\U0001f600"
+    tries = [cls() for cls in classes]
+    keys = []
+
+    for j in range(ntrials):
+        u = random.uniform(0, 1)
+        if u < 0.4 or not keys:
+            s = random_string(random.randint(1, Llim), A)
+            n = random.choice([j, str(j), None])
+            keys.append(s)
+            for tst in tries:
+                tst.put(s, n)
+        elif u < 0.43:
+            batch = []
+            for _ in range(random.randint(1, 5)):
+                s = random.choice(keys) if random.random() < 0.3 else \
+                    random_string(random.randint(1, Llim), A)
+                batch.append((s, random.choice([j, str(j), None])))
+            keys.extend(s for s, _ in batch)
+            for tst in tries:
+                tst.put_many(batch)
+        elif u < 0.6:
+            s = random.choice(keys)
+            for tst in tries:
+                tst.delete(s)
+        elif u < 0.603:
+            s = random.choice(keys)
+            p = ''.join(ch if random.random() < 0.7 else '.' for ch in s)
+            d = random.randint(0, 1)
+            limit = random.choice([None, 3])
+            results = [(list(tst.keys_that_match(p, limit=limit)), 
+                        list(tst.keys_within_hamming(s, d, limit=limit)), 
+                        list(tst.keys_within_distance(s, d, limit=limit))) for tst in tries]
+            assert(all(r == results[0] for r in results))
+        elif u < 0.9:
+            s = random.choice(keys)[:random.randint(0, Llim)]
+            results = [(tst.get(s), tst.longest_prefix_of(s), 
+                        list(tst.keys_with_prefix(s[:2], limit=5))) for tst in tries]
+            assert(all(r == results[0] for r in results))
+        else:
+            batch = random.sample(keys, min(len(keys), 20))
+            results = [tst.get_many(batch) for tst in tries]
+            assert(all(r == results[0] for r in results))
+        if j % (ntrials // 4 + 1) == ntrials // 8:
+            for tst in tries:
+                tst.rebalance()
+
+    long_key = 'x' * 100000
+    for tst in tries:
+        tst.put(long_key, 1)
+        assert(tst.get(long_key) == 1)
+    items = [list(tst.items()) for tst in tries]
+    assert(all(i == items[0] for i in items))
+    for tst in tries:
+        tst.delete(long_key)
+        assert(tst.get(long_key) is None)
+
+    probes = random.sample(keys, min(len(keys), 500))
+    for tst in tries:
+        loaded = type(tst).from_items(tst.items(), presorted=True)
+        assert(list(loaded.items()) == list(tst.items()))
+        assert(loaded.get_many(probes) == tst.get_many(probes))
+        for s in probes[::10]:
+            assert(list(loaded.keys_with_prefix(s[:2])) == list(tst.keys_with_prefix(s[:2])))
+
+    print("all differential tests passed!", ', '.join(cls.__name__ for cls in classes))
+
+
+def testConcurrentTST(nwriters=2, nreaders=4, ntrials=3000, Llim=12):
+    """
+    Stress test for ConcurrentTST. Writer threads apply random put, 
+    put_many and delete operations, each on its own share of the keys and 
+    its own python dictionary, while reader threads keep reading. Values 
+    are (key, n) pairs, so a reader can tell when a lookup has landed on 
+    the wrong node. Readers also check that a set of keys written up front 
+    is always visible and that items() yields a sorted, consistent view. 
+    At the end the trie must match the writers' dictionaries exactly. 
+    """
+    A = "ACGTacgt"
+    tst = ConcurrentTST()
+    stable = {}
+    for i in range(200):
+        s = '~' + random_string(random.randint(1, Llim), A)
+        stable[s] = (s, i)
+    tst.put_many(stable.items())
+
+    oracles = [{} for _ in range(nwriters)]
+    errors = []
+    done = threading.Event()
+
+    def writer(w):
+        rng = random.Random(w)
+        test_d = oracles[w]
+        prefix = str(w)
+        for j in range(ntrials):
+            u = rng.uniform(0, 1)
+            if u < 0.3 and len(test_d) > 2:
+                s = rng.choice(sorted(test_d))
+                if s[0] != '#':
+                    tst.delete(s)
+                    del test_d[s]
+            elif u < 0.4:
+                # the two ledger keys are only ever written together, so a 
+                # reader must never see them with different values
+                batch = {'#a' + prefix: ('#a' + prefix, j), '#z' + prefix: ('#z' + prefix, j)}
+                for _ in range(10):
+                    s = prefix + random_string(rng.randint(1, Llim), A)
+                    batch[s] = (s, j)
+                tst.put_many(batch.items())
+                test_d.update(batch)
+            else:
+                s = prefix + random_string(rng.randint(1, Llim), A)
+                tst.put(s, (s, j))
+                test_d[s] = (s, j)
+
+    def reader(r):
+        rng = random.Random(100 + r)
+        stable_keys = sorted(stable)
+        try:
+            j = 0
+            while not done.is_set():
+                j += 1
+                s = rng.choice(stable_keys)
+                assert(tst.get(s) == stable[s])
+                s = str(rng.randrange(nwriters)) + random_string(rng.randint(1, Llim), A)
+                val = tst.get(s)
+                assert(val is None or val[0] == s)
+                if j % 100 == 0:
+                    prev = None
+                    for key, val in tst.items():
+                        assert(val[0] == key and (prev is None or prev < key))
+                        prev = key
+                batch = rng.sample(stable_keys, 20)
+                assert(tst.get_many(batch) == [stable[s] for s in batch])
+                w = str(rng.randrange(nwriters))
+                a, z = tst.get_many(['#a' + w, '#z' + w])
+                assert((a and a[1]) == (z and z[1]))
+        except AssertionError as e:
+            errors.append(e)
+
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)  # force frequent thread switches
+    try:
+        writers = [threading.Thread(target=writer, args=(w,)) for w in range(nwriters)]
+        readers = [threading.Thread(target=reader, args=(r,)) for r in range(nreaders)]
+        for t in readers + writers:
+            t.start()
+        for t in writers:
+            t.join()
+        done.set()
+        for t in readers:
+            t.join()
+    finally:
+        sys.setswitchinterval(switch)
+
+    assert(not errors)
+    expected = dict(stable)
+    for test_d in oracles:
+        expected.update(test_d)
+    assert(sorted(expected.items()) == list(tst.items()))
+    for s in expected:
+        assert(tst.get(s) == expected[s])
+
+    print("all concurrent tests passed!", len(expected))
+
+
+# ----------------------------------------------------------
+# benchmark functions
+# ----------------------------------------------------------
+
+def benchTST(nkeys=200000, Llim=20, classes=None):
+    """
+    Inserts nkeys random keys (length 5 to Llim) into each trie class and 
+    reports memory held by the trie, put time and get time. 
+    """
+    if classes is None:
+        classes = (TST, CompactTST)
+    A = "ACGTacgt0123456789abcdefghijklmnop"
+    keys = [random_string(random.randint(5, Llim), A) for _ in range(nkeys)]
+
+    for cls in classes:
+        # memory is measured on a separate build, tracing slows down put
+        tracemalloc.start()
+        tst = cls()
+        for i, s in enumerate(keys):
+            tst.put(s, i)
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del tst
+
+        tst = cls()
+        st = time.perf_counter()
+        for i, s in enumerate(keys):
+            tst.put(s, i)
+        put_time = time.perf_counter() - st
+
+        st = time.perf_counter()
+        for s in keys:
+            tst.get(s)
+        get_time = time.perf_counter() - st
+
+        print('{:<12} memory {:8.1f} MiB   put {:6.2f} s   get {:6.2f} s'.format(
+              cls.__name__, mem / 2**20, put_time, get_time))
+        del tst
+
+
+def benchRecursion(nkeys=20000, L=100, classes=None):
+    """
+    Times put, get and delete on nkeys random keys of length L, once through 
+    the recursive helpers and once through the iterative methods. 
+    """
+    if classes is None:
+        classes = (TST, CompactTST)
+    A = "ACGTacgt0123456789abcdefghijklmnop"
+    keys = [random_string(L, A) for _ in range(nkeys)]
+
+    for cls in classes:
+        rec = cls()
+        if cls is CompactTST:
+            def rput(s, v):
+                rec.mid[0] = rec.put_recursive(rec.mid[0], s, v, 0)
+            def rget(s):
+                return rec.get_recursive(rec.mid[0], s, 0)
+            def rdelete(s):
+                rec.mid[0] = rec.delete_recursive(rec.mid[0], s, 0)
+        else:
+            def rput(s, v):
+                rec.root.mid = rec.put_recursive(rec.root.mid, s, v, 0)
+            def rget(s):
+                return rec.get_recursive(rec.root.mid, s, 0)
+            def rdelete(s):
+                rec.root.mid = rec.delete_recursive(rec.root.mid, s, 0)
+        it = cls()
+
+        for name, (put, get, delete) in (('recursive', (rput, rget, rdelete)),
+                                         ('iterative', (it.put, it.get, it.delete))):
+            times = []
+            st = time.perf_counter()
+            for i, s in enumerate(keys):
+                put(s, i)
+            times.append(time.perf_counter() - st)
+            st = time.perf_counter()
+            for s in keys:
+                get(s)
+            times.append(time.perf_counter() - st)
+            st = time.perf_counter()
+            for s in keys:
+                delete(s)
+            times.append(time.perf_counter() - st)
+            print('{:<12} {:<10} put {:6.2f} s   get {:6.2f} s   delete {:6.2f} s'.format(
+                  cls.__name__, name, *times))
+
+
+def benchBalance(nkeys=100000, Llim=12):
+    """
+    Compares the average and worst number of nodes visited per lookup for 
+    a TST built by putting sorted keys, one built with TST.from_items, and 
+    one that has had half its keys deleted, before and after rebalance. 
+    """
+    A = "ACGTacgt0123456789abcdefghijklmnop"
+    keys = sorted(set(random_string(random.randint(1, Llim), A) for _ in range(nkeys)))
+
+    def depths(tst, keys):
+        total = worst = 0
+        for key in keys:
+            node = tst.root.mid
+            index = visited = 0
+            while node is not None:
+                visited += 1
+                if key[index] < node.c:
+                    node = node.left
+                elif key[index] > node.c:
+                    node = node.right
+                elif index < len(key) - 1:
+                    index += 1
+                    node = node.mid
+                else:
+                    break
+            total += visited
+            worst = max(worst, visited)
+        return total / len(keys), worst
+
+    def report(name, tst, keys, build_time=None):
+        mean, worst = depths(tst, keys)
+        line = '{:<28} mean depth {:7.1f}   max depth {:5d}'.format(name, mean, worst)
+        if build_time is not None:
+            line += '   build {:6.2f} s'.format(build_time)
+        print(line)
+
+    st = time.perf_counter()
+    degraded = TST()
+    for i, s in enumerate(keys):
+        degraded.put(s, i)
+    report('put, sorted order', degraded, keys, time.perf_counter() - st)
+
+    shuffled = list(enumerate(keys))
+    random.shuffle(shuffled)
+    st = time.perf_counter()
+    tst = TST()
+    for i, s in shuffled:
+        tst.put(s, i)
+    report('put, random order', tst, keys, time.perf_counter() - st)
+
+    st = time.perf_counter()
+    tst = TST.from_items((s, i) for i, s in enumerate(keys))
+    report('from_items', tst, keys, time.perf_counter() - st)
+
+    # churn on the trie built from sorted keys: delete half of the keys and 
+    # put a new batch, also arriving in sorted order
+    tst = degraded
+    for s in keys[1::2]:
+        tst.delete(s)
+    fresh = sorted(set(random_string(random.randint(1, Llim), A) 
+                       for _ in range(nkeys // 2)) - set(keys))
+    for i, s in enumerate(fresh):
+        tst.put(s, i)
+    kept = sorted(keys[::2] + fresh)
+    report('after delete churn', tst, kept)
+    st = time.perf_counter()
+    tst.rebalance()
+    report('after rebalance', tst, kept, time.perf_counter() - st)
+
+
+def benchBatch(nkeys=100000, batch=5000, nbatches=20, L=16, classes=None):
+    """
+    Compares a loop of get calls with get_many on batches of lookups drawn 
+    from nkeys random keys over a small alphabet (half of them missing), 
+    and put in a loop with put_many. 
+    """
+    if classes is None:
+        classes = (TST, CompactTST)
+    A = "ACGT"
+    keys = [random_string(L, A).upper() for _ in range(nkeys)]
+    batches = [[random.choice(keys) if random.random() < 0.5 else 
+                random_string(L, A).upper() for _ in range(batch)]
+               for _ in range(nbatches)]
+    nlookups = batch * nbatches
+
+    for cls in classes:
+        st = time.perf_counter()
+        tst = cls()
+        for i, s in enumerate(keys):
+            tst.put(s, i)
+        put_time = time.perf_counter() - st
+
+        st = time.perf_counter()
+        tst = cls()
+        tst.put_many((s, i) for i, s in enumerate(keys))
+        put_many_time = time.perf_counter() - st
+
+        st = time.perf_counter()
+        looped = [[tst.get(s) for s in b] for b in batches]
+        get_time = time.perf_counter() - st
+
+        st = time.perf_counter()
+        batched = [tst.get_many(b) for b in batches]
+        get_many_time = time.perf_counter() - st
+        assert(looped == batched)
+
+        print('{:<12} put {:6.2f} s   put_many {:6.2f} s   '
+              'get {:8.0f} keys/s   get_many {:8.0f} keys/s'.format(
+              cls.__name__, put_time, put_many_time, 
+              nlookups / get_time, nlookups / get_many_time))
+
+
+def benchMapped(nkeys=200000, Llim=20):
+    """
+    Compares rebuilding a trie from its items with opening a saved copy as 
+    a MappedTST, and the get throughput of the two. 
+    """
+    A = "ACGTacgt0123456789abcdefghijklmnop"
+    items = [(random_string(random.randint(5, Llim), A), i) for i in range(nkeys)]
+    probes = [s for s, _ in random.sample(items, 50000)]
+
+    st = time.perf_counter()
+    tst = CompactTST.from_items(items)
+    build_time = time.perf_counter() - st
+
+    fd, fname = tempfile.mkstemp(suffix='.tst')
+    os.close(fd)
+    try:
+        st = time.perf_counter()
+        save(tst, fname)
+        save_time = time.perf_counter() - st
+
+        st = time.perf_counter()
+        mapped = MappedTST(fname)
+        open_time = time.perf_counter() - st
+
+        for name, trie in (('CompactTST', tst), ('MappedTST', mapped)):
+            st = time.perf_counter()
+            for s in probes:
+                trie.get(s)
+            print('{:<12} get {:8.0f} keys/s'.format(
+                  name, len(probes) / (time.perf_counter() - st)))
+        mapped.close()
+        print('build {:.2f} s   save {:.2f} s   open {:.4f} s   file {:.1f} MiB'.format(
+              build_time, save_time, open_time, os.path.getsize(fname) / 2**20))
+    finally:
+        os.remove(fname)
 
 
 def random_string(L, alphabet):
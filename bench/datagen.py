@@ -0,0 +1,98 @@
+############################################################
+# datagen.py
+# synthetic inputs for the benchmarks in run_bench.py. every
+# generator takes an rng (random.Random) so that a seed gives
+# the same data on every commit.
+############################################################
+
+import random
+
+DNA = "ACGT"
+KEY_ALPHABET = "ACGTacgt0123456789abcdefghijklmnop"
+COMPLEMENT = str.maketrans("ACGTacgt", "TGCAtgca")
+FASTA_WIDTH = 60
+
+
+def random_string(L, alphabet=DNA, rng=random):
+    return ''.join(rng.choice(alphabet) for _ in range(L))
+
+
+def random_keys(n, Llim=20, alphabet=KEY_ALPHABET, rng=random):
+    """n random keys of length 5 to Llim, as in TST.benchTST"""
+    return [random_string(rng.randint(5, Llim), alphabet, rng) for _ in range(n)]
+
+
+def mutate(s, rate, alphabet=DNA, rng=random):
+    """
+    copy of s where each character is deleted, preceded by an inserted
+    character or substituted, each with probability rate / 3.
+    """
+    out = []
+    for ch in s:
+        r = rng.random()
+        if r < rate / 3:
+            continue
+        elif r < 2 * rate / 3:
+            out.append(rng.choice(alphabet))
+        elif r < rate:
+            ch = rng.choice(alphabet)
+        out.append(ch)
+    return ''.join(out)
+
+
+def random_pair(m, n, alphabet=DNA, rng=random):
+    """two unrelated random strings of lengths m and n"""
+    return random_string(m, alphabet, rng), random_string(n, alphabet, rng)
+
+
+def near_identical_pair(m, n, rate=0.03, alphabet=DNA, rng=random):
+    """
+    a read of length about m copied, with a fraction rate of errors, from a
+    random place of a random string of length n. returns (read, string).
+    """
+    w = random_string(n, alphabet, rng)
+    start = rng.randint(0, n - m)
+    return mutate(w[start:start + m], rate, alphabet, rng), w
+
+
+def telomere_repeat(pattern, copies, rate=0.0, rng=random):
+    """
+    a run of copies of a rotation of pattern, cut at a random length, on a
+    random strand, with a fraction rate of errors.
+    """
+    shift = rng.randrange(len(pattern))
+    run = (pattern[shift:] + pattern[:shift]) * copies
+    run = run[:rng.randint(len(run) - len(pattern) + 1, len(run))]
+    if rng.random() < 0.5:
+        run = run.translate(COMPLEMENT)[::-1]
+    return mutate(run, rate, DNA, rng) if rate else run
+
+
+def synthetic_genome(fname, nrecords=20, length=100000, pattern="TTAGGG",
+                     nrepeats=10, copies=(2, 40), rate=0.01, rng=random):
+    """
+    writes a FASTA file of nrecords random records of about length bases, each
+    with nrepeats telomere-like repeats (see telomere_repeat) of copies[0]
+    to copies[1] copies of pattern planted at random places; a repeat
+    at the ends of the record stands in for a real telomere. returns
+    the number of bases written.
+    """
+    total = 0
+    with open(fname, 'w') as f:
+        for i in range(nrecords):
+            seq = list(random_string(length, DNA, rng))
+            for j in range(nrepeats):
+                run = telomere_repeat(pattern, rng.randint(*copies), rate, rng)
+                if j == 0:
+                    start = 0
+                elif j == 1:
+                    start = len(seq) - len(run)
+                else:
+                    start = rng.randint(0, len(seq) - len(run))
+                seq[start:start + len(run)] = run
+            seq = ''.join(seq)
+            f.write('>chr{} synthetic record {}\n'.format(i + 1, i + 1))
+            for k in range(0, len(seq), FASTA_WIDTH):
+                f.write(seq[k:k + FASTA_WIDTH] + '\n')
+            total += len(seq)
+    return total
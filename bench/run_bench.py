@@ -0,0 +1,277 @@
+############################################################
+# run_bench.py
+# usage: python bench/run_bench.py [-only NAME ...] [-scale X]
+#            [-repeat N] [-seed S] [-out FILE] [-compare OLD [NEW]]
+#
+# times the hot paths of TST, fitted_align and permfinder16 on
+# synthetic data (see datagen.py) and writes throughput, latency
+# percentiles and peak memory of each as JSON, by default to
+# bench/results/<commit>.json. -compare prints the change from
+# an older results file, for the new run or for a file NEW.
+############################################################
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+import datagen
+import fitted_align
+import permfinder16
+import TST
+
+PERCENTILES = (50, 90, 99)
+REGRESSION = 0.10     # -compare flags changes worse than this fraction
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-only', type=str, dest='only', nargs='+', default=None)
+    parser.add_argument('-scale', type=float, dest='scale', default=1.0)
+    parser.add_argument('-repeat', type=int, dest='repeat', default=3)
+    parser.add_argument('-seed', type=int, dest='seed', default=1)
+    parser.add_argument('-out', type=str, dest='out', default=None)
+    parser.add_argument('-compare', type=str, dest='compare', nargs='+', default=None)
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 1:
+        compare(load(args.compare[0]), load(args.compare[1]))
+        return
+    results = run(args)
+    out = args.out or os.path.join(BENCH_DIR, 'results',
+                                   '{}.json'.format(results['meta']['commit'] or 'local'))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('wrote', out)
+    if args.compare:
+        compare(load(args.compare[0]), results)
+
+
+def run(args):
+    """runs the benchmarks selected by args and returns the results with metadata"""
+    names = args.only or list(BENCHES)
+    unknown = [name for name in names if name not in BENCHES]
+    if unknown:
+        sys.exit('unknown benchmarks: {} (choose from {})'.format(
+                 ' '.join(unknown), ' '.join(BENCHES)))
+    results = {'meta': meta(args), 'results': {}}
+    print('{:<18} {:>20} {:>10} {:>10} {:>10} {:>9}'.format(
+          'bench', 'throughput', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MiB'))
+    for name in names:
+        rng = random.Random('{}:{}'.format(args.seed, name))
+        result = BENCHES[name](args.scale, args.repeat, rng)
+        results['results'][name] = result
+        print('{:<18} {:>20} {:10.3f} {:10.3f} {:10.3f} {:9.1f}'.format(
+              name, '{:.4g} {}'.format(result['throughput'], result['unit']),
+              result['p50_ms'], result['p90_ms'], result['p99_ms'], result['peak_mib']))
+    return results
+
+
+def meta(args):
+    """where and on what the benchmarks ran"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'seed': args.seed}
+
+
+# --- measuring ---
+
+def latencies(func, items, repeat=1):
+    """calls func on every item, repeat times over, and returns each call's time in seconds"""
+    times = []
+    for _ in range(repeat):
+        for item in items:
+            st = time.perf_counter()
+            func(item)
+            times.append(time.perf_counter() - st)
+    return times
+
+
+def peak_memory(func):
+    """peak memory traced by tracemalloc during func(), in MiB"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(values, q):
+    """nearest-rank percentile q of sorted values"""
+    return values[max(0, min(len(values) - 1, -(-q * len(values) // 100) - 1))]
+
+
+def summarize(times, work, unit, peak, **extra):
+    """
+    throughput (work per second over all calls), latency percentiles and peak
+    memory of a benchmark, plus any extra fields.
+    """
+    times = sorted(times)
+    result = {'calls': len(times),
+              'seconds': sum(times),
+              'throughput': work / max(sum(times), 1e-12),
+              'unit': unit,
+              'mean_ms': 1000 * sum(times) / len(times),
+              'max_ms': 1000 * times[-1],
+              'peak_mib': peak}
+    for q in PERCENTILES:
+        result['p{}_ms'.format(q)] = 1000 * percentile(times, q)
+    result.update(extra)
+    return result
+
+
+# --- benchmarks ---
+
+def bench_tst_put(scale, repeat, rng, cls=TST.TST):
+    """put of random keys into an empty trie"""
+    keys = datagen.random_keys(int(50000 * scale), rng=rng)
+    peak = peak_memory(lambda: build(cls, keys))
+    times = []
+    for _ in range(repeat):
+        tst = cls()
+        times.extend(latencies(lambda key: tst.put(key, 0), keys))
+    return summarize(times, len(times), 'puts/s', peak)
+
+
+def bench_tst_get(scale, repeat, rng, cls=TST.TST):
+    """get of every key of a trie, in random order"""
+    keys = datagen.random_keys(int(50000 * scale), rng=rng)
+    tst = build(cls, keys)
+    rng.shuffle(keys)
+    peak = peak_memory(lambda: [tst.get(key) for key in keys])
+    times = latencies(tst.get, keys, repeat)
+    return summarize(times, len(times), 'gets/s', peak)
+
+
+def bench_tst_prefix(scale, repeat, rng, cls=TST.TST):
+    """keys_with_prefix for random two character prefixes"""
+    keys = datagen.random_keys(int(50000 * scale), rng=rng)
+    tst = build(cls, keys)
+    prefixes = [key[:2] for key in rng.sample(keys, min(len(keys), 500))]
+    peak = peak_memory(lambda: [list(tst.keys_with_prefix(p)) for p in prefixes])
+    times = latencies(lambda p: list(tst.keys_with_prefix(p)), prefixes, repeat)
+    return summarize(times, len(times), 'queries/s', peak)
+
+
+def build(cls, keys):
+    tst = cls()
+    for i, key in enumerate(keys):
+        tst.put(key, i)
+    return tst
+
+
+def bench_align_random(scale, repeat, rng, m=100, n=400):
+    """fitted_align of unrelated random pairs with the default scoring"""
+    pairs = [datagen.random_pair(m, n, rng=rng) for _ in range(max(1, int(100 * scale)))]
+    return bench_align(pairs, repeat)
+
+
+def bench_align_near(scale, repeat, rng, m=1000, n=5000):
+    """fitted_align of reads copied with 3% errors from a longer string"""
+    pairs = [datagen.near_identical_pair(m, n, rng=rng) for _ in range(max(1, int(20 * scale)))]
+    return bench_align(pairs, repeat)
+
+
+def bench_align(pairs, repeat):
+    score = fitted_align.Score()
+    align = lambda pair: fitted_align.fitted_align(pair[0], pair[1], score)
+    peak = peak_memory(lambda: align(max(pairs, key=lambda pair: len(pair[0]) * len(pair[1]))))
+    times = latencies(align, pairs, repeat)
+    cells = repeat * sum(len(v) * len(w) for v, w in pairs)
+    return summarize(times, cells, 'cells/s', peak)
+
+
+def bench_permfinder(scale, repeat, rng, extra=('-filter', '5')):
+    """
+    permfinder16.run on a synthetic genome with planted telomere repeats,
+    with --profile for the time of each stage (summed over the runs)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        genome = os.path.join(tmp, 'genome.fa')
+        bases = datagen.synthetic_genome(genome, nrecords=max(1, int(20 * scale)), rng=rng)
+        args = permfinder16.parse_args(['-pattern', 'TTAGGG', '-infile', genome,
+                                        '-outfile', os.path.join(tmp, 'out.fa'),
+                                        '-table', os.path.join(tmp, 'out.tsv'),
+                                        '--profile'] + list(extra))
+        stages = {}
+        times = []
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                st = time.perf_counter()
+                cands, timer = permfinder16.run(args)
+                times.append(time.perf_counter() - st)
+            for name, seconds in timer.times.items():
+                stages[name] = stages.get(name, 0.0) + seconds
+        args.profile = False
+        with contextlib.redirect_stdout(io.StringIO()):
+            peak = peak_memory(lambda: permfinder16.run(args))
+    return summarize(times, repeat * bases, 'bases/s', peak,
+                     candidates=cands, stages=stages)
+
+
+BENCHES = {
+    'tst_put': bench_tst_put,
+    'tst_get': bench_tst_get,
+    'tst_prefix': bench_tst_prefix,
+    'compact_tst_put': lambda *a: bench_tst_put(*a, cls=TST.CompactTST),
+    'compact_tst_get': lambda *a: bench_tst_get(*a, cls=TST.CompactTST),
+    'align_random': bench_align_random,
+    'align_near': bench_align_near,
+    'permfinder': bench_permfinder,
+}
+
+
+# --- comparing ---
+
+def load(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+
+def compare(old, new):
+    """
+    prints the ratio new / old of throughput, median latency and peak memory
+    of each benchmark in both results; '!' marks a change worse than
+    REGRESSION.
+    """
+    print('{} -> {}'.format(old['meta']['commit'], new['meta']['commit']))
+    print('{:<18} {:>12} {:>12} {:>12}'.format('bench', 'throughput', 'p50', 'peak'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        cols = []
+        for key, higher_is_better in (('throughput', True), ('p50_ms', False), ('peak_mib', False)):
+            ratio = result[key] / max(before[key], 1e-12)
+            worse = ratio < 1 - REGRESSION if higher_is_better else ratio > 1 + REGRESSION
+            cols.append('{:10.3f}x{}'.format(ratio, '!' if worse else ' '))
+        print('{:<18} {:>12} {:>12} {:>12}'.format(name, *cols))
+
+
+if __name__ == "__main__":
+    main()
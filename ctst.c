@@ -0,0 +1,582 @@
+/* CPython extension holding the ternary search trie of TST.c, with str
+keys and arbitrary Python object values. Used by TST.py as the base of
+FastTST; see there for the full interface.
+
+Build in place with:
+    python setup.py build_ext --inplace
+or by hand with:
+    gcc -O2 -shared -fPIC $(python3-config --includes) ctst.c \
+        -o ctst$(python3-config --extension-suffix)
+
+Unlike TST.c, a node stores its character inline, values are references
+to Python objects (NULL when the node holds no value, storing None is the
+same as storing nothing), and put/get/del walk the trie in a loop so keys
+of any length work. */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+// node class for TST
+typedef struct node
+{
+    Py_UCS4 c;
+    PyObject *val;
+    struct node *left;
+    struct node *mid;
+    struct node *right;
+} node;
+
+// TST, top plays the part of root->mid in TST.c
+typedef struct
+{
+    PyObject_HEAD
+    node *top;
+} TSTObject;
+
+// growable stack used by del and items
+typedef struct
+{
+    void *items;
+    Py_ssize_t len;
+    Py_ssize_t cap;
+    size_t size;
+} stack;
+
+static int push(stack *s, const void *item)
+{
+    if (s->len == s->cap) {
+        Py_ssize_t cap = s->cap ? 2 * s->cap : 64;
+        void *items = PyMem_Realloc(s->items, cap * s->size);
+        if (items == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        s->items = items;
+        s->cap = cap;
+    }
+    memcpy((char *) s->items + s->len * s->size, item, s->size);
+    s->len++;
+    return 0;
+}
+
+static node *newNode(Py_UCS4 c)
+{
+    node *n = PyMem_Malloc(sizeof(node));
+    if (n == NULL) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    n->c = c;
+    n->val = NULL;
+    n->left = NULL;
+    n->mid = NULL;
+    n->right = NULL;
+    return n;
+}
+
+/* Deletes every node below n. Values are collected in vals so they can be
+released once the tree is gone. */
+static int delNodes(node *n, stack *vals)
+{
+    stack todo = {NULL, 0, 0, sizeof(node *)};
+    int err = 0;
+    if (n != NULL && push(&todo, &n) < 0) {
+        return -1;
+    }
+    while (todo.len > 0) {
+        n = ((node **) todo.items)[--todo.len];
+        if ((n->left != NULL && push(&todo, &n->left) < 0) ||
+            (n->mid != NULL && push(&todo, &n->mid) < 0) ||
+            (n->right != NULL && push(&todo, &n->right) < 0)) {
+            err = -1;
+            break;
+        }
+        if (n->val != NULL && push(vals, &n->val) < 0) {
+            err = -1;
+            break;
+        }
+        PyMem_Free(n);
+    }
+    PyMem_Free(todo.items);
+    return err;
+}
+
+static int checkKey(PyObject *key)
+{
+    if (!PyUnicode_Check(key)) {
+        PyErr_SetString(PyExc_TypeError, "key must be a str");
+        return -1;
+    }
+    return PyUnicode_READY(key);
+}
+
+/* Returns the node holding the last character of key, or NULL. */
+static node *getNode(TSTObject *self, PyObject *key)
+{
+    Py_ssize_t len = PyUnicode_GET_LENGTH(key);
+    int kind = PyUnicode_KIND(key);
+    const void *data = PyUnicode_DATA(key);
+    node *n = self->top;
+    Py_ssize_t index = 0;
+    if (len == 0) {
+        return NULL;
+    }
+    Py_UCS4 c = PyUnicode_READ(kind, data, 0);
+    while (n != NULL) {
+        if (c < n->c) {
+            n = n->left;
+        } else if (c > n->c) {
+            n = n->right;
+        } else if (index < len - 1) {
+            index++;
+            c = PyUnicode_READ(kind, data, index);
+            n = n->mid;
+        } else {
+            return n;
+        }
+    }
+    return NULL;
+}
+
+// ------------------------------------------------------
+// Inserting into trie
+// ------------------------------------------------------
+static PyObject *TST_put(TSTObject *self, PyObject *args)
+{
+    PyObject *key, *val;
+    if (!PyArg_ParseTuple(args, "OO:put", &key, &val) || checkKey(key) < 0) {
+        return NULL;
+    }
+    Py_ssize_t len = PyUnicode_GET_LENGTH(key);
+    if (len == 0) {
+        Py_RETURN_NONE;
+    }
+    int kind = PyUnicode_KIND(key);
+    const void *data = PyUnicode_DATA(key);
+    node **link = &self->top;
+    Py_ssize_t index = 0;
+    Py_UCS4 c = PyUnicode_READ(kind, data, 0);
+    for (;;) {
+        node *n = *link;
+        if (n == NULL) {
+            n = newNode(c);
+            if (n == NULL) {
+                return NULL;
+            }
+            *link = n;
+        }
+        if (c < n->c) {
+            link = &n->left;
+        } else if (c > n->c) {
+            link = &n->right;
+        } else if (index < len - 1) {
+            index++;
+            c = PyUnicode_READ(kind, data, index);
+            link = &n->mid;
+        } else {
+            PyObject *old = n->val;
+            if (val == Py_None) {
+                n->val = NULL;
+            } else {
+                Py_INCREF(val);
+                n->val = val;
+            }
+            Py_XDECREF(old);
+            Py_RETURN_NONE;
+        }
+    }
+}
+
+// ------------------------------------------------------
+// Retrieving from trie
+// ------------------------------------------------------
+static PyObject *TST_get(TSTObject *self, PyObject *key)
+{
+    if (checkKey(key) < 0) {
+        return NULL;
+    }
+    node *n = getNode(self, key);
+    if (n == NULL || n->val == NULL) {
+        Py_RETURN_NONE;
+    }
+    Py_INCREF(n->val);
+    return n->val;
+}
+
+// ------------------------------------------------------
+// Deleting from trie
+// ------------------------------------------------------
+static PyObject *TST_delete(TSTObject *self, PyObject *key)
+{
+    if (checkKey(key) < 0) {
+        return NULL;
+    }
+    Py_ssize_t len = PyUnicode_GET_LENGTH(key);
+    if (len == 0) {
+        Py_RETURN_NONE;
+    }
+    int kind = PyUnicode_KIND(key);
+    const void *data = PyUnicode_DATA(key);
+
+    // remember the link pointing at each node on the path
+    stack links = {NULL, 0, 0, sizeof(node **)};
+    node **link = &self->top;
+    PyObject *old = NULL;
+    Py_ssize_t index = 0;
+    Py_UCS4 c = PyUnicode_READ(kind, data, 0);
+    while (*link != NULL) {
+        node *n = *link;
+        if (push(&links, &link) < 0) {
+            PyMem_Free(links.items);
+            return NULL;
+        }
+        if (c < n->c) {
+            link = &n->left;
+        } else if (c > n->c) {
+            link = &n->right;
+        } else if (index < len - 1) {
+            index++;
+            c = PyUnicode_READ(kind, data, index);
+            link = &n->mid;
+        } else {
+            old = n->val;
+            n->val = NULL;
+            break;
+        }
+    }
+
+    /* walk back up: a node with no value and no middle path is replaced
+       by its only child, as in delRecursive of TST.c */
+    while (links.len > 0) {
+        link = ((node ***) links.items)[--links.len];
+        node *n = *link;
+        if (n->val == NULL && n->mid == NULL) {
+            if (n->left == NULL) {
+                *link = n->right;
+                PyMem_Free(n);
+            } else if (n->right == NULL) {
+                *link = n->left;
+                PyMem_Free(n);
+            }
+        }
+    }
+    PyMem_Free(links.items);
+    Py_XDECREF(old);
+    Py_RETURN_NONE;
+}
+
+// ------------------------------------------------------
+// Ordered iteration and queries
+// ------------------------------------------------------
+typedef struct
+{
+    node *n;
+    Py_ssize_t depth;
+    int visit;
+} frame;
+
+// a key found by collect: its characters in the chars stack, and its value
+typedef struct
+{
+    Py_ssize_t start;
+    Py_ssize_t len;
+    PyObject *val;
+} entry;
+
+/* Records the keys of the subtrie below n in sorted order, with the len
+characters in buf in front of every key, and takes a new reference to each
+value. The walk stops once entries holds limit keys (limit < 0: no limit). Nothing here calls back into Python, so a finalizer run by the
+garbage collector cannot change the trie under the raw node pointers of the
+walk; the pairs are built afterwards by appendEntries from the copies. */
+static int collect(node *n, Py_UCS4 *buf, Py_ssize_t len, stack *entries,
+                   stack *chars, Py_ssize_t limit)
+{
+    stack todo = {NULL, 0, 0, sizeof(frame)};
+    stack path = {NULL, 0, 0, sizeof(Py_UCS4)};
+    frame f = {n, len, 0};
+    int err = -1;
+    for (Py_ssize_t i = 0; i < len; i++) {
+        if (push(&path, &buf[i]) < 0) {
+            goto done;
+        }
+    }
+    if (n != NULL && push(&todo, &f) < 0) {
+        goto done;
+    }
+    while (todo.len > 0 && entries->len != limit) {
+        f = ((frame *) todo.items)[--todo.len];
+        n = f.n;
+        if (f.visit) {
+            path.len = f.depth;
+            if (push(&path, &n->c) < 0) {
+                goto done;
+            }
+            if (n->val != NULL) {
+                entry e = {chars->len, path.len, n->val};
+                for (Py_ssize_t i = 0; i < path.len; i++) {
+                    if (push(chars, (Py_UCS4 *) path.items + i) < 0) {
+                        goto done;
+                    }
+                }
+                if (push(entries, &e) < 0) {
+                    goto done;
+                }
+                Py_INCREF(n->val);
+            }
+            frame m = {n->mid, f.depth + 1, 0};
+            if (n->mid != NULL && push(&todo, &m) < 0) {
+                goto done;
+            }
+        } else {
+            frame r = {n->right, f.depth, 0};
+            frame v = {n, f.depth, 1};
+            frame l = {n->left, f.depth, 0};
+            if ((n->right != NULL && push(&todo, &r) < 0) ||
+                push(&todo, &v) < 0 ||
+                (n->left != NULL && push(&todo, &l) < 0)) {
+                goto done;
+            }
+        }
+    }
+    err = 0;
+done:
+    PyMem_Free(todo.items);
+    PyMem_Free(path.items);
+    return err;
+}
+
+/* Appends a (key, value) pair to out for every entry recorded by collect,
+unless out is NULL, and releases the references collect took, also on
+error. */
+static int appendEntries(stack *entries, stack *chars, PyObject *out)
+{
+    entry *es = entries->items;
+    int err = out == NULL ? -1 : 0;
+    for (Py_ssize_t i = 0; i < entries->len; i++) {
+        if (err == 0) {
+            PyObject *key = PyUnicode_FromKindAndData(
+                PyUnicode_4BYTE_KIND, (Py_UCS4 *) chars->items + es[i].start,
+                es[i].len);
+            PyObject *pair = key == NULL ? NULL : PyTuple_Pack(2, key, es[i].val);
+            Py_XDECREF(key);
+            if (pair == NULL || PyList_Append(out, pair) < 0) {
+                err = -1;
+            }
+            Py_XDECREF(pair);
+        }
+        Py_DECREF(es[i].val);
+    }
+    return err;
+}
+
+static PyObject *TST_items(TSTObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"prefix", "limit", NULL};
+    PyObject *prefix = NULL, *limitobj = Py_None;
+    Py_ssize_t limit = -1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|UO:items", kwlist,
+                                     &prefix, &limitobj) ||
+        (prefix != NULL && PyUnicode_READY(prefix) < 0)) {
+        return NULL;
+    }
+    if (limitobj != Py_None) {
+        limit = PyNumber_AsSsize_t(limitobj, PyExc_OverflowError);
+        if (limit == -1 && PyErr_Occurred()) {
+            return NULL;
+        }
+        if (limit < 0) {
+            PyErr_SetString(PyExc_ValueError, "limit must be None or >= 0");
+            return NULL;
+        }
+    }
+    stack entries = {NULL, 0, 0, sizeof(entry)};
+    stack chars = {NULL, 0, 0, sizeof(Py_UCS4)};
+    int err = 0;
+    if (limit == 0) {
+        return PyList_New(0);
+    }
+    if (prefix == NULL || PyUnicode_GET_LENGTH(prefix) == 0) {
+        err = collect(self->top, NULL, 0, &entries, &chars, limit);
+    } else {
+        Py_ssize_t len = PyUnicode_GET_LENGTH(prefix);
+        Py_UCS4 *buf = PyUnicode_AsUCS4Copy(prefix);
+        if (buf == NULL) {
+            return NULL;
+        }
+        node *n = getNode(self, prefix);
+        if (n != NULL && n->val != NULL) {
+            // the prefix itself sorts first
+            entry e = {0, len, n->val};
+            for (Py_ssize_t i = 0; i < len && err == 0; i++) {
+                err = push(&chars, &buf[i]);
+            }
+            if (err == 0 && (err = push(&entries, &e)) == 0) {
+                Py_INCREF(n->val);
+            }
+        }
+        if (n != NULL && err == 0) {
+            err = collect(n->mid, buf, len, &entries, &chars, limit);
+        }
+        PyMem_Free(buf);
+    }
+
+    // the trie is not touched from here on
+    PyObject *out = err < 0 ? NULL : PyList_New(0);
+    if (appendEntries(&entries, &chars, out) < 0) {
+        Py_XDECREF(out);
+        out = NULL;
+    }
+    PyMem_Free(entries.items);
+    PyMem_Free(chars.items);
+    return out;
+}
+
+static PyObject *TST_longest_prefix_of(TSTObject *self, PyObject *s)
+{
+    if (checkKey(s) < 0) {
+        return NULL;
+    }
+    Py_ssize_t len = PyUnicode_GET_LENGTH(s);
+    int kind = PyUnicode_KIND(s);
+    const void *data = PyUnicode_DATA(s);
+    node *n = self->top;
+    Py_ssize_t index = 0, length = 0;
+    while (n != NULL && index < len) {
+        Py_UCS4 c = PyUnicode_READ(kind, data, index);
+        if (c < n->c) {
+            n = n->left;
+        } else if (c > n->c) {
+            n = n->right;
+        } else {
+            index++;
+            if (n->val != NULL) {
+                length = index;
+            }
+            n = n->mid;
+        }
+    }
+    if (length == 0) {
+        Py_RETURN_NONE;
+    }
+    return PyUnicode_Substring(s, 0, length);
+}
+
+static PyObject *TST_clear(TSTObject *self, PyObject *Py_UNUSED(ignored))
+{
+    stack vals = {NULL, 0, 0, sizeof(PyObject *)};
+    node *top = self->top;
+    self->top = NULL;
+    int err = delNodes(top, &vals);
+    for (Py_ssize_t i = 0; i < vals.len; i++) {
+        Py_DECREF(((PyObject **) vals.items)[i]);
+    }
+    PyMem_Free(vals.items);
+    if (err < 0) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+// ------------------------------------------------------
+// Type boilerplate
+// ------------------------------------------------------
+static int TST_traverse(TSTObject *self, visitproc visit, void *arg)
+{
+    stack todo = {NULL, 0, 0, sizeof(node *)};
+    node *n = self->top;
+    int err = 0;
+    if (n != NULL && push(&todo, &n) < 0) {
+        PyErr_Clear();
+        return 0;
+    }
+    while (todo.len > 0 && err == 0) {
+        n = ((node **) todo.items)[--todo.len];
+        if ((n->left != NULL && push(&todo, &n->left) < 0) ||
+            (n->mid != NULL && push(&todo, &n->mid) < 0) ||
+            (n->right != NULL && push(&todo, &n->right) < 0)) {
+            PyErr_Clear();
+            break;
+        }
+        if (n->val != NULL) {
+            err = visit(n->val, arg);
+        }
+    }
+    PyMem_Free(todo.items);
+    return err;
+}
+
+static int TST_tp_clear(TSTObject *self)
+{
+    PyObject *res = TST_clear(self, NULL);
+    if (res == NULL) {
+        PyErr_Clear();
+        return 0;
+    }
+    Py_DECREF(res);
+    return 0;
+}
+
+static void TST_dealloc(TSTObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    TST_tp_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+static PyMethodDef TST_methods[] = {
+    {"put", (PyCFunction) TST_put, METH_VARARGS,
+     "put(key, val)\nInserts key into trie and associates key with value."},
+    {"get", (PyCFunction) TST_get, METH_O,
+     "get(key)\nReturns value associated with key, or None."},
+    {"delete", (PyCFunction) TST_delete, METH_O,
+     "delete(key)\nDeletes the given key from the trie."},
+    {"items", (PyCFunction)(void (*)(void)) TST_items, METH_VARARGS | METH_KEYWORDS,
+     "items(prefix='', limit=None)\nReturns a list of the (key, value) pairs "
+     "whose key starts with prefix, in sorted key order, stopping after limit "
+     "pairs."},
+    {"longest_prefix_of", (PyCFunction) TST_longest_prefix_of, METH_O,
+     "longest_prefix_of(s)\nReturns the longest key that is a prefix of s, "
+     "or None."},
+    {"clear", (PyCFunction) TST_clear, METH_NOARGS,
+     "clear()\nRemoves every key from the trie."},
+    {NULL}
+};
+
+static PyTypeObject TSTType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "ctst.TST",
+    .tp_doc = "Ternary search trie mapping str keys to Python objects.",
+    .tp_basicsize = sizeof(TSTObject),
+    .tp_itemsize = 0,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    .tp_new = PyType_GenericNew,
+    .tp_dealloc = (destructor) TST_dealloc,
+    .tp_traverse = (traverseproc) TST_traverse,
+    .tp_clear = (inquiry) TST_tp_clear,
+    .tp_methods = TST_methods,
+};
+
+static struct PyModuleDef ctstmodule = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "ctst",
+    .m_doc = "Ternary search trie implemented in C.",
+    .m_size = -1,
+};
+
+PyMODINIT_FUNC PyInit_ctst(void)
+{
+    if (PyType_Ready(&TSTType) < 0) {
+        return NULL;
+    }
+    PyObject *m = PyModule_Create(&ctstmodule);
+    if (m == NULL) {
+        return NULL;
+    }
+    Py_INCREF(&TSTType);
+    if (PyModule_AddObject(m, "TST", (PyObject *) &TSTType) < 0) {
+        Py_DECREF(&TSTType);
+        Py_DECREF(m);
+        return NULL;
+    }
+    return m;
+}
@@ -9,6 +9,15 @@
 
 import numpy as np
 import heapq
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import chain, islice
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
 
 LEFT = -1
 DIAG = 0
@@ -16,31 +25,181 @@ UP = 1
 TO_START = -5
 TO_END = 5
 
+# affine backtrack: whether a gap was opened or extended
+OPEN = 0
+EXTEND = 1
+
+# score of unreachable nodes, low enough to never win and never overflow
+NEG = -(1 << 40)
+
 
 def main():
-    fname = "dataset_248_5 (12).txt"
-    with open(fname, 'rt') as f:
-        v = f.readline().strip()
-        w = f.readline().strip()
-    (v_aln, w_aln), score = fitted_align(v, w, Score())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-infile', type=str, dest='infile', default="dataset_248_5 (12).txt")
+    parser.add_argument('-outfile', type=str, dest='outfile', default="out.txt")
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('-workers', type=int, dest='workers', default=os.cpu_count())
+    parser.add_argument('-chunksize', type=int, dest='chunksize', default=256)
+    parser.add_argument('--unordered', action='store_true')
+    parser.add_argument('-matrix', type=str, dest='matrix', default=None)
+    parser.add_argument('-sigma', type=int, dest='sigma', default=-1)
+    parser.add_argument('-epsilon', type=int, dest='epsilon', default=None)
+    parser.add_argument('-band', type=int, dest='band', default=None, metavar='K',
+                        help='heuristic, may be suboptimal: fill only K diagonals '
+                             'either side of a seed diagonal, so the score may be '
+                             'below the optimum. off by default. linear gaps only')
+    parser.add_argument('--test', action='store_true',
+                        help='run the test functions instead of aligning')
+    parser.set_defaults(func=run)
+    args = parser.parse_args()
+    if args.test:
+        test()
+        return
+    if args.band is not None and args.epsilon is not None and args.epsilon != args.sigma:
+        parser.error('-band does not support affine gaps (-epsilon other than -sigma)')
+    if args.band is not None:
+        print('-band is a heuristic: scores may be below the optimum', file=sys.stderr)
+    args.func(args)
+
+
+def run(args):
+    score = Score(args.matrix)
+    options = {"sigma": args.sigma, "epsilon": args.epsilon, "band": args.band}
+    if not args.batch:
+        with open(args.infile, 'rt') as f:
+            v = f.readline().strip()
+            w = f.readline().strip()
+        (v_aln, w_aln), top_score = fitted_align(v, w, score, **options)
+
+        with open(args.outfile, 'wt') as out:
+            print(top_score, v_aln, w_aln, sep='\n', file=out)
+        return
 
-    with open("out.txt", 'wt') as out:
-        print(score, v_aln, w_aln, sep='\n', file=out)
+    st = time.perf_counter()
+    count = 0
+    with open(args.outfile, 'wt') as out:
+        for name, top_score, v_aln, w_aln in align_batch(read_pairs(args.infile), score, options,
+                                                        args.workers, args.chunksize,
+                                                        not args.unordered):
+            print(name, top_score, v_aln, w_aln, sep='\t', file=out)
+            count += 1
+    elapsed = time.perf_counter() - st
+    print('aligned {} pairs in {:.2f} s ({:.1f} pairs/sec)'
+          .format(count, elapsed, count / elapsed if elapsed else 0.0), file=sys.stderr)
 
 
-def fitted_align(v, w, score, sigma=-1, epsilon=-1):
+def fitted_align(v, w, score, sigma=-1, epsilon=None, engine="auto", 
+                 linear=False, score_only=False, band=None):
     """
     returns a fitted alignment of strings v and w. shorter string fit to longer.
-    score - object x with method x.score(v[i], w[j]) for indices i and j 
+    score - object x with method x.score(v[i], w[j]) for indices i and j, 
+            e.g. Score("PAM250.txt")
     sigma - gap-open penalty
-    epsilon - gap-extension penalty (not implemented for now)
+    epsilon - gap-extension penalty. a gap of length k costs 
+              sigma + (k-1)*epsilon. None (or sigma) gives linear gaps, 
+              otherwise sigma <= epsilon is required (see fill_affine). 
+              affine gaps are filled by the rows engine only, so they 
+              cannot be combined with engine="loop" or linear.
+    engine - "rows" fills the matrices a row at a time with numpy array
+             operations, "loop" fills them one cell at a time. both give
+             the same alignment. "auto" uses bits_fitted_align when the 
+             scores are +1/-1 with sigma=-1 and rows otherwise; the score 
+             is the same, the alignment may be a different optimal one.
+    linear - keep only O(len(w)) scores in memory and find the alignment by
+             divide and conquer (see linear_fitted_align). the score is the
+             same, the alignment may be a different optimal one.
+    score_only - return only the score, computed in linear memory without
+             any traceback.
+    band - heuristic, may be suboptimal. only fill cells within k 
+           diagonals of the alignment, in O(k*len(v)) time and memory (see 
+           banded_fitted_align). either k, with the diagonal seeded from 
+           shared k-mers, or (diagonal, k) where diagonal is j - i. takes 
+           the place of linear. the result is the best alignment inside 
+           the band, whose score is a lower bound on the optimum and may 
+           be below it. None (the default) gives the exact alignment. 
+           linear gaps only.
     """
     if len(w) < len(v):
         v, w = w, v
     m = len(v) + 1
     n = len(w) + 1
 
+    if epsilon is not None and epsilon != sigma:
+        if band is not None:
+            raise ValueError("band does not support affine gaps")
+        if engine == "loop" or linear:
+            raise ValueError("affine gaps are only supported by the rows engine, "
+                             "not with engine=\"loop\" or linear")
+        return affine_fitted_align(v, w, score, sigma, epsilon, score_only)
+
+    if band is not None and len(v) > 0:
+        result = banded_fitted_align(v, w, score, sigma, band)
+        return result[1] if score_only else result
+    if engine == "auto" and not linear and len(v) > 0:
+        table, v_codes, w_codes = substitution_table(v, w, score)
+        if unit_scoring(table, sigma):
+            result = bits_fitted_align(v, w, table, v_codes, w_codes, sigma, score_only)
+            if result is not None:
+                return result
+    if score_only:
+        table, v_codes, w_codes = substitution_table(v, w, score)
+        return top_of_row(last_row(table, v_codes, w_codes, sigma, fitted=True))[0]
+    if linear:
+        return linear_fitted_align(v, w, score, sigma)
+
     # alignment and backtrack matrices
+    if engine == "loop":
+        a, b = fill_loop(v, w, score, sigma)
+    else:
+        a, b = fill_rows(v, w, score, sigma)
+
+    # collect top-scoring node on bottom row
+    top_node = top_of_row(a[m - 1])
+
+    # backtrack through graph - first go to top-scoring region
+    v_out, w_out = backtrack(b, v, w, m - 1, top_node[1])
+    return (w_out, v_out), top_node[0]
+
+
+def backtrack(b, v, w, i, j):
+    """
+    follows backtrack matrix b from node (i, j) back to the start and 
+    returns the aligned strings (v_out, w_out).
+    """
+    v_aln = []
+    w_aln = []
+
+    while i > 0 or j > 0:
+        if b[i, j] == TO_START:
+            break
+        elif b[i, j] == LEFT:
+            j -= 1
+            v_aln.append('-')
+            w_aln.append(w[j])
+        elif b[i, j] == UP:
+            i -= 1
+            v_aln.append(v[i])
+            w_aln.append('-')
+        else:
+            i -= 1
+            j -= 1
+            v_aln.append(v[i])
+            w_aln.append(w[j])
+
+    v_out = ''.join(v_aln)[::-1]
+    w_out = ''.join(w_aln)[::-1]
+    return v_out, w_out
+
+
+def fill_loop(v, w, score, sigma):
+    """
+    fills alignment and backtrack matrices one cell at a time.
+    """
+    m = len(v) + 1
+    n = len(w) + 1
+    table, v_codes, w_codes = substitution_table(v, w, score)
+    table = table.tolist()
+    w_codes = w_codes.tolist()
     a = np.zeros((m, n), dtype="int64")
     b = np.zeros((m, n), dtype="int64")
 
@@ -51,19 +210,13 @@ def fitted_align(v, w, score, sigma=-1, epsilon=-1):
         a[i, 0] = a[i - 1, 0] + sigma
         b[i, 0] = UP
 
-    # collect top-scoring node on bottom row
-    top_node = tuple([None])
-
     # fill in remainder of alignment and backtrack matrix
-    # fill in remainder of matrix
     for i in range(1, m):
+        subst = table[v_codes[i - 1]]
         for j in range(1, n):
-            vchar = v[i - 1]
-            wchar = w[j - 1]
-
             from_above = a[i - 1, j] + sigma
             from_left = a[i, j - 1] + sigma
-            from_diag = a[i - 1, j - 1] + score.score(vchar, wchar)
+            from_diag = a[i - 1, j - 1] + subst[w_codes[j - 1]]
 
             max_score = max(from_above, from_left, from_diag)
 
@@ -77,28 +230,250 @@ def fitted_align(v, w, score, sigma=-1, epsilon=-1):
 
             a[i, j] = max_score
             b[i, j] = back
+    return a, b
 
-            # store top-scoring bottom-node
-            if i == m - 1:
-                if not top_node[0] or top_node[0] < max_score:
-                    top_node = (max_score, i, j)
 
-    # backtrack through graph - first go to top-scoring region
-    i = top_node[1]
-    j = top_node[2]
-    score = top_node[0]
+def fill_rows(v, w, score, sigma):
+    """
+    fills alignment and backtrack matrices a row at a time, see fill_codes.
+    """
+    table, v_codes, w_codes = substitution_table(v, w, score)
+    return fill_codes(table, v_codes, w_codes, sigma, fitted=True)
+
+
+def fill_codes(table, v_codes, w_codes, sigma, fitted):
+    """
+    fills alignment and backtrack matrices for encoded sequences a row at 
+    a time. with fitted=False the first row charges gaps instead of being 
+    free, which gives a global alignment.
+
+    a cell's score is max(t[j], a[i, j-1] + sigma), where t[j] is the better 
+    of the moves from above and from the diagonal. unrolled along the row 
+    this is max over k <= j of t[k] + (j-k)*sigma, which is a running 
+    maximum of t[k] - k*sigma shifted back by j*sigma. ties are broken as 
+    in fill_loop: LEFT, then UP, then DIAG.
+    """
+    m = len(v_codes) + 1
+    n = len(w_codes) + 1
+    a = np.zeros((m, n), dtype="int64")
+    b = np.zeros((m, n), dtype="int64")
+    gaps = np.arange(n, dtype="int64") * sigma
+    if fitted:
+        b[0, 1:] = TO_START
+    else:
+        a[0] = gaps
+        b[0, 1:] = LEFT
+    b[1:, 0] = UP
+
+    for i in range(1, m):
+        row = a[i]
+        from_above = next_row(a[i - 1], table[v_codes[i - 1]][w_codes], sigma, gaps, row)
+        b[i, 1:] = np.where(row[1:] == row[:-1] + sigma, LEFT,
+                            np.where(row[1:] == from_above, UP, DIAG))
+    return a, b
+
+
+def next_row(prev, subst, sigma, gaps, row):
+    """
+    fills row with the scores following row prev, where subst holds the 
+    substitution scores of the row's character against w. gaps is 
+    arange(n) * sigma. returns the scores of the moves from above.
+    """
+    from_above = prev[1:] + sigma
+    t = np.empty(len(prev), dtype="int64")
+    t[0] = prev[0] + sigma
+    np.maximum(from_above, prev[:-1] + subst, out=t[1:])
+    np.subtract(t, gaps, out=t)
+    np.maximum.accumulate(t, out=row)
+    row += gaps
+    return from_above
+
+
+def last_row(table, v_codes, w_codes, sigma, fitted):
+    """
+    returns the last row of the alignment matrix of the encoded sequences, 
+    keeping only two rows in memory. fitted as in fill_codes.
+    """
+    n = len(w_codes) + 1
+    gaps = np.arange(n, dtype="int64") * sigma
+    prev = np.zeros(n, dtype="int64") if fitted else gaps.copy()
+    row = np.empty(n, dtype="int64")
+    for code in v_codes:
+        next_row(prev, table[code][w_codes], sigma, gaps, row)
+        prev, row = row, prev
+    return prev
+
+
+# ----------------------------------------------------------
+# linear memory alignment
+# ----------------------------------------------------------
+
+# sub-problems with at most this many cells are aligned with full matrices
+FULL_CELLS = 1 << 18
+
+
+def linear_fitted_align(v, w, score, sigma):
+    """
+    fitted alignment of v (the shorter string) to w in O(len(w)) memory.
+
+    a forward pass over the scores gives the best score and the column 
+    where the alignment ends. a backward pass of v against w up to that 
+    column, reversed and with the end fixed, gives the column where it 
+    starts. v is then aligned globally against the part of w in between 
+    with hirschberg's divide and conquer.
+    """
+    table, v_codes, w_codes = substitution_table(v, w, score)
+    top_score, end = top_of_row(last_row(table, v_codes, w_codes, sigma, fitted=True))
+    back = last_row(table, v_codes[::-1], w_codes[:end][::-1], sigma, fitted=False)
+    start = end - int(np.argmax(back))
+
+    v_aln, w_aln = [], []
+    hirschberg(v, w[start:end], table, v_codes, w_codes[start:end], sigma, v_aln, w_aln)
+    return (''.join(w_aln), ''.join(v_aln)), top_score
+
+
+def hirschberg(v, w, table, v_codes, w_codes, sigma, v_aln, w_aln):
+    """
+    appends a global alignment of v and w to v_aln and w_aln. the middle 
+    row of v is matched to the column of w maximising the forward score 
+    of the top half plus the backward score of the bottom half, and the 
+    two halves are aligned the same way.
+    """
+    if len(v) < 2 or len(v) * len(w) <= FULL_CELLS:
+        _, b = fill_codes(table, v_codes, w_codes, sigma, fitted=False)
+        v_out, w_out = backtrack(b, v, w, len(v), len(w))
+        v_aln.append(v_out)
+        w_aln.append(w_out)
+        return
+
+    mid = len(v) // 2
+    forward = last_row(table, v_codes[:mid], w_codes, sigma, fitted=False)
+    backward = last_row(table, v_codes[mid:][::-1], w_codes[::-1], sigma, fitted=False)
+    j = int(np.argmax(forward + backward[::-1]))
+    hirschberg(v[:mid], w[:j], table, v_codes[:mid], w_codes[:j], sigma, v_aln, w_aln)
+    hirschberg(v[mid:], w[j:], table, v_codes[mid:], w_codes[j:], sigma, v_aln, w_aln)
+
+
+# ----------------------------------------------------------
+# banded alignment
+# ----------------------------------------------------------
+
+# length of the shared k-mers used to seed the band
+SEED_KMER = 11
+
+
+def banded_fitted_align(v, w, score, sigma, band):
+    """
+    heuristic, may be suboptimal: fitted alignment of v (the shorter string) 
+    to w filling only the cells within k diagonals of a seed diagonal. 
+    band is k or (diagonal, k), see 
+    fitted_align. whenever the alignment found runs along the edge of the 
+    band (and not along the edge of the matrix) the band is doubled and the 
+    fill repeated, until it no longer does or the band covers the matrix.
+
+    the result is only the best alignment inside the final band. an 
+    alignment elsewhere, e.g. on a diagonal far from the seed that never 
+    meets the band's edges, is not seen, so the score is a lower bound on 
+    the optimum. it is the optimum whenever some optimal alignment lies in 
+    the band, and always once the band covers the matrix.
+    """
+    m = len(v)
+    n = len(w)
+    table, v_codes, w_codes = substitution_table(v, w, score)
+    if isinstance(band, tuple):
+        diag, k = band
+    else:
+        diag, k = seed_diagonal(v, w), band
+        if diag is None:  # nothing shared, use the whole matrix
+            diag, k = 0, n
+
+    k = max(k, 1)
+    while True:
+        k = min(k, max(m + diag, n - diag))
+        result = fill_band(v, w, table, v_codes, w_codes, sigma, diag, k)
+        if result is not None:
+            return result
+        k *= 2
+
+
+def seed_diagonal(v, w, kmer=SEED_KMER):
+    """
+    returns the diagonal j - i shared by most k-mers v[i:i+kmer] == 
+    w[j:j+kmer], or None if v and w share no k-mer.
+    """
+    kmer = min(kmer, len(v))
+    first = {}
+    for i in range(len(v) - kmer + 1):
+        first.setdefault(v[i:i + kmer], i)
+    votes = Counter()
+    for j in range(len(w) - kmer + 1):
+        i = first.get(w[j:j + kmer])
+        if i is not None:
+            votes[j - i] += 1
+    if not votes:
+        return None
+    return votes.most_common(1)[0][0]
+
+
+def fill_band(v, w, table, v_codes, w_codes, sigma, diag, k):
+    """
+    fills row i of the band over columns i + diag - k ... i + diag + k and 
+    backtracks from the top-scoring node of the last row. returns the 
+    alignment as fitted_align does, or None if the alignment touches the 
+    edge of the band.
+    """
+    m = len(v)
+    n = len(w)
+    width = 2 * k + 1
+    offsets = np.arange(width)
+    gaps = offsets * sigma
+    b = np.empty((m + 1, width), dtype="int8")
+    b[0] = TO_START
+
+    cols = offsets + diag - k
+    prev = np.where((cols >= 0) & (cols <= n), 0, NEG)
+    from_above = np.full(width, NEG, dtype="int64")
+    for i in range(1, m + 1):
+        cols += 1
+        outside = (cols < 0) | (cols > n)
+        from_above[:-1] = prev[1:] + sigma
+        subst = table[v_codes[i - 1]][w_codes[np.clip(cols - 1, 0, n - 1)]]
+        t = np.where(cols >= 1, np.maximum(from_above, prev + subst), from_above)
+        t[outside] = NEG
+        row = np.maximum.accumulate(t - gaps) + gaps
+        row[outside] = NEG
+
+        back = np.where(row == from_above, UP, DIAG)
+        back[1:] = np.where(row[1:] == row[:-1] + sigma, LEFT, back[1:])
+        b[i] = back
+        prev = row
+
+    # top-scoring node on the band's part of the bottom row
+    ends = np.flatnonzero((cols >= 1) & (cols <= n))
+    if len(ends) == 0:
+        return None
+    top_score, top = top_of_row(np.concatenate(([NEG], prev[ends])))
+    if top_score < NEG // 2:  # the band misses the first row
+        return None
+    c = ends[top - 1]
+
     v_aln = []
     w_aln = []
-
-    while i > 0 or j > 0:
-        if b[i, j] == TO_START:
+    i = m
+    j = int(cols[c])
+    while True:
+        if (c == 0 and j > 0) or (c == width - 1 and j < n):
+            return None
+        if b[i, c] == TO_START:
             break
-        elif b[i, j] == LEFT:
+        elif b[i, c] == LEFT:
             j -= 1
+            c -= 1
             v_aln.append('-')
             w_aln.append(w[j])
-        elif b[i, j] == UP:
+        elif b[i, c] == UP:
             i -= 1
+            c += 1
             v_aln.append(v[i])
             w_aln.append('-')
         else:
@@ -109,16 +484,799 @@ def fitted_align(v, w, score, sigma=-1, epsilon=-1):
 
     v_out = ''.join(v_aln)[::-1]
     w_out = ''.join(w_aln)[::-1]
-    return (w_out, v_out), score
+    return (w_out, v_out), top_score
+
+
+# ----------------------------------------------------------
+# bit-parallel filter for unit scores
+# ----------------------------------------------------------
+
+# windows covering more than this fraction of w fall back to the full fill
+BITS_COVER = 0.5
+
+
+def unit_scoring(table, sigma):
+    """
+    whether matches score +1, mismatches -1 and gaps sigma = -1.
+    """
+    return sigma == -1 and (table == 2 * np.eye(len(table), dtype="int64") - 1).all()
+
+
+def bits_fitted_align(v, w, table, v_codes, w_codes, sigma, score_only):
+    """
+    fitted alignment for unit scores that only fills the parts of w which 
+    can hold the optimum. returns what fitted_align would, or None if those 
+    parts cover more than BITS_COVER of w.
+
+    with E(A) the number of mismatches and gaps of an alignment A of v, its 
+    score is at most m - E(A). the alignment with the fewest edits, E*, 
+    scores at least m - 2E*, so the optimum has E(A) <= 2E* and spans at 
+    most m + 2E* columns. column_distances gives E_j, the fewest edits of 
+    an alignment ending at column j, so the optimum ends in a column with 
+    E_j <= 2E* and starts at most m + 2E* columns before it. only those 
+    windows are filled, and a column outside them scores below the optimum.
+    """
+    m = len(v)
+    n = len(w)
+    dists = column_distances(v_codes, w_codes, len(table))
+    limit = 2 * int(dists[1:].min())
+    reach = m + limit
+
+    windows = []
+    for j in np.flatnonzero(dists <= limit).tolist():
+        if j == 0:
+            continue
+        start = max(0, j - reach)
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = j
+        else:
+            windows.append([start, j])
+    if sum(end - start for start, end in windows) > BITS_COVER * n:
+        return None
+
+    # first top-scoring column over all windows, as top_of_row picks it
+    top_score = None
+    for start, end in windows:
+        if score_only:
+            row = last_row(table, v_codes, w_codes[start:end], sigma, fitted=True)
+        else:
+            a, b = fill_codes(table, v_codes, w_codes[start:end], sigma, fitted=True)
+            row = a[m]
+        j = 1 + int(np.argmax(row[1:]))
+        if top_score is None or row[j] > top_score:
+            top_score = row[j]
+            top = (start, end, j, None if score_only else b)
+    if top_score <= 0:  # top_of_row treats a top score of 0 differently
+        return None
+    if score_only:
+        return top_score
+
+    start, end, j, b = top
+    v_out, w_out = backtrack(b, v, w[start:end], m, j)
+    return (w_out, v_out), top_score
+
+
+def column_distances(v_codes, w_codes, size):
+    """
+    returns E, where E[j] is the fewest mismatches and gaps in an alignment 
+    of all of v ending at column j of w. uses myers' bit-vector algorithm 
+    with each column of the edit distance matrix held as two python ints, 
+    pv and mv marking the rows where it goes up and down by one.
+    """
+    m = len(v_codes)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    peq = [int.from_bytes(np.packbits(v_codes == c, bitorder="little").tobytes(), "little")
+           for c in range(size)]
+
+    pv = mask
+    mv = 0
+    dist = m
+    dists = [m]
+    for c in w_codes.tolist():
+        eq = peq[c]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            dist += 1
+        elif mh & high:
+            dist -= 1
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        dists.append(dist)
+    return np.array(dists)
+
+
+# ----------------------------------------------------------
+# affine gaps
+# ----------------------------------------------------------
+
+def affine_fitted_align(v, w, score, sigma, epsilon, score_only=False):
+    """
+    fitted alignment of v (the shorter string) to w with affine gaps, see 
+    fill_affine. takes the arguments of fitted_align.
+    """
+    if sigma > epsilon:
+        raise ValueError("affine gaps need sigma <= epsilon, got sigma={} and epsilon={}"
+                         .format(sigma, epsilon))
+
+    table, v_codes, w_codes = substitution_table(v, w, score)
+    if score_only:
+        n = len(w) + 1
+        gaps = np.arange(n, dtype="int64") * epsilon
+        mid = np.zeros(n, dtype="int64")
+        low = np.full(n, NEG, dtype="int64")
+        for code in v_codes:
+            mid, low, up = affine_row(mid, low, table[code][w_codes], sigma, epsilon, gaps)
+        return top_of_row(mid)[0]
+
+    mid, b_mid, b_low, b_up = fill_affine(table, v_codes, w_codes, sigma, epsilon)
+    top_score, j = top_of_row(mid)
+    i = len(v)
+
+    # walk back through the three layers, starting in the middle one
+    v_aln = []
+    w_aln = []
+    layer = DIAG
+    while i > 0 or j > 0:
+        if layer == DIAG:
+            back = b_mid[i, j]
+            if back == TO_START:
+                break
+            elif back == DIAG:
+                i -= 1
+                j -= 1
+                v_aln.append(v[i])
+                w_aln.append(w[j])
+            else:
+                layer = back
+        elif layer == UP:
+            if b_low[i, j] == OPEN:
+                layer = DIAG
+            i -= 1
+            v_aln.append(v[i])
+            w_aln.append('-')
+        else:
+            if b_up[i, j] == OPEN:
+                layer = DIAG
+            j -= 1
+            v_aln.append('-')
+            w_aln.append(w[j])
+
+    v_out = ''.join(v_aln)[::-1]
+    w_out = ''.join(w_aln)[::-1]
+    return (w_out, v_out), top_score
+
+
+def fill_affine(table, v_codes, w_codes, sigma, epsilon):
+    """
+    three-matrix (gotoh) fill for the fitted alignment of encoded sequences. 
+    returns the last row of the middle matrix and the backtrack matrices of 
+    the middle, lower (gap in w) and upper (gap in v) matrices.
+
+    b_mid says which layer the middle node came from (LEFT for upper, UP for 
+    lower, DIAG for a match), b_low and b_up whether a gap was opened or 
+    extended. ties are broken LEFT, UP, DIAG as in fill_loop.
+    """
+    m = len(v_codes) + 1
+    n = len(w_codes) + 1
+    b_mid = np.empty((m, n), dtype="int8")
+    b_low = np.empty((m, n), dtype="int8")
+    b_up = np.empty((m, n), dtype="int8")
+    b_mid[0, 1:] = TO_START
+    b_mid[1:, 0] = UP
+
+    gaps = np.arange(n, dtype="int64") * epsilon
+    mid = np.zeros(n, dtype="int64")
+    low = np.full(n, NEG, dtype="int64")
+    for i in range(1, m):
+        prev_low = low
+        mid, low, up = affine_row(mid, low, table[v_codes[i - 1]][w_codes], sigma, epsilon, gaps)
+        b_mid[i, 1:] = np.where(mid[1:] == up[1:], LEFT,
+                                np.where(mid[1:] == low[1:], UP, DIAG))
+        b_low[i] = np.where(low == prev_low + epsilon, EXTEND, OPEN)
+        b_up[i, 1:] = np.where(up[1:] == up[:-1] + epsilon, EXTEND, OPEN)
+    return mid, b_mid, b_low, b_up
+
+
+def affine_row(prev_mid, prev_low, subst, sigma, epsilon, gaps):
+    """
+    returns the (middle, lower, upper) rows following prev_mid and prev_low. 
+    gaps is arange(n) * epsilon.
+
+    the upper node at j is the best t[k] + sigma + (j-k-1)*epsilon over 
+    k < j, where t is the better of the lower and diagonal moves. a gap 
+    opened straight after another gap is never better than extending it 
+    when sigma <= epsilon, so t can leave the upper matrix out and the row 
+    is a running maximum like in next_row.
+    """
+    low = np.maximum(prev_low + epsilon, prev_mid + sigma)
+    t = low.copy()
+    np.maximum(low[1:], prev_mid[:-1] + subst, out=t[1:])
+    up = np.empty(len(t), dtype="int64")
+    up[0] = NEG
+    up[1:] = np.maximum.accumulate(t - gaps)[:-1] + gaps[:-1] + sigma
+    return np.maximum(t, up), low, up
+
+
+def substitution_table(v, w, score):
+    """
+    returns (table, v_codes, w_codes): v and w encoded as arrays of indices 
+    into an alphabet, and table[x, y] holding the score of the characters 
+    with codes x and y. a Score loaded from a file brings its own table, 
+    any other scorer is asked for score.score over the joint alphabet of 
+    v and w.
+    """
+    if getattr(score, "table", None) is not None:
+        codes = score.index
+        missing = (set(v) | set(w)) - set(codes)
+        if missing:
+            raise ValueError("residues {} are not in the scoring matrix"
+                             .format(''.join(sorted(missing))))
+        table = score.table
+    else:
+        alphabet = sorted(set(v) | set(w))
+        codes = {c: k for k, c in enumerate(alphabet)}
+        table = np.array([[score.score(x, y) for y in alphabet] for x in alphabet],
+                         dtype="int64").reshape(len(alphabet), len(alphabet))
+    v_codes = np.fromiter((codes[c] for c in v), dtype=np.intp, count=len(v))
+    w_codes = np.fromiter((codes[c] for c in w), dtype=np.intp, count=len(w))
+    return table, v_codes, w_codes
+
+
+def top_of_row(row):
+    """
+    returns (score, column) of the top-scoring node on the bottom row. the 
+    first maximum wins, except that a top score of 0 is always replaced by 
+    the next column's score.
+    """
+    top_node = tuple([None])
+    for j, max_score in enumerate(row[1:].tolist(), 1):
+        if not top_node[0] or top_node[0] < max_score:
+            top_node = (max_score, j)
+    if len(top_node) == 1:  # w is empty
+        return row[0], 0
+    return row[top_node[1]], top_node[1]
 
 
 class Score():
+    """
+    substitution scores. with no file, +1 for a match and -1 for a mismatch, 
+    otherwise read from a PAM/BLOSUM style file: a header line of residues 
+    followed by exactly one line per residue, the residue then its scores. 
+    blank lines and lines starting with # (as in the NCBI matrices) are 
+    skipped.
+    """
+
+    def __init__(self, fname=None):
+        self.alphabet = None
+        self.index = None
+        self.table = None
+        if fname is not None:
+            self.load(fname)
+
+    def load(self, fname):
+        with open(fname, 'rt') as f:
+            lines = [line.split() for line in f
+                     if line.strip() and not line.lstrip().startswith('#')]
+        if not lines:
+            raise ValueError("no scores in {}".format(fname))
+        self.alphabet = ''.join(lines[0])
+        self.index = {c: k for k, c in enumerate(self.alphabet)}
+        if len(self.index) != len(lines[0]) or any(len(c) != 1 for c in lines[0]):
+            raise ValueError("bad header in {}: {}".format(fname, ' '.join(lines[0])))
+        self.table = np.zeros((len(self.alphabet), len(self.alphabet)), dtype="int64")
+        seen = set()
+        for row in lines[1:]:
+            if row[0] not in self.index or row[0] in seen:
+                raise ValueError("{} row for {} in {}".format(
+                                 "repeated" if row[0] in seen else "unknown", row[0], fname))
+            if len(row) != len(self.alphabet) + 1:
+                raise ValueError("bad row for {} in {}".format(row[0], fname))
+            self.table[self.index[row[0]]] = [int(x) for x in row[1:]]
+            seen.add(row[0])
+        missing = [c for c in self.alphabet if c not in seen]
+        if missing:
+            raise ValueError("no rows for {} in {}".format(''.join(missing), fname))
+
+    def score(self, v, w):
+        if self.table is None:
+            return 1 if v == w else -1
+        return int(self.table[self.index[v], self.index[w]])
+
+
+# ----------------------------------------------------------
+# batch alignment
+# ----------------------------------------------------------
+
+def read_pairs(fname):
+    """
+    yields (name, v, w) pairs from a file ("-" for stdin). FASTA input pairs 
+    up consecutive records, query then reference, named after the query. 
+    TSV input has one pair per line, either name, v and w or just v and w, 
+    which are then named by line number. raises ValueError, with the file 
+    name and line number, for a TSV line with another number of fields or 
+    a last FASTA record left without a reference.
+    """
+    f = sys.stdin if fname == '-' else open(fname, 'rt')
+    where = '<stdin>' if fname == '-' else fname
+    try:
+        lines = (line.rstrip('\r\n') for line in f)
+        first = next(lines, None)
+        if first is None:
+            return
+        lines = chain([first], lines)
+        if first.startswith('>'):
+            records = read_fasta(lines)
+            for name, v, k in records:
+                reference = next(records, None)
+                if reference is None:
+                    raise ValueError("{}:{}: record {} has no reference record after it"
+                                     .format(where, k, name))
+                yield name, v, reference[1]
+        else:
+            for k, line in enumerate(lines, 1):
+                if not line:
+                    continue
+                fields = line.split('\t')
+                if len(fields) == 2:
+                    yield str(k), fields[0], fields[1]
+                elif len(fields) == 3:
+                    yield fields[0], fields[1], fields[2]
+                else:
+                    raise ValueError("{}:{}: expected 2 or 3 tab separated fields, got {}"
+                                     .format(where, k, len(fields)))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_fasta(lines):
+    """
+    yields (name, sequence, line number of the header) for FASTA records in 
+    lines.
+    """
+    name = None
+    seq = []
+    start = 0
+    for k, line in enumerate(lines, 1):
+        if line.startswith('>'):
+            if name is not None:
+                yield name, ''.join(seq), start
+            name = line[1:].strip().split(' ')[0]
+            seq = []
+            start = k
+        else:
+            seq.append(line.strip())
+    if name is not None:
+        yield name, ''.join(seq), start
+
+
+def align_chunk(chunk, score, options):
+    """
+    aligns a list of (name, v, w) pairs, returning (name, score, v_aln, w_aln) 
+    for each. runs in the worker processes.
+    """
+    results = []
+    for name, v, w in chunk:
+        (v_aln, w_aln), top_score = fitted_align(v, w, score, **options)
+        results.append((name, int(top_score), v_aln, w_aln))
+    return results
+
+
+def align_batch(pairs, score, options, workers=None, chunksize=256, ordered=True):
+    """
+    aligns (name, v, w) pairs across a pool of worker processes, yielding 
+    (name, score, v_aln, w_aln) as they finish, in input order if ordered. 
+    pairs are sent in chunks of chunksize, with at most twice as many chunks 
+    in flight as there are workers, so pairs can be streamed from disk.
+    """
+    pairs = iter(pairs)
+    chunks = iter(lambda: list(islice(pairs, chunksize)), [])
+    if workers == 1:
+        for chunk in chunks:
+            yield from align_chunk(chunk, score, options)
+        return
+
+    limit = 2 * (workers or os.cpu_count())
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if ordered:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(align_chunk, chunk, score, options))
+                if len(pending) >= limit:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        else:
+            pending = set()
+            for chunk in chunks:
+                pending.add(pool.submit(align_chunk, chunk, score, options))
+                if len(pending) >= limit:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+
+
+# ----------------------------------------------------------
+# test functions
+# ----------------------------------------------------------
+
+def test():
+    testEngines()
+    testAffine()
+    testScore()
+    testBatch()
+
+
+class RandomScore():
+    """
+    random, not necessarily symmetric, substitution scores from low to high 
+    for the characters of alphabet.
+    """
 
-    def __init__(self, fname="PAM250.txt"):
-        pass
+    def __init__(self, alphabet, rng, low=-3, high=3):
+        self.scores = {(x, y): rng.randint(low, high) for x in alphabet for y in alphabet}
 
     def score(self, v, w):
-        return 1 if v == w else -1
+        return self.scores[v, w]
+
+
+def random_pair(rng, m, n, alphabet, rate=None):
+    """
+    random strings v and w of lengths m <= n. with rate, v is copied from a 
+    random place of w with a fraction rate of substitutions and indels, and 
+    cut to at most n characters.
+    """
+    w = ''.join(rng.choice(alphabet) for _ in range(n))
+    if rate is None:
+        return ''.join(rng.choice(alphabet) for _ in range(m)), w
+    start = rng.randint(0, n - m)
+    v = []
+    for ch in w[start:start + m]:
+        r = rng.random()
+        if r < rate / 3:
+            continue
+        elif r < 2 * rate / 3:
+            v.append(rng.choice(alphabet))
+        elif r < rate:
+            ch = rng.choice(alphabet)
+        v.append(ch)
+    return ''.join(v)[:n] or w[start], w
+
+
+def rescore(alignment, v, w, score, sigma, epsilon=None):
+    """
+    score of an alignment (w_aln, v_aln) as fitted_align returns it, after 
+    checking that it aligns all of v to a substring of w. a gap of length k 
+    costs sigma + (k-1)*epsilon.
+    """
+    w_aln, v_aln = alignment
+    if epsilon is None:
+        epsilon = sigma
+    assert(len(v_aln) == len(w_aln))
+    assert(v_aln.replace('-', '') == v)
+    assert(w_aln.replace('-', '') in w)
+    total = 0
+    prev = None
+    for x, y in zip(v_aln, w_aln):
+        assert(x != '-' or y != '-')
+        gap = 'v' if x == '-' else 'w' if y == '-' else None
+        if gap is None:
+            total += score.score(x, y)
+        else:
+            total += epsilon if gap == prev else sigma
+        prev = gap
+    return total
+
+
+def testEngines(ntrials=300, seed=1):
+    """
+    aligns seeded random pairs, unrelated or with v copied from w with 
+    errors, and checks every engine against the loop engine: rows gives the 
+    same alignment, auto (the bit-parallel filter for unit scores), linear 
+    and score_only the same score, and a band covering the matrix the same 
+    score. a narrow band scores at most the optimum. every alignment must 
+    rescore to the score returned with it.
+    """
+    rng = random.Random(seed)
+    bits_used = 0
+    for trial in range(ntrials):
+        alphabet = rng.choice(("ACGT", "AC", "ACDEFGHIKLMNPQRSTVWY"))
+        m = rng.randint(1, 15)
+        n = rng.randint(m, 120 if trial % 2 else 40)
+        v, w = random_pair(rng, m, n, alphabet, rate=rng.choice((None, 0.05, 0.2)))
+        if rng.random() < 0.5:
+            score, sigma = Score(), -1
+        else:
+            score, sigma = RandomScore(alphabet, rng), rng.choice((-1, -2, -4))
+
+        ref_aln, ref = fitted_align(v, w, score, sigma, engine="loop")
+        assert(rescore(ref_aln, v, w, score, sigma) == ref)
+        aln, top = fitted_align(v, w, score, sigma, engine="rows")
+        assert((aln, top) == (ref_aln, ref))
+
+        for kwargs in ({}, {"linear": True}, {"band": (0, m + n)}):
+            aln, top = fitted_align(v, w, score, sigma, **kwargs)
+            assert(top == ref)
+            assert(rescore(aln, v, w, score, sigma) == top)
+        for kwargs in ({}, {"engine": "rows"}, {"engine": "loop"}, {"linear": True}):
+            assert(fitted_align(v, w, score, sigma, score_only=True, **kwargs) == ref)
+
+        for band in (rng.randint(1, 4), (rng.randint(-m, len(w)), rng.randint(1, 4))):
+            aln, top = fitted_align(v, w, score, sigma, band=band)
+            assert(top <= ref)
+            assert(rescore(aln, v, w, score, sigma) == top)
+
+        if isinstance(score, Score):
+            table, v_codes, w_codes = substitution_table(v, w, score)
+            result = bits_fitted_align(v, w, table, v_codes, w_codes, sigma, False)
+            if result is not None:
+                bits_used += 1
+                assert(result[1] == ref)
+                assert(rescore(result[0], v, w, score, sigma) == ref)
+    assert(bits_used > 0)
+
+    print("all engine tests passed!", ntrials, bits_used)
+
+
+def affine_reference(v, w, score, sigma, epsilon):
+    """
+    plain three-matrix fill of the fitted alignment with affine gaps, one 
+    cell at a time. returns the score top_of_row picks from the last row.
+    """
+    m = len(v)
+    n = len(w)
+    mid = [0] * (n + 1)
+    low = [NEG] * (n + 1)
+    for i in range(1, m + 1):
+        new_mid = [NEG] * (n + 1)
+        new_low = [NEG] * (n + 1)
+        up = [NEG] * (n + 1)
+        for j in range(n + 1):
+            new_low[j] = max(low[j] + epsilon, mid[j] + sigma)
+            if j > 0:
+                up[j] = max(up[j - 1] + epsilon, new_mid[j - 1] + sigma)
+                new_mid[j] = max(new_low[j], up[j],
+                                 mid[j - 1] + score.score(v[i - 1], w[j - 1]))
+            else:
+                new_mid[j] = new_low[j]
+        mid, low = new_mid, new_low
+    return top_of_row(np.array(mid, dtype="int64"))[0]
+
+
+def testAffine(ntrials=200, seed=2):
+    """
+    checks the affine fill on seeded random pairs against affine_reference, 
+    score_only against the full fill, and that each alignment rescores to 
+    its score with affine gaps. with epsilon = sigma the affine fill must 
+    match the linear loop engine.
+    """
+    rng = random.Random(seed)
+    for trial in range(ntrials):
+        alphabet = rng.choice(("ACGT", "ACDEFGHIKLMNPQRSTVWY"))
+        m = rng.randint(1, 12)
+        n = rng.randint(m, 40)
+        v, w = random_pair(rng, m, n, alphabet, rate=rng.choice((None, 0.2)))
+        score = Score() if rng.random() < 0.5 else RandomScore(alphabet, rng)
+        sigma = rng.randint(-6, -1)
+        epsilon = rng.randint(sigma, -1)
+
+        ref = affine_reference(v, w, score, sigma, epsilon)
+        aln, top = fitted_align(v, w, score, sigma, epsilon)
+        assert(top == ref)
+        assert(rescore(aln, v, w, score, sigma, epsilon) == top)
+        assert(fitted_align(v, w, score, sigma, epsilon, score_only=True) == ref)
+
+        linear = fitted_align(v, w, score, sigma, engine="loop")
+        assert(affine_fitted_align(v, w, score, sigma, sigma) == linear)
+
+    for kwargs in ({"engine": "loop"}, {"linear": True}, {"band": 4}):
+        try:
+            fitted_align("ACGT", "AACGTT", Score(), -3, -1, **kwargs)
+            assert(False)
+        except ValueError:
+            pass
+
+    print("all affine tests passed!", ntrials)
+
+
+def testScore():
+    """
+    loads a matrix with NCBI style comments and checks that a header residue 
+    without a row, or a repeated row, is rejected.
+    """
+    rows = ["   A  C  G", "A  2 -1  0", "C -1  3 -2", "G  0 -2  1"]
+    fd, fname = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        with open(fname, 'w') as f:
+            print("#  Matrix made by matblas from blosum62.iij", "", *rows, sep='\n', file=f)
+        score = Score(fname)
+        assert(score.score('C', 'C') == 3 and score.score('G', 'C') == -2)
+        for bad in (rows[:3], rows + [rows[1]]):
+            with open(fname, 'w') as f:
+                print(*bad, sep='\n', file=f)
+            try:
+                Score(fname)
+                assert(False)
+            except ValueError:
+                pass
+    finally:
+        os.remove(fname)
+
+    print("all score tests passed!")
+
+
+def testBatch(npairs=200, seed=3):
+    """
+    writes seeded random pairs as TSV and FASTA, reads them back with 
+    read_pairs and checks that align_batch in a pool of two workers, in and 
+    out of order, gives what fitted_align gives pair by pair. malformed 
+    files must raise ValueError.
+    """
+    rng = random.Random(seed)
+    pairs = []
+    for k in range(npairs):
+        m = rng.randint(1, 30)
+        v, w = random_pair(rng, m, rng.randint(m, 80), "ACGT", rate=0.1)
+        pairs.append(('p{}'.format(k), v, w))
+    options = {"sigma": -1, "epsilon": None, "band": None}
+    expected = []
+    for name, v, w in pairs:
+        (v_aln, w_aln), top_score = fitted_align(v, w, Score(), **options)
+        expected.append((name, int(top_score), v_aln, w_aln))
+
+    fd, fname = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        for text in ('\n'.join('\t'.join(pair) for pair in pairs),
+                     '\n'.join('>{}\n{}\n>ref\n{}'.format(*pair) for pair in pairs)):
+            with open(fname, 'w') as f:
+                print(text, file=f)
+            assert(list(read_pairs(fname)) == pairs)
+            results = list(align_batch(read_pairs(fname), Score(), options, 2, 7))
+            assert(results == expected)
+            results = align_batch(read_pairs(fname), Score(), options, 2, 7, ordered=False)
+            assert(sorted(results) == sorted(expected))
+
+        for text in ("a\tACGT\tAACGT\nACGT", "a\tb\tc\td", ">q\nACGT\n>r\nAACGT\n>q2\nAC"):
+            with open(fname, 'w') as f:
+                print(text, file=f)
+            try:
+                list(read_pairs(fname))
+                assert(False)
+            except ValueError:
+                pass
+    finally:
+        os.remove(fname)
+
+    print("all batch tests passed!", npairs)
+
+
+# ----------------------------------------------------------
+# benchmark functions
+# ----------------------------------------------------------
+
+def benchmark(m=300, n=600, big_m=2000, big_n=6000, alphabet="ACGT"):
+    """
+    aligns a random m x n pair with both engines, checks that they agree, 
+    and times the row engine, the linear memory alignment and the score 
+    alone on a big_m x big_n pair.
+    """
+    v = ''.join(random.choice(alphabet) for _ in range(m))
+    w = ''.join(random.choice(alphabet) for _ in range(n))
+    results = []
+    for engine in ("loop", "rows"):
+        st = time.perf_counter()
+        results.append(fitted_align(v, w, Score(), engine=engine))
+        print('{:>5} x {:<5} {:<5} {:8.3f} s'.format(m, n, engine, time.perf_counter() - st))
+    assert(results[0] == results[1])
+
+    v = ''.join(random.choice(alphabet) for _ in range(big_m))
+    w = ''.join(random.choice(alphabet) for _ in range(big_n))
+    for label, kwargs in (("rows", {}), ("linear", {"linear": True}),
+                          ("score", {"score_only": True})):
+        st = time.perf_counter()
+        fitted_align(v, w, Score(), **kwargs)
+        print('{:>5} x {:<5} {:<6} {:8.3f} s'.format(big_m, big_n, label, time.perf_counter() - st))
+
+
+def benchmark_scoring(m=300, n=600, fname=None, sigma=-11, epsilon=-1):
+    """
+    scores every cell of a random m x n pair with calls to score.score and 
+    with lookups in the encoded table, then times the rows engine with 
+    linear and with affine gaps. fname is a scoring matrix file.
+    """
+    score = Score(fname)
+    alphabet = score.alphabet or "ACGT"
+    v = ''.join(random.choice(alphabet) for _ in range(m))
+    w = ''.join(random.choice(alphabet) for _ in range(n))
+
+    st = time.perf_counter()
+    total_calls = sum(score.score(x, y) for x in v for y in w)
+    print('{:<8} {:8.3f} s'.format("calls", time.perf_counter() - st))
+
+    st = time.perf_counter()
+    table, v_codes, w_codes = substitution_table(v, w, score)
+    table = table.tolist()
+    w_codes = w_codes.tolist()
+    total_table = sum(table[x][y] for x in v_codes.tolist() for y in w_codes)
+    print('{:<8} {:8.3f} s'.format("table", time.perf_counter() - st))
+    assert(total_calls == total_table)
+
+    for label, eps in (("linear", None), ("affine", epsilon)):
+        st = time.perf_counter()
+        fitted_align(v, w, score, sigma, eps)
+        print('{:<8} {:8.3f} s'.format(label, time.perf_counter() - st))
+
+
+def benchmark_band(m=5000, n=6000, k=16, rate=0.03, alphabet="ACGT"):
+    """
+    aligns a read of length m, copied from a random string of length n with 
+    a fraction rate of substitutions and indels, with the full matrix and 
+    with a band of k diagonals seeded from shared k-mers. the band score 
+    can be lower than the full one, see banded_fitted_align.
+    """
+    w = ''.join(random.choice(alphabet) for _ in range(n))
+    start = random.randint(0, n - m)
+    v = []
+    for ch in w[start:start + m]:
+        r = random.random()
+        if r < rate / 3:
+            continue
+        elif r < 2 * rate / 3:
+            v.append(random.choice(alphabet))
+        elif r < rate:
+            ch = random.choice(alphabet)
+        v.append(ch)
+    v = ''.join(v)
+
+    results = []
+    for label, kwargs in (("full", {}), ("band", {"band": k})):
+        st = time.perf_counter()
+        results.append(fitted_align(v, w, Score(), **kwargs)[1])
+        print('{:>5} x {:<5} {:<5} {:8.3f} s'.format(len(v), n, label, time.perf_counter() - st))
+    print('scores', *results)
+
+
+def benchmark_bits(m=2000, n=20000, rate=0.03, alphabet="ACGT"):
+    """
+    aligns a read of length m, copied from a random string of length n with 
+    a fraction rate of substitutions and indels, with the rows engine and 
+    with the bit-parallel filter, for the alignment and the score alone.
+    """
+    w = ''.join(random.choice(alphabet) for _ in range(n))
+    start = random.randint(0, n - m)
+    v = []
+    for ch in w[start:start + m]:
+        r = random.random()
+        if r < rate / 3:
+            continue
+        elif r < 2 * rate / 3:
+            v.append(random.choice(alphabet))
+        elif r < rate:
+            ch = random.choice(alphabet)
+        v.append(ch)
+    v = ''.join(v)
+
+    for score_only in (False, True):
+        results = []
+        for engine in ("rows", "auto"):
+            st = time.perf_counter()
+            result = fitted_align(v, w, Score(), engine=engine, score_only=score_only)
+            results.append(result if score_only else result[1])
+            print('{:>5} x {:<5} {:<5} {:<5} {:8.3f} s'.format(len(v), n, engine,
+                  "score" if score_only else "align", time.perf_counter() - st))
+        assert(results[0] == results[1])
 
 
 if __name__ == "__main__":
@@ -1,37 +1,365 @@
 ################################################################################
 # pdf_merge.py
-# usage: python pdf_merge.py FILE1 FILE2 ... -o OUTPUT
+# usage: python pdf_merge.py FILE1 FILE2 ... [-l LIST] [--stream] [-j N]
+#                             [--check] -o OUTPUT
 ################################################################################
 
-from PyPDF2 import PdfFileMerger
+from PyPDF2 import PdfFileMerger, PdfFileReader
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject,
+                            NameObject, NullObject, NumberObject, StreamObject)
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, zip_longest
+import hashlib
+import io
+import os
+import shutil
 import sys
+import tempfile
+import time
 
-USAGE = "usage: python pdf_merge.py FILE1 FILE2 ... -o OUTPUT"
+USAGE = ("usage: python pdf_merge.py FILE1 FILE2 ... [-l LIST] [--stream] "
+         "[-j N] [--check] -o OUTPUT\n"
+         "  -l LIST    also read input names from LIST, one per line "
+         "('-' for stdin)\n"
+         "  --stream   write pages as they are read, one source open at a time\n"
+         "  -j N       merge groups of inputs in N processes, then merge the "
+         "parts\n"
+         "  --check    compare page count and order of OUTPUT with the inputs")
 
-# parse arguments
-OUTPUT_FLAG = -1
-try:
-    assert(len(sys.argv) > 1)
-    OUTPUT_FLAG = sys.argv.index('-o')
-    assert(OUTPUT_FLAG > 1)
-except(ValueError, AssertionError):
-    sys.exit(USAGE)
+CATALOG = 1     # object numbers reserved by PdfStreamWriter
+PAGES = 2
+FAN_IN = 32     # most parts merged at once by the tree merge
 
 
-def main():
+def parse_args(argv):
+    """split argv into input names, output name, list file, workers and flags"""
+    files = []
+    options = {'-o': None, '-l': None, '-j': None}
+    flags = {'--stream': False, '--check': False}
+    args = iter(argv[1:])
+    for arg in args:
+        if arg in options:
+            options[arg] = next(args, None)
+            if options[arg] is None:
+                sys.exit(USAGE)
+        elif arg in flags:
+            flags[arg] = True
+        else:
+            files.append(arg)
+    if options['-o'] is None or not (files or options['-l']):
+        sys.exit(USAGE)
+    workers = None
+    if options['-j'] is not None:
+        try:
+            workers = int(options['-j'])
+            assert(workers > 0)
+        except(ValueError, AssertionError):
+            sys.exit(USAGE)
+    return (files, options['-o'], options['-l'], workers,
+            flags['--stream'], flags['--check'])
+
+
+def read_list(fname):
+    """yield input names from a list file (or stdin for '-'), skipping blanks"""
+    if fname is None:
+        return
+    handle = sys.stdin if fname == '-' else open(fname)
+    try:
+        for line in handle:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def merge(names, output):
+    """merge every input in one PdfFileMerger, keeping bookmarks"""
     pdf_merger = PdfFileMerger()
-    index = 1
+    for name in names:
+        pdf_merger.append(name)
+    with open(output, 'wb') as out:
+        pdf_merger.write(out)
+    pdf_merger.close()
+
+
+def stream_merge(names, output, dedupe=True):
+    """merge inputs one at a time, writing each page before the next is read"""
+    try:
+        with open(output, 'wb') as out:
+            writer = PdfStreamWriter(out, dedupe)
+            for name in names:
+                with open(name, 'rb') as source:
+                    writer.add_file(source)
+            writer.close()
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+
+
+def tree_merge(names, output, workers, dedupe=True):
+    """
+    stream merge groups of inputs into temporary parts in a process pool,
+    then groups of parts, until at most FAN_IN remain for the final merge
+    """
+    names = list(names)
+    size = max(2, min(FAN_IN, -(-len(names) // workers)))
+    tmpdir = tempfile.mkdtemp(prefix='pdf_merge_',
+                              dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            level = 0
+            while len(names) > size:
+                groups = [names[i:i + size]
+                          for i in range(0, len(names), size)]
+                parts = [os.path.join(tmpdir, '{}_{}.pdf'.format(level, i))
+                         for i in range(len(groups))]
+                list(pool.map(stream_merge, groups, parts,
+                              [dedupe] * len(groups)))
+                if level:
+                    for name in names:
+                        os.remove(name)
+                names = parts
+                size = FAN_IN
+                level += 1
+        stream_merge(names, output, dedupe)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class PdfStreamWriter:
+    """
+    pdf writer that writes each object as soon as it is copied. only object
+    offsets, the page references and a digest per object are kept, so memory
+    is bounded by the largest source rather than by the whole output.
+    outlines and named destinations of the sources are not carried over.
+
+    objects are copied depth first, so an object is serialized with the
+    output numbers of what it references. with dedupe, an object whose bytes
+    match one already written reuses its number: identical fonts, images and
+    streams from different sources (or parts) are written once.
+    """
+
+    def __init__(self, out, dedupe=True):
+        self.out = out
+        self.dedupe = dedupe
+        self.offsets = [None, None, None]    # object 0 is free
+        self.digests = {}
+        self.kids = []
+        out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def new_object(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def write_object(self, num, obj):
+        self.offsets[num] = self.out.tell()
+        self.out.write(b'%d 0 obj\n' % num)
+        obj.writeToStream(self.out, None)
+        self.out.write(b'\nendobj\n')
+
+    def add_object(self, obj, num=None):
+        """write obj under num, or under a new or deduplicated number"""
+        if num is None:
+            data = io.BytesIO()
+            obj.writeToStream(data, None)
+            data = data.getvalue()
+            digest = None
+            if self.dedupe:
+                digest = hashlib.blake2b(data, digest_size=20).digest()
+                if digest in self.digests:
+                    return self.digests[digest]
+            num = self.new_object()
+            if digest is not None:
+                self.digests[digest] = num
+            self.offsets[num] = self.out.tell()
+            self.out.write(b'%d 0 obj\n%s\nendobj\n' % (num, data))
+        else:
+            self.write_object(num, obj)
+        return num
+
+    def add_file(self, source):
+        """copy every page of an open pdf file and the objects it references"""
+        reader = PdfFileReader(source, strict=False)
+        if reader.isEncrypted:
+            reader.decrypt('')
+        numbers = {}
+        # page tree nodes of the source all collapse into our one /Pages
+        nodes = [reader.trailer['/Root'].raw_get('/Pages')]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, IndirectObject):
+                numbers[node.idnum, node.generation] = PAGES
+            node = node.getObject()
+            if node.get('/Type') != '/Page':
+                nodes.extend(node.get('/Kids', ()))
+        pages = [reader.getPage(i) for i in range(reader.getNumPages())]
+        page_numbers = []
+        for page in pages:
+            num = self.new_object()
+            if page.indirectRef is not None:
+                ref = page.indirectRef
+                numbers[ref.idnum, ref.generation] = num
+            page_numbers.append(num)
+        active = set()
+
+        def copy(obj):
+            if isinstance(obj, IndirectObject):
+                return IndirectObject(resolve(obj), 0, None)
+            if isinstance(obj, StreamObject):
+                new = obj.__class__()
+                new._data = obj._data
+                new.update((k, copy(v)) for k, v in obj.items()
+                           if k != '/Length')
+                return new
+            if isinstance(obj, DictionaryObject):
+                new = DictionaryObject()
+                new.update((k, copy(v)) for k, v in obj.items())
+                return new
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(copy(v) for v in obj)
+            return obj
+
+        def resolve(ref):
+            key = ref.idnum, ref.generation
+            if key in numbers:
+                return numbers[key]
+            if key in active:
+                # a reference cycle: the number is fixed before the bytes
+                numbers[key] = self.new_object()
+                return numbers[key]
+            active.add(key)
+            obj = ref.getObject()
+            obj = copy(NullObject() if obj is None else obj)
+            active.discard(key)
+            numbers[key] = self.add_object(obj, numbers.get(key))
+            return numbers[key]
+
+        for page, num in zip(pages, page_numbers):
+            page = copy(page)
+            page[NameObject('/Parent')] = IndirectObject(PAGES, 0, None)
+            self.write_object(num, page)
+        self.kids.extend(page_numbers)
+
+    def close(self):
+        """write the page tree, catalog, cross-reference table and trailer"""
+        pages = DictionaryObject()
+        pages[NameObject('/Type')] = NameObject('/Pages')
+        pages[NameObject('/Kids')] = ArrayObject(
+            IndirectObject(num, 0, None) for num in self.kids)
+        pages[NameObject('/Count')] = NumberObject(len(self.kids))
+        self.write_object(PAGES, pages)
+        catalog = DictionaryObject()
+        catalog[NameObject('/Type')] = NameObject('/Catalog')
+        catalog[NameObject('/Pages')] = IndirectObject(PAGES, 0, None)
+        self.write_object(CATALOG, catalog)
+        xref = self.out.tell()
+        self.out.write(b'xref\n0 %d\n0000000000 65535 f \n' % len(self.offsets))
+        self.out.writelines(b'%010d 00000 n \n' % offset
+                            for offset in self.offsets[1:])
+        self.out.write(b'trailer\n<< /Size %d /Root %d 0 R >>\n'
+                       b'startxref\n%d\n%%%%EOF\n'
+                       % (len(self.offsets), CATALOG, xref))
+
+
+def page_digests(fname):
+    """yield a digest of the decoded content of each page of a pdf file"""
+    with open(fname, 'rb') as source:
+        reader = PdfFileReader(source, strict=False)
+        if reader.isEncrypted:
+            reader.decrypt('')
+        for i in range(reader.getNumPages()):
+            contents = reader.getPage(i).get('/Contents')
+            contents = contents.getObject() if contents is not None else ()
+            if not isinstance(contents, ArrayObject):
+                contents = [contents]
+            digest = hashlib.blake2b(digest_size=20)
+            for part in contents:
+                digest.update(part.getObject().getData())
+            yield digest.digest()
+
+
+def check_pages(names, output):
+    """
+    compare output page by page with the pages of the inputs in order.
+    returns the number of pages compared and the index of the first page
+    that differs, or None if the count and order match.
+    """
+    pages = zip_longest(chain.from_iterable(map(page_digests, names)),
+                        page_digests(output))
+    count = 0
+    for expected, found in pages:
+        if expected != found:
+            return count, count
+        count += 1
+    return count, None
+
+
+def peak_memory():
+    """peak resident set size of this process or a child in MB, or None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(who).ru_maxrss
+               for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def benchmark(names, workers=None):
+    """
+    merges the given pdf files with PdfFileMerger, the stream merge with and
+    without dedupe and the tree merge, checks each output against the inputs
+    and prints time, throughput and output size.
+    """
+    names = list(names)
+    workers = workers or os.cpu_count()
+    runs = [('merger', merge, ()), ('stream', stream_merge, (False,)),
+            ('dedupe', stream_merge, ()), ('tree', tree_merge, (workers,))]
+    tmpdir = tempfile.mkdtemp(prefix='pdf_merge_')
+    try:
+        for label, func, args in runs:
+            output = os.path.join(tmpdir, label + '.pdf')
+            st = time.perf_counter()
+            func(names, output, *args)
+            elapsed = time.perf_counter() - st
+            count, index = check_pages(names, output)
+            assert(index is None)
+            print('{:<6} {:>6} pages {:8.3f} s {:8.1f} pages/s {:8.1f} MB'.format(
+                  label, count, elapsed, count / elapsed,
+                  os.path.getsize(output) / (1 << 20)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    files, output, list_file, workers, stream, check = parse_args(sys.argv)
+    names = chain(files, read_list(list_file))
+    if workers or check:
+        names = list(names)
     try:
-        while index < OUTPUT_FLAG:
-            pdf_merger.append(sys.argv[index])
-            index += 1
-        with open(sys.argv[OUTPUT_FLAG + 1], 'wb') as out:
-            pdf_merger.write(out)
-            print('wrote file:', sys.argv[OUTPUT_FLAG + 1])
-    except FileNotFoundError:
-        print("invalid file name:", sys.argv[index])
+        if workers:
+            tree_merge(names, output, workers)
+        elif stream:
+            stream_merge(names, output)
+        else:
+            merge(names, output)
+        print('wrote file:', output)
+    except FileNotFoundError as error:
+        print("invalid file name:", error.filename)
         sys.exit("aborting!")
 
+    if check:
+        count, index = check_pages(names, output)
+        if index is not None:
+            sys.exit("page {} of {} does not match the inputs!".format(
+                index + 1, output))
+        print('checked pages:', count)
+    peak = peak_memory()
+    if peak is not None:
+        print('peak memory: {:.1f} MB'.format(peak))
     print('job completed successfully. exiting!')
 
 
@@ -8,35 +8,62 @@ Created on Wed Jun  5 10:09:09 2019
 # now supports gzip files
 
 import argparse
+import re
 import time
-from Bio import SeqIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack, redirect_stdout
+from functools import lru_cache
+from itertools import chain, groupby
+from bisect import bisect_right
+import csv
 import gzip
+import io
+import mmap
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
 #%%
 class Permutation():
     '''
     Class which conveniently stores relevant permutation information, including
-    whether or not permutation occurs in sense or antisense strand.
+    whether or not permutation occurs in sense or antisense strand. The contig
+    is kept as the record sequence plus start and end, and only sliced when
+    it is used.
     '''
     def __init__(self, loc, match, header, sense=True):
         self.loc = loc
         self.match = match
-        self.contig = None
+        self.seq = None
         self.start = None
         self.end = None
         self.header = header
+        self.description = header
         self.sense = sense
     
     def get_contig(self, seq, up, down, whole):
+        self.set_bounds(len(seq), up, down, whole)
+        self.seq = seq
+    
+    def set_bounds(self, length, up, down, whole):
         if whole:
             self.start = 0
-            self.end = len(seq)
+            self.end = length
         elif self.sense:
             self.start = max(self.loc-up, 0)
-            self.end = min(self.loc+down, len(seq))
+            self.end = min(self.loc+down, length)
         else:
             self.start = max(self.loc-down, 0)
-            self.end = min(self.loc+up, len(seq))
-        self.contig = seq[self.start:self.end]
+            self.end = min(self.loc+up, length)
+    
+    @property
+    def contig(self):
+        if self.seq is None:
+            return None
+        return self.seq[self.start:self.end]
         
     def update_header(self):
         if self.sense:
@@ -48,60 +75,469 @@ class Permutation():
         self.header = '|'.join((self.header, suffix))
         
     def update_match(self, num):
-        while self.match not in permutation_extender(self.match[:num],
-                                                     len(self.match)):
-            self.match = self.match[:-1]
+        # trims match to its longest prefix found among the extensions of
+        # the rotations of match[:num]: the prefix with period num
+        self.match = self.match[:periodic_prefix(self.match, num)]
             
     def get_filter_stat(self, n):
         contig_loc = self.contig.find(self.match)
         return 'Q' not in self.contig[contig_loc-n:contig_loc+n+len(self.match)]
         
 
+#%% profiling
+class StageTimer():
+    '''
+    Adds up the time spent in each stage of run (parse, mask, search, filter,
+    write) when enabled. Stages nest, as the generators of the pipeline pull
+    from each other, so the time of a stage excludes the stages it waits on.
+    When disabled, wrap and stage do nothing.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.times = {}
+        self.stack = []
+        self.mark = time.perf_counter()
+    
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.times[self.stack[-1]] += now - self.mark
+        self.times.setdefault(name, 0.0)
+        self.stack.append(name)
+        self.mark = now
+    
+    def exit(self):
+        now = time.perf_counter()
+        self.times[self.stack.pop()] += now - self.mark
+        self.mark = now
+    
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+    
+    def wrap(self, name, iterable):
+        """
+        Yields from iterable, counting the time each item takes to arrive as stage name.
+        """
+        if not self.enabled:
+            return iterable
+        return self.timed(name, iter(iterable))
+    
+    def timed(self, name, iterator):
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+    
+    def report(self, total):
+        print('{:<8} {:>9} {:>7}'.format('stage', 'seconds', 'share'))
+        for name in sorted(self.times, key=lambda name: STAGES.index(name) 
+                           if name in STAGES else len(STAGES)):
+            seconds = self.times[name]
+            print('{:<8} {:9.3f} {:6.1f}%'.format(name, seconds, 100*seconds/max(total, 1e-9)))
+        print('{:<8} {:9.3f}'.format('total', total))
+
+
+STAGES = ('index', 'parse', 'mask', 'search', 'filter', 'write')
+NO_PROFILE = StageTimer(enabled=False)
+
 #%% main fuction
 def main():
+    args = parse_args()
+    if args.test:
+        test()
+        return
+    args.func(args)
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line (or argv, a list of arguments). Outputs: parsed arguments.
+    """
     parser = argparse.ArgumentParser()
-    parser.add_argument('-pattern', type=str, dest='pattern', required=True)
-    parser.add_argument('-infile', type=str, dest='infile', required=True)
+    parser.add_argument('-pattern', type=str, dest='pattern', default=None)
+    parser.add_argument('-infile', type=str, dest='infile', default=None)
     parser.add_argument('-minlength', type=int, dest='minlength', default=-1)
     parser.add_argument('-maxlength', type=int, dest='maxlength', default=-1)
     parser.add_argument('--whole_contig', action='store_true')
     parser.add_argument('-upstream', type=int, dest='up', default=100)
     parser.add_argument('-downstream', type=int, dest='down', default=400)
-    parser.add_argument('-outfile', dest='output', type=str, required=True)
+    parser.add_argument('-outfile', dest='output', type=str, default='')
     parser.add_argument('-table', dest='out_table', type=str, default='')
     parser.add_argument('--mask', action='store_true')
     parser.add_argument('-filter', type=int, dest='filter', default=0)
     parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('-threads', type=int, dest='threads', default=1)
+    parser.add_argument('-chunksize', type=int, dest='chunksize', default=10000000)
+    parser.add_argument('-coords', dest='coords', type=str, default='')
+    parser.add_argument('-from_coords', dest='from_coords', type=str, default='')
+    parser.add_argument('--index', action='store_true')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--test', action='store_true',
+                        help='run the test functions instead of searching')
     parser.set_defaults(func=run)
-    args = parser.parse_args()
-    args.func(args)
+    args = parser.parse_args(argv)
+    if args.test:
+        return args
+    if args.pattern is None or args.infile is None:
+        parser.error('the following arguments are required: -pattern, -infile')
+    if not (args.output or args.coords or args.index):
+        parser.error('one of -outfile, -coords or --index is required')
+    return args
     
 
 def run(args):
+    """
+    Runs the search described by args. With args.profile the time of each stage is printed. Outputs: (number of candidates, StageTimer).
+    """
     st = time.time()
-    all_perms = []
-    with open_file(args.infile, args.gzip) as f:
-        for record in SeqIO.parse(f, 'fasta'):
-            record_sequence = str(record.seq)
-            record_header = record.description
-            if args.mask or args.filter > 0:
-                record_sequence = mask_telomeres(record_sequence, args.pattern)
-            all_perms.extend(permutation_search(record_sequence, args.pattern, args.up, 
-                                                args.down, record_header, args.whole_contig,
-                                                args.minlength, args.maxlength))
-    all_perms = filter_perms(all_perms, args.filter)
-    if len(args.out_table) > 0:
-        write_table_output(args, all_perms)
-    cands = write_fasta_output(args.output, all_perms)  
+    timer = StageTimer() if args.profile else NO_PROFILE
+    if args.index:
+        with timer.stage('index'):
+            build_index(args.infile)
+        if not (args.output or args.coords):
+            print('Time taken:', time.time()-st)
+            return 0, timer
+    with ExitStack() as stack:
+        # each stage passes on one record's permutations at a time
+        if args.from_coords:
+            index = stack.enter_context(FastaIndex(args.infile))
+            permlists = timer.wrap('parse', read_coords_output(args, index))
+        else:
+            f = stack.enter_context(open_file(args.infile, args.gzip))
+            records = timer.wrap('parse', read_fasta(f))
+            permlists = timer.wrap('search', search_records(records, args, timer))
+        permlists = timer.wrap('filter', filter_perms(permlists, args.filter))
+        with timer.stage('write'):
+            if len(args.coords) > 0:
+                permlists = write_coords_output(args.coords, permlists)
+            if len(args.out_table) > 0:
+                permlists = write_table_output(args, permlists)
+            if len(args.output) > 0:
+                cands = write_fasta_output(args.output, permlists, args.threads)  
+            else:
+                cands = sum(len(permlist) for permlist in permlists)
     print('Time taken:', time.time()-st)
     print('There were {} candidates found in this search'.format(cands))
+    if timer.enabled:
+        timer.report(time.time()-st)
+    return cands, timer
+
+#%% parallel search
+def search_record(record_sequence, record_header, args, hits=None, candidates=None,
+                  timer=NO_PROFILE):
+    """
+    Masks (if asked for) and searches one record. hits and candidates are scan results from search_chunk, when the record was scanned in chunks. timer times masking as its own stage. Inputs: record_sequence (string), record_header (string), args (parsed arguments). Outputs: list of permutations (class).
+    """
+    if args.mask or args.filter > 0:
+        with timer.stage('mask'):
+            record_sequence = mask_telomeres(record_sequence, args.pattern, hits)
+    return permutation_search(record_sequence, args.pattern, args.up, 
+                              args.down, record_header, args.whole_contig,
+                              args.minlength, args.maxlength, candidates)
+
+
+def search_chunk(chunk, offset, end, args):
+    """
+    Runs the scans of mask_telomeres and permutation_search over a chunk of a record, which starts at offset and carries a halo past end long enough to hold any hit starting before end. Outputs: (telomere hits, comp telomere hits, permutation candidates) starting in [offset, end), as positions in the record.
+    """
+    k, _, perms, _, revperms, _ = permutation_sets(args.pattern, args.minlength, args.maxlength)
+    candidates = [offset+loc for loc in permutation_candidates(chunk.upper(), perms | revperms)
+                  if offset+loc < end]
+    if args.mask or args.filter > 0:
+        hits, comp_hits = telomere_hits(chunk, args.pattern)
+        hits = [offset+loc for loc in hits if offset+loc < end]
+        comp_hits = [offset+loc for loc in comp_hits if offset+loc < end]
+    else:
+        hits, comp_hits = [], []
+    return hits, comp_hits, candidates
+
+
+def search_records(records, args, timer=NO_PROFILE):
+    """
+    Searches (sequence, header) records, yielding each record's list of permutations in input order. With args.threads > 1 records are searched in a process pool; records longer than args.chunksize are scanned in chunks across the pool and the hits resolved here in order, so the output is the same as the serial search. timer only sees masking in the serial search; in the pool it is part of the search stage.
+    """
+    if args.threads <= 1:
+        for record_sequence, record_header in records:
+            yield search_record(record_sequence, record_header, args, timer=timer)
+        return
+    
+    k, _, _, _, _, _ = permutation_sets(args.pattern, args.minlength, args.maxlength)
+    halo = max(k, 3*len(args.pattern)) - 1
+    with ProcessPoolExecutor(max_workers=args.threads) as pool:
+        pending = deque()
+        for record_sequence, record_header in records:
+            if len(record_sequence) > args.chunksize:
+                chunks = [pool.submit(search_chunk, record_sequence[start:start+args.chunksize+halo],
+                                      start, start+args.chunksize, args)
+                          for start in range(0, len(record_sequence), args.chunksize)]
+                pending.append((record_sequence, record_header, chunks))
+            else:
+                pending.append((None, None, pool.submit(search_record, record_sequence, 
+                                                        record_header, args)))
+            while len(pending) > 2*args.threads:
+                yield resolve_search(pending.popleft(), args)
+        while pending:
+            yield resolve_search(pending.popleft(), args)
+
+
+def resolve_search(job, args):
+    """
+    Waits for a record submitted by search_records and returns its permutations.
+    """
+    record_sequence, record_header, futures = job
+    if record_sequence is None:
+        return futures.result()
+    hits, comp_hits, candidates = [], [], []
+    for future in futures:
+        chunk_hits, chunk_comp_hits, chunk_candidates = future.result()
+        hits.extend(chunk_hits)
+        comp_hits.extend(chunk_comp_hits)
+        candidates.extend(chunk_candidates)
+    return search_record(record_sequence, record_header, args, (hits, comp_hits), candidates)
+
+#%% fasta index
+def fasta_name(description):
+    """
+    The name a FASTA index uses for a record: its description up to the first whitespace.
+    """
+    return description.split(None, 1)[0] if description.strip() else ''
+
+
+def build_index(fname):
+    """
+    Writes a samtools style index fname.fai (name, length, offset, bases per line, bytes per line) and, for a BGZF compressed file, fname.gzi mapping compressed to uncompressed block offsets. Every line of a record but the last must have the same length, and the last line may not be longer; otherwise ValueError is raised. Outputs: path of the .fai file.
+    """
+    check_not_gzip(fname)
+    bgzf = is_bgzf(fname)
+    if bgzf:
+        write_gzi(fname)
+    opener = gzip.open if bgzf else open
+    entries = []
+    with opener(fname, 'rb') as f:
+        pos = 0
+        entry = None
+        short = False
+        for line in f:
+            if line.startswith(b'>'):
+                entry = [fasta_name(line[1:].decode('latin-1')), 0, pos+len(line), 0, 0]
+                entries.append(entry)
+                short = False
+            elif entry is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if (bases and short) or (entry[3] and bases > entry[3]):
+                    raise ValueError('record {} in {} has lines of different lengths'.format(entry[0], fname))
+                if entry[3] == 0 and bases == 0:
+                    short = True
+                elif entry[3] == 0:
+                    entry[3], entry[4] = bases, len(line)
+                elif bases != entry[3] or len(line) != entry[4]:
+                    short = True
+                entry[1] += bases
+            pos += len(line)
+    with open(fname + '.fai', 'w') as out:
+        for entry in entries:
+            print(*entry, sep='\t', file=out)
+    return fname + '.fai'
+
+
+def is_bgzf(fname):
+    """
+    Whether fname is BGZF compressed: gzip blocks carrying a BC extra field with the block size.
+    """
+    with open(fname, 'rb') as f:
+        header = f.read(16)
+    return header[:4] == GZIP_MAGIC + b'\x08\x04' and header[12:14] == b'BC'
+
+
+def check_not_gzip(fname):
+    """
+    Raises ValueError for gzip files which are not BGZF, as they cannot be read at random.
+    """
+    if is_bgzf(fname):
+        return
+    with open(fname, 'rb') as f:
+        if f.read(2) == GZIP_MAGIC:
+            raise ValueError('{} is gzip but not BGZF compressed, recompress it with bgzip'.format(fname))
+
+
+def write_gzi(fname):
+    """
+    Writes fname.gzi, the htslib block index of a BGZF file: the number of blocks after the first, then (compressed offset, uncompressed offset) for each, as little endian uint64. Only the block headers and sizes are read.
+    """
+    blocks = []
+    coffset = uoffset = 0
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while coffset < size:
+            f.seek(coffset)
+            header = f.read(18)
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            f.seek(coffset + block_size - 4)
+            coffset += block_size
+            uoffset += struct.unpack('<I', f.read(4))[0]
+            blocks.append((coffset, uoffset))
+    blocks = blocks[:-1]  # the last offsets are the end of the file
+    with open(fname + '.gzi', 'wb') as out:
+        out.write(struct.pack('<Q', len(blocks)))
+        for block in blocks:
+            out.write(struct.pack('<QQ', *block))
+
+
+class FastaIndex():
+    '''
+    Random access to the sequences of a FASTA file (plain or BGZF) through its .fai (and .gzi) index, which is built if missing.
+    '''
+    def __init__(self, fname):
+        if not os.path.exists(fname + '.fai'):
+            build_index(fname)
+        self.records = {}
+        with open(fname + '.fai') as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')[:5]
+                self.records[name] = (int(length), int(offset), int(linebases), int(linewidth))
+        self.blocks = None
+        check_not_gzip(fname)
+        if is_bgzf(fname):
+            with open(fname + '.gzi', 'rb') as f:
+                count = struct.unpack('<Q', f.read(8))[0]
+                offsets = struct.unpack('<{}Q'.format(2*count), f.read(16*count))
+            self.blocks = [(0, 0)] + list(zip(offsets[::2], offsets[1::2]))
+            self.ublocks = [uoffset for _, uoffset in self.blocks]
+        self.handle = open(fname, 'rb')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self.handle.close()
+    
+    def length(self, name):
+        return self.records[name][0]
+    
+    def fetch(self, name, start, end):
+        """
+        Returns bases start to end (0-based, end excluded) of record name.
+        """
+        length, offset, linebases, linewidth = self.records[name]
+        start, end = max(start, 0), min(end, length)
+        if start >= end:
+            return ''
+        first = offset + start//linebases*linewidth + start%linebases
+        last = offset + (end-1)//linebases*linewidth + (end-1)%linebases + 1
+        return self.read(first, last-first).translate(None, b'\r\n').decode('latin-1')
+    
+    def read(self, pos, size):
+        if self.blocks is None:
+            self.handle.seek(pos)
+            return self.handle.read(size)
+        coffset, uoffset = self.blocks[bisect_right(self.ublocks, pos)-1]
+        self.handle.seek(coffset)
+        with gzip.GzipFile(fileobj=self.handle) as f:
+            f.seek(pos-uoffset)
+            return f.read(size)
+
+
+class IndexedRecord():
+    '''
+    A record of a FastaIndex which can stand in for its sequence: len() and slicing read only the bases asked for.
+    '''
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+    
+    def __len__(self):
+        return self.index.length(self.name)
+    
+    def __getitem__(self, key):
+        start, end, _ = key.indices(len(self))
+        return self.index.fetch(self.name, start, end)
 
 #%% utility functions
+GZIP_MAGIC = b'\x1f\x8b'
+READ_SIZE = 1 << 24
+
+@contextmanager
 def open_file(fname, cond):
-    if cond:
-        import gzip
-        return gzip.open(fname, 'rt')
-    return open(fname, 'rt')
+    """
+    Opens fname for reading bytes. Gzip files (cond, or detected by their magic number) are decompressed by pigz when it is installed, in a separate process, or by the gzip module otherwise. Plain files are memory mapped.
+    """
+    with open(fname, 'rb') as f:
+        cond = cond or f.read(2) == GZIP_MAGIC
+        f.seek(0)
+        if cond:
+            pigz = shutil.which('pigz')
+            if pigz is None:
+                with gzip.open(f, 'rb') as handle:
+                    yield handle
+                return
+            proc = subprocess.Popen([pigz, '-dc'], stdin=f, stdout=subprocess.PIPE)
+            try:
+                yield proc.stdout
+            finally:
+                proc.stdout.close()
+                if proc.wait() not in (0, -13):  # -13: stopped reading early (SIGPIPE)
+                    raise IOError('pigz failed on {}'.format(fname))
+        elif os.fstat(f.fileno()).st_size == 0:
+            yield f
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as handle:
+                yield handle
+
+
+def read_fasta(handle, size=READ_SIZE):
+    """
+    Yields (sequence, description) for each record of a FASTA file opened by open_file. The file is read in blocks of size bytes, split on lines starting with '>' and each record's sequence lines joined with a single translate that drops whitespace, with no per-line work in python. Text before the first record is skipped.
+    """
+    record = None
+    prev = b'\n'
+    for block in iter(lambda: handle.read(size), b''):
+        # offsets of the '>' starting each record in this block
+        hits = [0] if prev == b'\n' and block.startswith(b'>') else []
+        hit = block.find(b'\n>')
+        while hit != -1:
+            hits.append(hit+1)
+            hit = block.find(b'\n>', hit+1)
+        start = 0
+        for hit in hits:
+            if record is not None:
+                record.append(block[start:hit])
+                yield fasta_record(record)
+            record = []
+            start = hit
+        if record is not None:
+            record.append(block[start:])
+        prev = block[-1:]
+    if record is not None:
+        yield fasta_record(record)
+
+
+def fasta_record(blocks):
+    """
+    Turns the blocks of one record, from its '>' to the next, into (sequence, description).
+    """
+    raw = b''.join(blocks)
+    end = raw.find(b'\n')
+    if end == -1:
+        end = len(raw)
+    description = raw[1:end].rstrip().decode('latin-1')
+    sequence = raw[end+1:].translate(None, b' \t\r\n').decode('latin-1')
+    return sequence, description
 
 def comp_base_dict_constructor():
     """
@@ -112,17 +548,14 @@ def comp_base_dict_constructor():
         comp_bases[k.lower()] = v.lower()
     return comp_bases
 
+COMP_TABLE = str.maketrans(comp_base_dict_constructor())
+
 def complement(seq, comp_bases=None, reverse=False): 
     """
-    Generates a complementary strand if DNA to a provided DNA string. If specified, this function will return a reverse complement. Inputs: seq(string), comp_bases (python dictionary), reverse (boolean).
+    Generates a complementary strand if DNA to a provided DNA string. If specified, this function will return a reverse complement. Inputs: seq(string), comp_bases (python dictionary), reverse (boolean). Uses a str.translate table, built once for the default bases; characters without a complement are left as they are.
     """
-    # make dictionary of complementary bases if one is not already provided
-    if not comp_bases: 
-        try:
-            comp_bases = comp_base_dict_constructor()
-        except NameError:
-            print('''Please provide a dictionary containing all DNA bases and their complements in the sequence to be examined. A helper function which contains nucleotide sequences containing  A, C, G, T, and N (upper or lower case) can be found in the same file this function was imported from: dnautil.py. To import the function, use the following code: from dnautil import comp_base_dict_constructor.''') # make complementary DNA strand         
-    comp_strand = ''.join([comp_bases[base] for base in seq])
+    table = COMP_TABLE if not comp_bases else str.maketrans(comp_bases)
+    comp_strand = seq.translate(table)
     if reverse:
         return comp_strand[::-1]
     return comp_strand
@@ -153,33 +586,15 @@ def permutation_extender(pattern, n):
     return ext_perm_lis
 
 #%% permutation search
-def permutation_search(sequence, pattern, up, down, header, whole, minlen, maxlen):
+def permutation_search(sequence, pattern, up, down, header, whole, minlen, maxlen,
+                       candidates=None):
     """
     Searches for permutations of the pattern of length n+2:2n+1 for specified
     pattern and its reverse complement. Outputs list of permutations (class). 
+    candidates optionally gives the permutation_candidates of the sequence
+    (before masking), when they were found elsewhere.
     """
-    # k = len(pattern)+2, k_long = 2(len(pattern))+1
-    if minlen < 0:
-        k = len(pattern)+2; k_long = (2*len(pattern))+1
-    else:
-        k = minlen
-    
-    if maxlen < 0:
-        k_long = (2*len(pattern)) + 1
-    else:
-        k_long = maxlen
-    
-    # telomere pattern indicates possible TR alignment domain in anti-sense strand
-    comp_pattern = pattern 
-    pattern = complement(pattern, reverse=True)
-    # k = len(pattern)+2, k_long = 2(len(pattern))+1
-    # k = len(pattern)+2; k_long = (2*len(pattern))+1
-    
-    perms, long_perms = (permutation_extender(pattern, k),
-                         permutation_extender(pattern, k_long))
-
-    revperms, long_revperms = (permutation_extender(comp_pattern, k),
-                               permutation_extender(comp_pattern, k_long))
+    k, k_long, perms, long_perms, revperms, long_revperms = permutation_sets(pattern, minlen, maxlen)
     # handle for lower case characters
     seq = sequence.upper()
     # different rule for bad bases: if region has both G and C in
@@ -190,111 +605,686 @@ def permutation_search(sequence, pattern, up, down, header, whole, minlen, maxle
     #output list
     permlist = list()
     
-    while i <= n-k+1:
-        subseq = seq[i:i+k].upper()
+    # every position where a permutation of either strand starts, found in
+    # one pass. the last window (one base short) is checked as before.
+    if candidates is None:
+        candidates = permutation_candidates(seq, perms | revperms)
+    candidates = chain(candidates, (n-k+1,))
+    
+    for loc in candidates:
+        if loc < i or loc > n-k+1:
+            continue
+        subseq = seq[loc:loc+k]
         
         if subseq in perms:
-            if seq[i:i+k_long] not in long_perms \
-            and seq[i+1-k_long:i+1] not in long_perms:
-                match = seq[i:i+k_long]
-                loc = i
+            if seq[loc:loc+k_long] not in long_perms \
+            and seq[loc+1-k_long:loc+1] not in long_perms:
+                match = seq[loc:loc+k_long]
                 perm = Permutation(loc, match, header)
                 perm.get_contig(sequence, up, down, whole)
                 perm.update_header()
                 permlist.append(perm)
             # Increment i to skip over permutation.            
-            i += k_long
-            continue 
+            i = loc + k_long
         
         elif subseq in revperms:
-            if seq[i:i+k_long] not in long_revperms \
-            and seq[i+1-k_long:i+1] not in long_revperms:
-                match = seq[i:i+k_long]
-                loc = i
+            if seq[loc:loc+k_long] not in long_revperms \
+            and seq[loc+1-k_long:loc+1] not in long_revperms:
+                match = seq[loc:loc+k_long]
                 perm = Permutation(loc, match, header, sense=False)
                 perm.get_contig(sequence, up, down, whole)
                 perm.update_header()
                 permlist.append(perm)
             # Increment i to skip over permutation.            
-            i += k_long
-            continue
-        i += 1
+            i = loc + k_long
     return permlist
 
 
-def mask_telomeres(seq, pattern):
+@lru_cache(maxsize=None)
+def permutation_sets(pattern, minlen, maxlen):
+    """
+    Builds the permutations searched for by permutation_search: k and k_long (from minlen and maxlen, -1 for the defaults len(pattern)+2 and 2*len(pattern)+1), then the sets of permutations of length k and k_long of the reverse complement of pattern and of pattern itself. Built once per pattern and lengths and shared by every record, so the sets must not be modified. Outputs: (k, k_long, perms, long_perms, revperms, long_revperms).
+    """
+    # k = len(pattern)+2, k_long = 2(len(pattern))+1
+    if minlen < 0:
+        k = len(pattern)+2; k_long = (2*len(pattern))+1
+    else:
+        k = minlen
+    
+    if maxlen < 0:
+        k_long = (2*len(pattern)) + 1
+    else:
+        k_long = maxlen
+    
+    # telomere pattern indicates possible TR alignment domain in anti-sense strand
+    comp_pattern = pattern 
+    pattern = complement(pattern, reverse=True)
+    # k = len(pattern)+2, k_long = 2(len(pattern))+1
+    # k = len(pattern)+2; k_long = (2*len(pattern))+1
+    
+    perms, long_perms = (set(permutation_extender(pattern, k)),
+                         set(permutation_extender(pattern, k_long)))
+
+    revperms, long_revperms = (set(permutation_extender(comp_pattern, k)),
+                               set(permutation_extender(comp_pattern, k_long)))
+    return k, k_long, perms, long_perms, revperms, long_revperms
+
+
+def periodic_prefix(match, num):
+    """
+    Length of the longest prefix of match that is an extension of a rotation of match[:num], which is the longest prefix repeating with period num (all of match if it is no longer than num). match is xored with itself shifted by num as one big integer, so the first mismatch is found in a single linear pass without a python loop. Inputs: match (string), num (integer). Outputs: length (integer).
+    """
+    if len(match) <= num:
+        return len(match)
+    if not match.isascii():
+        for i in range(num, len(match)):
+            if match[i] != match[i-num]:
+                return i
+        return len(match)
+    ahead, behind = match[num:].encode('ascii'), match[:-num].encode('ascii')
+    diff = int.from_bytes(ahead, 'big') ^ int.from_bytes(behind, 'big')
+    if diff == 0:
+        return len(match)
+    return num + len(ahead) - (diff.bit_length()+7)//8
+
+
+def permutation_candidates(seq, perms):
+    """
+    Lists every position in seq (upper case) where one of perms starts, in a single pass with permutation_regex. Inputs: seq (string), perms (set of strings). Outputs: positions (list).
+    """
+    return [hit.start() for hit in permutation_regex(perms).finditer(seq)]
+
+
+def permutation_regex(perms):
+    """
+    Compiles a regular expression which matches (with zero width, so overlapping hits are all reported by finditer) wherever one of the strings in perms starts. The strings are arranged as a trie, so each position is tested by walking shared prefixes once rather than trying every permutation in turn. Inputs: perms (iterable of strings). Outputs: compiled regular expression.
+    """
+    return re.compile('(?={})'.format(trie_regex(sorted(set(perms)))))
+
+
+def trie_regex(words):
+    """
+    Builds a regular expression alternation for a sorted list of strings, grouped by shared prefixes. For example, [TAAC, TAGG, TTAG] gives T(?:A(?:AC|GG)|TAG). The trie is built and written out with an explicit stack rather than recursion, as its depth is the length of the words (-minlength). Inputs: words (sorted list of strings). Outputs: regular expression (string).
+    """
+    root = {}
+    for word in words:
+        node = root
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = None
+    parts = []
+    todo = [root]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, str):
+            parts.append(node)
+        elif '' not in node:
+            # a word ending here matches whatever follows, so its children are not written
+            alts = list(node.items())
+            if len(alts) != 1:
+                todo.append(')')
+            for i in reversed(range(len(alts))):
+                c, child = alts[i]
+                todo.append(child)
+                todo.append(re.escape(c))
+                if i > 0:
+                    todo.append('|')
+            if len(alts) != 1:
+                todo.append('(?:')
+    return ''.join(parts)
+
+
+def mask_telomeres(seq, pattern, hits=None):
+    """
+    Replaces runs of pattern*3 with Q, then runs of its reverse complement (times 3) in what is left, each taken leftmost first without overlaps. Both patterns are found in a single scan of seq (or given as hits, from telomere_hits); the hits are resolved in that order and masked in a bytearray. Inputs: seq (string), pattern (string). Outputs: masked sequence (string).
+    """
     comp_pattern = complement(pattern, reverse=True)
-    mask_num = 0
+    pat, comp_pat = pattern*3, comp_pattern*3
+    if hits is None:
+        hits = telomere_hits(seq, pattern)
+    hits, comp_hits = hits
+    
+    # first pass: pattern hits that do not overlap the previous one
+    masked = []
+    last_hit = 0
+    for loc in hits:
+        if loc >= last_hit:
+            masked.append((loc, loc+len(pat)))
+            last_hit = loc + len(pat)
+    
+    # second pass: also skip hits overlapping anything masked by the first
+    comp_masked = []
+    last_hit = 0
+    j = 0
+    for loc in comp_hits:
+        if loc < last_hit:
+            continue
+        while j < len(masked) and masked[j][1] <= loc:
+            j += 1
+        if j < len(masked) and masked[j][0] < loc + len(comp_pat):
+            continue
+        comp_masked.append((loc, loc+len(comp_pat)))
+        last_hit = loc + len(comp_pat)
+    
+    buf = bytearray(seq, 'latin-1')
+    for start, end in chain(masked, comp_masked):
+        buf[start:end] = b'Q' * (end-start)
+    return buf.decode('latin-1')
 
-    for pat in (pattern*3, comp_pattern*3):
-        last_hit = 0
-        seqlis = []
-        while True:
-            hit = seq[last_hit:].find(pat)
-            if hit == -1:
-                seqlis.append(seq[last_hit:])
-                break
-            seqlis.append(seq[last_hit:last_hit+hit])
-            seqlis.append('Q'*len(pat))
-            last_hit += hit + len(pat)
-            mask_num += 1
-        seq = ''.join(seqlis) 
-    return ''.join(seqlis)
+
+def telomere_hits(seq, pattern):
+    """
+    Finds every (overlapping) start of pattern*3 and of its reverse complement times 3 in one scan. Inputs: seq (string), pattern (string). Outputs: (pattern starts, reverse complement starts).
+    """
+    pat = pattern*3
+    comp_pat = complement(pattern, reverse=True)*3
+    hits, comp_hits = [], []
+    scanner = re.compile('(?={}|{})'.format(re.escape(pat), re.escape(comp_pat)))
+    for hit in scanner.finditer(seq):
+        loc = hit.start()
+        if seq.startswith(pat, loc):
+            hits.append(loc)
+        if seq.startswith(comp_pat, loc):
+            comp_hits.append(loc)
+    return hits, comp_hits
 
 
-def filter_perms(permlis, n):
-    if n > 0:
-        return [perm for perm in permlis if perm.get_filter_stat(n)]
-    return permlis
+def filter_perms(permlists, n):
+    """
+    Yields each record's list of permutations, keeping those that pass get_filter_stat(n) if n > 0.
+    """
+    for permlis in permlists:
+        if n > 0:
+            permlis = [perm for perm in permlis if perm.get_filter_stat(n)]
+        yield permlis
     
 #%%
-def write_fasta_output(file_name, permlist):
+FASTA_WIDTH = 60
+WRITE_BUFFER = 1 << 20
+
+
+def write_fasta_output(file_name, permlists, threads=1):
+    """
+    Writes the permutations of each record as they arrive, flushing after every record. Contigs are wrapped at FASTA_WIDTH by slicing and written with writelines. A file name ending in .gz is gzip compressed (see open_output). Outputs: number of permutations written.
+    """
     total_ct = 0
-    with open(file_name, 'w') as file_handle:
-        for perm in permlist:
-            # parse sequence into chuncks of 60
-            seq = []
-            for i, c in enumerate(perm.contig):
-                if i % 60 == 0 and i > 0:
-                    seq.append('\n')
-                seq.append(c)
-            fasta_sequence = ''.join(seq)
-        
-            file_handle.write('>{0}\n{1}\n'.format(perm.header, fasta_sequence))
-            total_ct += 1
+    with open_output(file_name, threads) as file_handle:
+        for permlist in permlists:
+            for perm in permlist:
+                contig = perm.contig
+                file_handle.write('>{0}\n'.format(perm.header))
+                if contig:
+                    file_handle.writelines(wrap_lines(contig))
+                else:
+                    file_handle.write('\n')
+                total_ct += 1
+            file_handle.flush()
     
     return total_ct
 
 
-def write_table_output(args, permlist):
-    import pandas as pd
-    
-    data = {'Contig': [],
-        'Putative Template': [],
-        'Template Length': [],
-        'Contig Start': [],
-        'Contig End': [],
-        'Strand': []}
-    
-    for perm in permlist:
-        perm.update_match(len(args.pattern))
-        data['Contig'].append(perm.header)
-        data['Putative Template'].append(perm.match)
-        data['Template Length'].append(len(perm.match))
-        data['Contig Start'].append(perm.start+1)
-        data['Contig End'].append(perm.end+1)
-        if perm.sense:
-            data['Strand'].append('+')
+def wrap_lines(seq, width=FASTA_WIDTH):
+    """
+    Yields seq in lines of width characters, each with its newline.
+    """
+    for i in range(0, len(seq), width):
+        yield seq[i:i+width] + '\n'
+
+
+@contextmanager
+def open_output(fname, threads=1):
+    """
+    Opens fname for writing text with a large buffer. Names ending in .gz are compressed by pigz (with threads threads) when it is installed, or by the gzip module otherwise.
+    """
+    if not fname.endswith('.gz'):
+        with open(fname, 'w', buffering=WRITE_BUFFER) as handle:
+            yield handle
+        return
+    pigz = shutil.which('pigz')
+    if pigz is None:
+        with gzip.open(fname, 'wt') as handle:
+            yield handle
+        return
+    with open(fname, 'wb') as out:
+        proc = subprocess.Popen([pigz, '-c', '-p', str(max(threads, 1))], 
+                                stdin=subprocess.PIPE, stdout=out)
+        with io.TextIOWrapper(io.BufferedWriter(proc.stdin, WRITE_BUFFER)) as handle:
+            yield handle
+        if proc.wait() != 0:
+            raise IOError('pigz failed on {}'.format(fname))
+
+
+TABLE_COLUMNS = ['Contig', 'Putative Template', 'Template Length', 
+                 'Contig Start', 'Contig End', 'Strand']
+
+
+def write_table_output(args, permlists):
+    """
+    Passes on each record's list of permutations after adding their rows to the table (see TableWriter).
+    """
+    with TableWriter(args.out_table) as table:
+        for permlist in permlists:
+            rows = []
+            for perm in permlist:
+                perm.update_match(len(args.pattern))
+                rows.append((perm.header, perm.match, len(perm.match), 
+                             perm.start+1, perm.end+1, '+' if perm.sense else '-'))
+            table.write(rows)
+            yield permlist
+
+
+class TableWriter():
+    '''
+    Writes table rows as they come. The format follows the file name: Excel for names containing .xlsx (through pandas, which needs every row at the end), Parquet for .parquet and Arrow IPC for .arrow or .feather (through pyarrow, a record batch per write), tab separated for .tsv and CSV otherwise.
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.rows = []
+        self.handle = None
+        self.writer = None
+        if '.xlsx' in fname:
+            self.kind = 'xlsx'
+        elif fname.endswith(('.parquet', '.arrow', '.feather')):
+            self.kind = 'arrow'
+            import pyarrow as pa
+            self.schema = pa.schema([(TABLE_COLUMNS[0], pa.string()), (TABLE_COLUMNS[1], pa.string()), 
+                                     (TABLE_COLUMNS[2], pa.int64()), (TABLE_COLUMNS[3], pa.int64()), 
+                                     (TABLE_COLUMNS[4], pa.int64()), (TABLE_COLUMNS[5], pa.string())])
+            if fname.endswith('.parquet'):
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(fname, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(fname, self.schema)
         else:
-            data['Strand'].append('-')
+            self.kind = 'csv'
+            self.handle = open(fname, 'w', newline='', buffering=WRITE_BUFFER)
+            delimiter = '\t' if fname.endswith('.tsv') else ','
+            self.writer = csv.writer(self.handle, delimiter=delimiter, lineterminator='\n')
+            self.writer.writerow(TABLE_COLUMNS)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def write(self, rows):
+        if self.kind == 'xlsx':
+            self.rows.extend(rows)
+        elif not rows:
+            return
+        elif self.kind == 'arrow':
+            import pyarrow as pa
+            columns = [list(column) for column in zip(*rows)]
+            self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+        else:
+            self.writer.writerows(rows)
+            self.handle.flush()
+    
+    def close(self):
+        if self.kind == 'xlsx':
+            import pandas as pd
+            df = pd.DataFrame(self.rows, columns=TABLE_COLUMNS).set_index('Contig')
+            df.to_excel(self.fname)
+        elif self.kind == 'arrow':
+            self.writer.close()
+        else:
+            self.handle.close()
 
-    df = pd.DataFrame(data)
-    df = df.set_index('Contig')
 
-    if '.xlsx' in args.out_table:
-        df.to_excel(args.out_table)
-    else:
-        df.to_csv(args.out_table)
+COORDS_COLUMNS = ['Record', 'Location', 'Match', 'Strand']
+
+
+def write_coords_output(file_name, permlists):
+    """
+    Passes on each record's list of permutations after writing their coordinates (record description, 0-based location, match and strand) as tab separated lines. These are all -from_coords needs to extract contigs again from an indexed FASTA file.
+    """
+    with open(file_name, 'w', newline='') as file_handle:
+        writer = csv.writer(file_handle, delimiter='\t', lineterminator='\n')
+        writer.writerow(COORDS_COLUMNS)
+        for permlist in permlists:
+            writer.writerows((perm.description, perm.loc, perm.match, 
+                              '+' if perm.sense else '-') for perm in permlist)
+            file_handle.flush()
+            yield permlist
+
+
+def read_coords_output(args, index):
+    """
+    Yields lists of permutations, one per record, from a file written by write_coords_output. Their contigs are read from the indexed FASTA file with the flanks in args, so changing -upstream or -downstream needs no new search. Contigs come from the file as it is, without --mask.
+    """
+    with open(args.from_coords, newline='') as file_handle:
+        reader = csv.reader(file_handle, delimiter='\t')
+        next(reader, None)
+        for header, rows in groupby(reader, key=lambda row: row[0]):
+            record = IndexedRecord(index, fasta_name(header))
+            permlist = []
+            for _, loc, match, strand in rows:
+                perm = Permutation(int(loc), match, header, sense=(strand == '+'))
+                perm.get_contig(record, args.up, args.down, args.whole_contig)
+                perm.update_header()
+                permlist.append(perm)
+            yield permlist
+#%% test functions
+TEST_PATTERN = 'TTAGGG'
+
+
+def test():
+    testScan()
+    testMask()
+    testSearch()
+    testIndex()
+    testRun()
+
+
+def reference_search(sequence, pattern, header, up=100, down=400, whole=False,
+                     minlen=-1, maxlen=-1):
+    """
+    Window by window search for the permutations of pattern and of its reverse complement, as the script did before the trie scan. Outputs: list of (loc, match, sense, start, end, header) for each permutation found.
+    """
+    k = len(pattern)+2 if minlen < 0 else minlen
+    k_long = 2*len(pattern)+1 if maxlen < 0 else maxlen
+    comp_pattern = complement(pattern, reverse=True)
+    perms = permutation_extender(comp_pattern, k)
+    long_perms = permutation_extender(comp_pattern, k_long)
+    revperms = permutation_extender(pattern, k)
+    long_revperms = permutation_extender(pattern, k_long)
+    seq = sequence.upper()
+    n = len(seq)
+    found = []
+    i = 0
+    while i <= n-k+1:
+        subseq = seq[i:i+k]
+        for sense, short, long in ((True, perms, long_perms), (False, revperms, long_revperms)):
+            if subseq in short:
+                if seq[i:i+k_long] not in long and seq[i+1-k_long:i+1] not in long:
+                    perm = Permutation(i, seq[i:i+k_long], header, sense)
+                    perm.get_contig(sequence, up, down, whole)
+                    perm.update_header()
+                    found.append(perm)
+                i += k_long
+                break
+        else:
+            i += 1
+    return [(p.loc, p.match, p.sense, p.start, p.end, p.header) for p in found]
+
+
+def reference_mask(seq, pattern):
+    """
+    Replaces each run of pattern*3, then of its reverse complement times 3 in what is left, with Q, leftmost first and without overlaps, by find and replace.
+    """
+    comp_pattern = complement(pattern, reverse=True)
+    for pat in (pattern*3, comp_pattern*3):
+        last_hit = 0
+        parts = []
+        while True:
+            hit = seq.find(pat, last_hit)
+            if hit == -1:
+                parts.append(seq[last_hit:])
+                break
+            parts.append(seq[last_hit:hit])
+            parts.append('Q'*len(pat))
+            last_hit = hit + len(pat)
+        seq = ''.join(parts)
+    return seq
+
+
+def reference_match(match, num):
+    """
+    match trimmed until it is an extension of a rotation of match[:num].
+    """
+    while match not in permutation_extender(match[:num], len(match)):
+        match = match[:-1]
+    return match
+
+
+def synthetic_records(seed, nrecords=4, length=20000, nrepeats=12):
+    """
+    Writes a FASTA file of random records with nrepeats runs of 2 to 40 copies of a rotation of TEST_PATTERN, or of its reverse complement, with 1% errors, planted in each; the first two at the ends stand in for telomeres. Outputs: file name, list of (sequence, description) read back with read_fasta.
+    """
+    rng = random.Random(seed)
+    fd, fname = tempfile.mkstemp(suffix='.fa')
+    with os.fdopen(fd, 'w') as f:
+        for i in range(nrecords):
+            seq = [rng.choice('ACGT') for _ in range(length)]
+            for j in range(nrepeats):
+                shift = rng.randrange(len(TEST_PATTERN))
+                run = (TEST_PATTERN[shift:] + TEST_PATTERN[:shift]) * rng.randint(2, 40)
+                if rng.random() < 0.5:
+                    run = complement(run, reverse=True)
+                run = [rng.choice('ACGT') if rng.random() < 0.01 else c for c in run]
+                start = (0, length-len(run))[j] if j < 2 else rng.randint(0, length-len(run))
+                seq[start:start+len(run)] = run
+            f.write('>chr{} synthetic record {}\n'.format(i+1, i+1))
+            seq = ''.join(seq)
+            f.writelines(seq[k:k+60] + '\n' for k in range(0, len(seq), 60))
+    with open_file(fname, False) as handle:
+        records = list(read_fasta(handle))
+    return fname, records
+
+
+def tricky_sequences(seed):
+    """
+    Short sequences with runs of both strands of the pattern touching and overlapping, lower case bases and N, which the planted repeats rarely give.
+    """
+    rng = random.Random(seed)
+    comp = complement(TEST_PATTERN, reverse=True)
+    pieces = [TEST_PATTERN, comp, TEST_PATTERN[2:], comp[:4], 'N', 'a', 'ttaggg', 'ACGT']
+    return [''.join(rng.choice(pieces) for _ in range(rng.randint(1, 40)))
+            for _ in range(300)]
+
+
+def testScan(seed=1):
+    """
+    Checks permutation_candidates, the one pass trie regex, against testing every window of the sequence against the permutation sets, also for a -minlength far past the recursion limit.
+    """
+    fname, records = synthetic_records(seed)
+    os.remove(fname)
+    seqs = [seq for seq, _ in records] + tricky_sequences(seed)
+    for minlen, maxlen in ((-1, -1), (8, 15), (10, -1)):
+        k, _, perms, _, revperms, _ = permutation_sets(TEST_PATTERN, minlen, maxlen)
+        both = perms | revperms
+        for seq in seqs:
+            seq = seq.upper()
+            expected = [i for i in range(len(seq)-k+1) if seq[i:i+k] in both]
+            assert(permutation_candidates(seq, both) == expected)
+
+    comp = complement(TEST_PATTERN, reverse=True)
+    long_seqs = [seqs[0][:3000] + TEST_PATTERN*400 + seqs[1][:3000] + comp*360 + 'A']
+    for minlen, maxlen in ((1100, 1200), (2000, 2100)):
+        k, _, perms, _, revperms, _ = permutation_sets(TEST_PATTERN, minlen, maxlen)
+        both = perms | revperms
+        for seq in long_seqs:
+            expected = [i for i in range(len(seq)-k+1) if seq[i:i+k] in both]
+            assert(permutation_candidates(seq, both) == expected)
+        assert(expected)
+
+    print("all scan tests passed!", len(seqs))
+
+
+def testMask(seed=2):
+    """
+    Checks the single scan mask_telomeres, with its own scan and with the hits given from telomere_hits as the pool does, against reference_mask.
+    """
+    fname, records = synthetic_records(seed)
+    os.remove(fname)
+    seqs = [seq for seq, _ in records] + tricky_sequences(seed)
+    masked = 0
+    for seq in seqs:
+        expected = reference_mask(seq, TEST_PATTERN)
+        assert(mask_telomeres(seq, TEST_PATTERN) == expected)
+        hits = telomere_hits(seq, TEST_PATTERN)
+        assert(mask_telomeres(seq, TEST_PATTERN, hits) == expected)
+        masked += expected != seq
+    assert(masked > 0)
+
+    print("all mask tests passed!", len(seqs), masked)
+
+
+def testSearch(seed=3):
+    """
+    Checks permutation_search on raw and masked sequences, and the trimmed matches of update_match, against the reference path.
+    """
+    fname, records = synthetic_records(seed)
+    os.remove(fname)
+    seqs = list(records)
+    seqs += [(seq, 'tricky{}'.format(i)) for i, seq in enumerate(tricky_sequences(seed))]
+    found = 0
+    for seq, header in seqs:
+        for s in (seq, reference_mask(seq, TEST_PATTERN)):
+            for minlen, maxlen, whole in ((-1, -1, False), (8, 15, True)):
+                perms = permutation_search(s, TEST_PATTERN, 100, 400, header, whole,
+                                           minlen, maxlen)
+                got = [(p.loc, p.match, p.sense, p.start, p.end, p.header) for p in perms]
+                assert(got == reference_search(s, TEST_PATTERN, header, 100, 400, whole,
+                                               minlen, maxlen))
+                for perm in perms:
+                    expected = reference_match(perm.match, len(TEST_PATTERN))
+                    perm.update_match(len(TEST_PATTERN))
+                    assert(perm.match == expected)
+                found += len(perms)
+    assert(found > 0)
+
+    print("all search tests passed!", len(seqs), found)
+
+
+def testIndex(seed=5):
+    """
+    Checks that FastaIndex fetches every slice of records wrapped at various widths, with a short or missing last line, CRLF line ends and no final newline, and that build_index refuses records whose lines other than the last differ in length or whose last line is too long.
+    """
+    rng = random.Random(seed)
+    fd, fname = tempfile.mkstemp(suffix='.fa')
+    os.close(fd)
+    checked = 0
+    try:
+        for trial in range(40):
+            records = []
+            text = []
+            newline = rng.choice(['\n', '\r\n'])
+            for i in range(rng.randint(1, 4)):
+                seq = ''.join(rng.choice('ACGTN') for _ in range(rng.randint(1, 50)))
+                width = rng.randint(1, 12)
+                records.append(('r{}'.format(i), seq))
+                text.append('>r{} record {}'.format(i, i) + newline)
+                text.extend(seq[k:k+width] + newline for k in range(0, len(seq), width))
+            text = ''.join(text)
+            if rng.random() < 0.3:
+                text = text.rstrip('\r\n')
+            with open(fname, 'w', newline='') as f:
+                f.write(text)
+            if os.path.exists(fname + '.fai'):
+                os.remove(fname + '.fai')
+            with FastaIndex(fname) as index:
+                for name, seq in records:
+                    assert(index.length(name) == len(seq))
+                    for start in range(len(seq)):
+                        for end in range(start, len(seq)+1):
+                            assert(index.fetch(name, start, end) == seq[start:end])
+                            checked += 1
+
+        for text in ('>r1\nACGT\nAAAAACCCCC\n', '>r1\nACGT\nAC\nACGT\n', 
+                     '>r1\nACGT\nACGTA\n>r2\nAC\n', '>r1\nACGT\r\nACGT\nAC\n',
+                     '>r1\nACGT\n\nACGT\n'):
+            with open(fname, 'w', newline='') as f:
+                f.write(text)
+            try:
+                build_index(fname)
+            except ValueError:
+                pass
+            else:
+                assert(False)
+    finally:
+        for name in (fname, fname + '.fai'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    print("all index tests passed!", checked)
+
+
+def reference_output(records, mask, filter_n, up=100, down=400):
+    """
+    FASTA text and table rows the reference path gives for records.
+    """
+    fasta = []
+    rows = []
+    for seq, header in records:
+        if mask or filter_n > 0:
+            seq = reference_mask(seq, TEST_PATTERN)
+        for loc, match, sense, start, end, full in reference_search(seq, TEST_PATTERN, header, up, down):
+            contig = seq[start:end]
+            if filter_n > 0:
+                at = contig.find(match)
+                if 'Q' in contig[at-filter_n:at+filter_n+len(match)]:
+                    continue
+            lines = [contig[i:i+60] for i in range(0, len(contig), 60)]
+            fasta.append('>{}\n{}\n'.format(full, '\n'.join(lines)))
+            match = reference_match(match, len(TEST_PATTERN))
+            rows.append([full, match, str(len(match)), str(start+1), str(end+1),
+                         '+' if sense else '-'])
+    return ''.join(fasta), rows
+
+
+def testRun(seed=4):
+    """
+    Runs the script end to end on a synthetic genome over a matrix of options (threads and chunk sizes, --mask, -filter, gzip input, coordinates written and read back from the plain and, with biopython, a BGZF copy of the genome) and checks the FASTA output and the table against the reference path.
+    """
+    try:
+        from Bio import bgzf  # only to write the BGZF test input
+    except ImportError:
+        bgzf = None
+    fname, records = synthetic_records(seed, nrecords=5, length=30000)
+    tmp = tempfile.mkdtemp()
+    gz = os.path.join(tmp, 'genome.fa.gz')
+    with open(fname, 'rb') as f, gzip.open(gz, 'wb') as out:
+        out.write(f.read())
+    indexed = [fname]
+    if bgzf is not None:
+        indexed.append(os.path.join(tmp, 'genome.fa.bgz'))
+        with open(fname, 'rb') as f, bgzf.BgzfWriter(indexed[-1], 'wb') as out:
+            out.write(f.read())
+    out_fa = os.path.join(tmp, 'out.fa')
+    out_table = os.path.join(tmp, 'out.csv')
+    coords = os.path.join(tmp, 'out.coords')
+    runs = 0
+    try:
+        for mask, filter_n in ((False, 0), (True, 0), (False, 5)):
+            expected_fasta, expected_rows = reference_output(records, mask, filter_n)
+            for infile, threads, chunksize in ((fname, 1, 10000000), (fname, 2, 10000000),
+                                               (fname, 2, 7000), (gz, 2, 5000), (gz, 1, 10000000)):
+                argv = ['-pattern', TEST_PATTERN, '-infile', infile, '-outfile', out_fa,
+                        '-table', out_table, '-coords', coords, '-filter', str(filter_n),
+                        '-threads', str(threads), '-chunksize', str(chunksize)]
+                args = parse_args(argv + (['--mask'] if mask else []))
+                with redirect_stdout(io.StringIO()):
+                    run(args)
+                with open(out_fa) as f:
+                    assert(f.read() == expected_fasta)
+                with open(out_table, newline='') as f:
+                    rows = list(csv.reader(f))
+                assert(rows[0] == TABLE_COLUMNS)
+                assert(rows[1:] == expected_rows)
+                runs += 1
+
+            if not mask and filter_n == 0:
+                # contigs extracted again from the indexed file, flanks changed
+                expected_fasta, _ = reference_output(records, False, 0, up=30, down=50)
+                for infile in indexed:
+                    args = parse_args(['-pattern', TEST_PATTERN, '-infile', infile,
+                                       '-from_coords', coords, '-outfile', out_fa,
+                                       '-upstream', '30', '-downstream', '50', '--index'])
+                    with redirect_stdout(io.StringIO()):
+                        run(args)
+                    with open(out_fa) as f:
+                        assert(f.read() == expected_fasta)
+                    runs += 1
+    finally:
+        shutil.rmtree(tmp)
+        for name in (fname, fname + '.fai'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    print("all run tests passed!", runs)
+
 #%% run function
 
 if __name__ == "__main__":
@@ -0,0 +1,9 @@
+############################################################
+# setup.py
+# builds ctst, the C trie behind TST.FastTST, next to TST.py:
+#     python setup.py build_ext --inplace
+############################################################
+
+from setuptools import setup, Extension
+
+setup(name='ctst', ext_modules=[Extension('ctst', sources=['ctst.c'])])